@@ -0,0 +1,43 @@
+"""Compare the cost of adding tasks one at a time or in bulk to scalems.local.
+
+Usage:
+    python benchmarks/add_items.py [num_tasks]
+
+"""
+import sys
+import time
+
+import scalems.local
+from scalems.subprocess import Subprocess, SubprocessInput
+
+
+def make_tasks(num_tasks: int):
+    return [Subprocess(SubprocessInput(('/bin/echo', str(i)))) for i in range(num_tasks)]
+
+
+def main(num_tasks=100000):
+    tasks = make_tasks(num_tasks)
+    # Fingerprints are cached by the task objects. Compute them outside of the timed region.
+    for task in tasks:
+        task.uid()
+
+    context = scalems.local.AsyncWorkflowManager()
+    start = time.perf_counter()
+    for task in tasks:
+        context.add_item(task)
+    serial = time.perf_counter() - start
+
+    context = scalems.local.AsyncWorkflowManager()
+    start = time.perf_counter()
+    context.add_items(tasks)
+    bulk = time.perf_counter() - start
+
+    print('add_item: {:.3f} s ({:.2f} us per task)'.format(serial, 1e6 * serial / num_tasks))
+    print('add_items: {:.3f} s ({:.2f} us per task)'.format(bulk, 1e6 * bulk / num_tasks))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
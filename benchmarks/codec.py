@@ -0,0 +1,89 @@
+"""Compare the throughput of the workflow record codecs.
+
+Encodes and decodes the records of *num_tasks* subprocess tasks (each depending
+on the previous task) with each registered codec, and writes and reads them as a
+workflow document.
+
+Usage:
+    python benchmarks/codec.py [num_tasks]
+
+"""
+import gc
+import io
+import sys
+import time
+
+import scalems.local
+from scalems.serialization import get_codec, WorkflowReader, WorkflowWriter
+from scalems.subprocess import Subprocess, SubprocessInput
+
+
+def make_records(num_tasks: int):
+    records = list()
+    previous = None
+    for i in range(num_tasks):
+        inputs = {} if previous is None else {'-i': previous}
+        task = Subprocess(SubprocessInput(('/bin/echo', str(i)), inputs=inputs))
+        records.append(scalems.local._make_record(task))
+        previous = scalems.context.ItemView(_placeholder, task.uid())
+    return records
+
+
+class _Placeholder(scalems.context.WorkflowManager):
+    def add_item(self, task_description):
+        ...
+
+    def item(self, identifier):
+        ...
+
+
+_placeholder = _Placeholder()
+
+
+def main(num_tasks=100000):
+    records = make_records(num_tasks)
+    # As in AsyncWorkflowManager.add_items(), do not let garbage collection of
+    # the (acyclic) records dominate the measurements.
+    gc.disable()
+    for name in ('json', 'binary'):
+        codec = get_codec(name)
+        start = time.perf_counter()
+        encoded = [codec.encode(record) for record in records]
+        encode = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = [codec.decode(data) for data in encoded]
+        decode = time.perf_counter() - start
+        assert decoded[-1] == codec.decode(codec.encode(records[-1]))
+        size = sum(len(data) for data in encoded)
+        del decoded
+
+        fp = io.BytesIO() if codec.binary else io.StringIO()
+        start = time.perf_counter()
+        with WorkflowWriter(fp, codec=codec) as writer:
+            for record in records:
+                writer.write(record)
+        write = time.perf_counter() - start
+        fp.seek(0)
+        start = time.perf_counter()
+        count = sum(1 for _ in WorkflowReader(fp, codec=codec))
+        read = time.perf_counter() - start
+        assert count == num_tasks
+
+        print('{}: {:.1f} bytes per record'.format(name, size / num_tasks))
+        print('    encode: {:.3f} s ({:.0f} records/s)'.format(encode, num_tasks / encode))
+        print('    decode: {:.3f} s ({:.0f} records/s)'.format(decode, num_tasks / decode))
+        print('    write document: {:.3f} s, read document: {:.3f} s'.format(write, read))
+        if hasattr(codec, 'decode_header'):
+            start = time.perf_counter()
+            for data in encoded:
+                codec.decode_header(data)
+            header = time.perf_counter() - start
+            print('    decode uid and dependencies only: {:.3f} s ({:.0f} records/s)'.format(
+                header, num_tasks / header))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,65 @@
+"""Compare scalems.reduce to a serial functools.reduce.
+
+Each combination sleeps for *delay* seconds, standing in for an operation
+(such as summing transition count matrices) that releases the GIL.
+
+Usage:
+    python benchmarks/reduce.py [num_inputs [delay [cores]]]
+
+"""
+import asyncio
+import functools
+import sys
+import tempfile
+import time
+
+import scalems
+import scalems.context
+import scalems.local
+
+
+def combine(a, b, delay=0.):
+    time.sleep(delay)
+    return a + b
+
+
+@scalems.function_wrapper(execution='thread')
+def scalems_combine(a, b):
+    return combine(a, b, delay=_delay)
+
+
+_delay = 0.
+
+
+async def run_scalems(inputs, *, ordered: bool, cores: int):
+    with tempfile.TemporaryDirectory() as directory:
+        context = scalems.local.AsyncWorkflowManager(cores=cores, directory=directory)
+        with scalems.context.scope(context):
+            async with context.dispatch():
+                if ordered:
+                    result = scalems.reduce(scalems_combine, inputs)
+                else:
+                    result = await scalems.reduce(scalems_combine, inputs, ordered=False)
+        return result.result()
+
+
+def main(num_inputs=1000, delay=0.001, cores=8):
+    global _delay
+    _delay = delay
+    inputs = list(range(num_inputs))
+    expected = sum(inputs)
+
+    start = time.perf_counter()
+    assert functools.reduce(functools.partial(combine, delay=delay), inputs) == expected
+    serial = time.perf_counter() - start
+    print('functools.reduce: {:.3f} s'.format(serial))
+
+    for ordered in (True, False):
+        start = time.perf_counter()
+        assert asyncio.run(run_scalems(inputs, ordered=ordered, cores=cores)) == expected
+        elapsed = time.perf_counter() - start
+        print('scalems.reduce(ordered={}): {:.3f} s'.format(ordered, elapsed))
+
+
+if __name__ == '__main__':
+    main(*[cast(arg) for cast, arg in zip((int, float, int), sys.argv[1:])])
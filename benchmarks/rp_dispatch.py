@@ -0,0 +1,56 @@
+"""Measure the throughput and latency of the RADICAL Pilot dispatching code path.
+
+Runs *num_tasks* ``/bin/true`` tasks through scalems.radical.RPWorkflowContext,
+using the local stand-in for radical.pilot (scalems.radical.fake) with an
+injected round-trip latency for each unit submission call and a launch latency
+for each unit. Compares submitting every unit separately, batched submission,
+and bundling tasks into units executed by scalems.radical.worker.
+
+Usage:
+    python benchmarks/rp_dispatch.py [num_tasks [cores]]
+
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+import scalems
+import scalems.context
+import scalems.radical
+import scalems.radical.fake as fake
+
+
+async def run(num_tasks: int, cores: int, batch_size: int, bundle_size: int = None):
+    context = scalems.radical.RPWorkflowContext(rp=fake, batch_size=batch_size,
+                                                bundle_size=bundle_size, bundle_cores=cores,
+                                                pilots=[{'cores': cores}])
+    latencies = list()
+    start = time.perf_counter()
+    with scalems.context.scope(context):
+        async with context.dispatch():
+            async def timed(i):
+                added = time.perf_counter()
+                await scalems.executable(('/bin/true', str(i)))
+                latencies.append(time.perf_counter() - added)
+
+            await asyncio.gather(*(timed(i) for i in range(num_tasks)))
+    elapsed = time.perf_counter() - start
+    return elapsed, latencies, context.umgr.submit_count
+
+
+def main(num_tasks=1000, cores=4):
+    fake.submit_latency = 0.01
+    fake.launch_latency = 0.05
+    print('{} tasks, {} cores, {:.0f} ms per submission call, {:.0f} ms per launch'.format(
+        num_tasks, cores, fake.submit_latency * 1000, fake.launch_latency * 1000))
+    for batch_size, bundle_size in ((1, None), (256, None), (256, 64)):
+        elapsed, latencies, calls = asyncio.run(run(num_tasks, cores, batch_size, bundle_size))
+        print('batch size {}, bundle size {}: {:.2f} s ({:.0f} tasks/s), {} submission calls'.format(
+            batch_size, bundle_size, elapsed, num_tasks / elapsed, calls))
+        print('    task latency: median {:.3f} s, max {:.3f} s'.format(
+            statistics.median(latencies), max(latencies)))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,60 @@
+"""Measure the per-task overhead of workflow item dispatching in scalems.local.
+
+Creates scalems.context.Task records and performs the item accesses made by
+the local executor for each dispatched task.
+
+Usage:
+    python benchmarks/task_dispatch.py [num_tasks]
+
+"""
+import json
+import sys
+import timeit
+
+import scalems.context
+import scalems.local
+import scalems.subprocess
+from scalems.serialization import Encoder
+
+
+def make_records(num_tasks: int):
+    records = []
+    for i in range(num_tasks):
+        task_input = scalems.subprocess.SubprocessInput(('/bin/echo', str(i)), environment={'SEED': str(i)})
+        task = scalems.subprocess.Subprocess(task_input)
+        record = {
+            'uid': task.uid().hex(),
+            'type': task.resource_type().scoped_identifier(),
+            'input': {key: value for key, value in task_input.__dict__.items()},
+            'depends': []
+        }
+        records.append(json.dumps(record, cls=Encoder))
+    return records
+
+
+def dispatch_overhead(context, records):
+    """Perform the Task accesses of run_executor for each record."""
+    input_type = scalems.subprocess.SubprocessTask.input_type()
+    for record in records:
+        item = scalems.context.Task(context, record)
+        item_shape = item.description().shape()
+        assert len(item_shape) == 1 and item_shape[0] == 1
+        assert item.description().type().identifier() == 'scalems.subprocess.SubprocessTask'
+        input_type(**item.input)
+        item.dependencies()
+
+
+def main(num_tasks=10000, repeat=5):
+    context = scalems.local.AsyncWorkflowManager()
+    records = make_records(num_tasks)
+    timings = timeit.repeat(lambda: dispatch_overhead(context, records), number=1, repeat=repeat)
+    best = min(timings)
+    print('{} tasks: best of {}: {:.3f} s ({:.2f} us per task)'.format(
+        num_tasks, repeat, best, 1e6 * best / num_tasks))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
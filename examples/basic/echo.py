@@ -3,17 +3,19 @@
 Example:
 
     $ python -m scalems.local echo.py
-    $ cat stdout
+    $ cat */stdout
 
     $
 
 Example:
 
     $ python -m scalems.local echo.py hi there
-    $ cat stdout
+    $ cat */stdout
     hi there
     $
 
+With scalems.local, the task executes in a directory named for the task uid.
+
 Example:
 
     $ python -m scalems.radical echo.py hi there
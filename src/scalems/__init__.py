@@ -136,7 +136,7 @@ def run(ref: WorkflowObject[ResultType], context=None, **kwargs) -> ResultType:
     return run(ref, context=context, **kwargs)
 
 
-def function_wrapper(output: dict = None):
+def function_wrapper(output: dict = None, *, execution: str = 'process'):
     # Suppress warnings in the example code.
     # noinspection PyUnresolvedReferences
     """Generate a decorator for wrapped functions with signature manipulation.
@@ -159,13 +159,23 @@ def function_wrapper(output: dict = None):
 
     Arguments:
         output (dict): output names and types
+        execution (str): hint for how to call the function: ``inline``, ``thread``, or ``process``
 
     If ``output`` is provided to the wrapper, a data structure will be passed to
     the wrapped functions with the named attributes so that the function can easily
     publish multiple named results. Otherwise, the ``output`` of the generated operation
     will just capture the return value of the wrapped function.
+
+    The *execution* hint lets the execution environment avoid the cost of
+    a worker process for cheap functions (``inline``) or functions that release
+    the GIL (``thread``). Refer to :py:func:`scalems.function.function_wrapper`.
+
+    Wrapped functions must be importable (defined at module level) and their
+    arguments must be serializable. Execution environments may run the function
+    in another process.
     """
-    raise exceptions.MissingImplementationError()
+    from .function import function_wrapper
+    return function_wrapper(output, execution=execution)
 
 
 def subgraph(variables=None):
@@ -207,13 +217,22 @@ def subgraph(variables=None):
         handle = loop()
         assert handle.output.float_with_default.result() == 6
 
+    Only operations produced by `function_wrapper` can currently be configured
+    in a subgraph.
+
+    Refer to :py:class:`scalems.control.Subgraph`.
     """
-    raise exceptions.MissingImplementationError()
+    from .control import Subgraph
+    return Subgraph(variables)
 
 
 def logical_not(value):
-    """Negate boolean inputs."""
-    raise exceptions.MissingImplementationError()
+    """Negate boolean inputs.
+
+    Refer to :py:func:`scalems.control.logical_not`.
+    """
+    from .control import logical_not
+    return logical_not(value)
 
 
 def logical_and(iterable):
@@ -259,8 +278,15 @@ def while_loop(*, function, condition, max_iteration=10, **kwargs):
         versions of this software. The default value may be changed or
         removed on short notice.
 
+    The current implementation requires *function* to be produced by `subgraph`,
+    and *condition* to be a (possibly negated) variable of the subgraph. The
+    chain is extended while *condition* is true, one iteration at a time, and
+    intermediate results are released as the loop proceeds.
+
+    Refer to :py:func:`scalems.control.while_loop`.
     """
-    raise exceptions.MissingImplementationError()
+    from .control import while_loop
+    return while_loop(function=function, condition=condition, max_iteration=max_iteration, **kwargs)
 
 
 def desequence(iterable):
@@ -273,8 +299,31 @@ def desequence(iterable):
 
     This allows iterative tools (e.g. `map`) to use unordered or asynchronous
     iteration on resource slices as they become available.
+
+    Refer to :py:func:`scalems.iteration.desequence`.
     """
-    raise exceptions.MissingImplementationError()
+    from .iteration import desequence
+    return desequence(iterable)
+
+
+def as_completed(iterable, *, batch_size: int = None, window: float = None):
+    """Iterate over workflow references as they complete.
+
+    Produces an asynchronous iterator of the references in *iterable*, in the
+    order in which the referenced work completes. If *batch_size* or *window*
+    is provided, references are delivered in lists of up to *batch_size* elements,
+    collected for no more than *window* seconds after the first element of the batch
+    becomes available.
+
+    Example::
+
+        async for batch in scalems.as_completed(trajectories, batch_size=10):
+            model = update(model, [trajectory.result() for trajectory in batch])
+
+    Refer to :py:func:`scalems.iteration.as_completed`.
+    """
+    from .iteration import as_completed
+    return as_completed(iterable, batch_size=batch_size, window=window)
 
 
 def resequence(keys, collection):
@@ -290,7 +339,7 @@ def resequence(keys, collection):
     raise exceptions.MissingImplementationError()
 
 
-def gather(iterable):
+def gather(iterable, **kwargs):
     """Convert an iterable or decomposable collection to a complete collection.
 
     Use to synchronize/localize data. Reference with ambiguous dimensionality or
@@ -311,11 +360,16 @@ def gather(iterable):
         a function implementation's assertion of its decomposability, a function
         could express its ensemble/decomposition behavior in terms of a particular
         target scope of an operation.
+
+    In the current implementation, *iterable* provides equal-length vectors (or
+    workflow references to them), which are gathered into contiguous (N, M) storage.
+    Refer to :py:func:`scalems.ensemble.gather`.
     """
-    raise exceptions.MissingImplementationError()
+    from .ensemble import gather
+    return gather(iterable, **kwargs)
 
 
-def scatter(iterable, axis=1):
+def scatter(iterable, axis=1, **kwargs):
     """Explicitly decompose data.
 
     For input with outer dimension size N and dimensionality D,
@@ -326,11 +380,15 @@ def scatter(iterable, axis=1):
     Note: This function is not necessary if we either require fixed dimensionality
     of function inputs or minimize implicit broadcast, scatter, and gather behavior.
     Otherwise, we will need to disambiguate decomposition.
+
+    In the current implementation, the members of gathered data are provided as
+    views of the (contiguous) rows, without copying. Refer to :py:func:`scalems.ensemble.scatter`.
     """
-    raise exceptions.MissingImplementationError()
+    from .ensemble import scatter
+    return scatter(iterable, axis=axis, **kwargs)
 
 
-def reduce(function, iterable):
+def reduce(function, iterable, **kwargs):
     """Repeatedly apply a function.
 
     For an Iterable[T] and a function that maps (T, T) -> T, apply the function
@@ -342,8 +400,13 @@ def reduce(function, iterable):
     *function* obeys the commutative property.
 
     Compare to :py:func:`functools.reduce`
+
+    Operations are generated for a balanced (pairwise) reduction, so independent
+    combinations can execute concurrently. For unordered reduction (``ordered=False``),
+    operands are combined as they become available. Refer to :py:func:`scalems.iteration.reduce`.
     """
-    raise exceptions.MissingImplementationError()
+    from .iteration import reduce
+    return reduce(function, iterable, **kwargs)
 
 
 def extend_sequence(sequence_a, sequence_b):
@@ -351,7 +414,7 @@ def extend_sequence(sequence_a, sequence_b):
     raise exceptions.MissingImplementationError()
 
 
-def map(function, iterable, shape=None):
+def map(function, iterable, shape=None, **kwargs):
     """Generate a collection of operations by iteration.
 
     Apply *function* to each element of *iterable*.
@@ -359,8 +422,13 @@ def map(function, iterable, shape=None):
     If *iterable* is ordered, the generated operation collection is ordered.
 
     If *iterable* is unordered, the generated operation collection is unordered.
+
+    Operations are generated as the collection is consumed, with a bounded
+    number of tasks in flight. Additional key word arguments (*ordered*, *window*,
+    *chunksize*, *context*) are described in :py:func:`scalems.iteration.map`.
     """
-    raise exceptions.MissingImplementationError()
+    from .iteration import map
+    return map(function, iterable, shape=shape, **kwargs)
 
 
 def poll():
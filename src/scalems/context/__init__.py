@@ -27,6 +27,7 @@ import contextvars
 import functools
 import json
 import logging
+import typing
 import warnings
 import weakref
 
@@ -209,6 +210,66 @@ class InvalidStateError(ScaleMSException):
     """
 
 
+class OutputStream:
+    """Deliver text output to asynchronous subscribers as it is produced.
+
+    Subscribers use asynchronous iteration (``async for line in stream``) to
+    receive lines (including line terminators) until the stream is closed.
+    Lines are delivered to each subscriber that is subscribed when they are fed
+    to the stream. Lines are not retained for later subscribers, and subscribers
+    that subscribe after the stream is closed receive no lines.
+
+    Warning:
+        Not thread-safe. Feed and subscribe from within the event loop.
+        Each subscriber buffers lines that it has not yet consumed.
+    """
+    # Marks the end of the stream in subscriber queues.
+    _closed_marker = None
+
+    def __init__(self):
+        self._subscribers = []
+        self._closed = False
+
+    def closed(self) -> bool:
+        return self._closed
+
+    def feed(self, lines: typing.Iterable[str]):
+        """Deliver *lines* to current subscribers."""
+        if self._closed:
+            raise ProtocolError('Stream is closed.')
+        for line in lines:
+            for subscriber in self._subscribers:
+                subscriber.put_nowait(line)
+
+    def close(self):
+        """Mark the end of the stream."""
+        if not self._closed:
+            self._closed = True
+            for subscriber in self._subscribers:
+                subscriber.put_nowait(self._closed_marker)
+
+    def __aiter__(self):
+        # Subscribe immediately, rather than when iteration begins, so that no
+        # lines are missed by a consumer that has not yet been scheduled.
+        subscriber = asyncio.Queue()
+        if self._closed:
+            subscriber.put_nowait(self._closed_marker)
+        else:
+            self._subscribers.append(subscriber)
+        return self._iterate(subscriber)
+
+    async def _iterate(self, subscriber: asyncio.Queue):
+        try:
+            while True:
+                line = await subscriber.get()
+                if line is self._closed_marker:
+                    return
+                yield line
+        finally:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+
 class Task:
     """Encapsulate the implementation details of a managed Task workflow item.
 
@@ -241,47 +302,158 @@ class Task:
     def result(self):
         if not self.done():
             raise InvalidStateError('Called result() on a Task that is not done.')
+        if self._exception is not None:
+            raise self._exception
         return self._result
 
+    def exception(self):
+        if not self.done():
+            raise InvalidStateError('Called exception() on a Task that is not done.')
+        return self._exception
+
     def description(self) -> Description:
-        decoded_record = json.loads(self._encoded)
-        resource_type = ResourceType(tuple(decoded_record['type']))
-        # TODO: Handle multidimensional references.
-        shape = (1,)
-        value = Description(resource_type=resource_type, shape=shape)
-        return value
+        return self._description
 
     def uid(self) -> bytes:
         if not isinstance(self._uid, bytes):
             raise InternalError('Task._uid was stored as bytes. Implementation changed?')
         return bytes(self._uid)
 
+    @property
+    def input(self) -> dict:
+        """The decoded input record.
+
+        Shared with the Task. Do not modify.
+        """
+        return self._input
+
     def done(self) -> bool:
         return self._done.is_set()
 
+    async def wait(self):
+        """Suspend the calling coroutine until the Task is done."""
+        await self._done.wait()
+
+    def dependencies(self) -> tuple:
+        """Get the uids of the workflow items that must complete before this Task."""
+        return self._dependencies
+
+    def add_done_callback(self, fn: typing.Callable[['Task'], typing.Any]):
+        """Call *fn* with the Task when the Task is done.
+
+        Unlike asyncio.Future, callbacks are called directly by `set_result()`
+        or `set_exception()` (or immediately, if the Task is already done),
+        rather than being scheduled with the event loop.
+        """
+        if self.done():
+            self._call(fn)
+            return
+        if self._callbacks is None:
+            self._callbacks = list()
+        self._callbacks.append(fn)
+
+    def _call(self, fn):
+        try:
+            fn(self)
+        except Exception as e:
+            logger.exception('Exception in done callback for {}: {}'.format(self.uid().hex(), str(e)))
+
+    def _finalize(self):
+        self._done.set()
+        callbacks = self._callbacks
+        self._callbacks = None
+        if callbacks is not None:
+            for fn in callbacks:
+                self._call(fn)
+
+    def serialize(self) -> typing.Union[str, bytes]:
+        """Get the encoded record from which the Task was created.
+
+        The record is encoded with the codec of the Task (JSON text by default).
+        """
+        return self._encoded
+
+    def _decode(self) -> dict:
+        if self._codec is None:
+            return json.loads(self._encoded)
+        return self._codec.decode(self._encoded)
+
+    def stream(self, name: str = 'stdout') -> OutputStream:
+        """Get the named output stream for the Task.
+
+        Whether and when lines are delivered to the stream depends on the
+        executor. Subscribe to the stream before the Task is launched to receive
+        all of its output. Streams are created on demand, so executors only
+        capture output for Tasks with subscribers (see `subscribed_streams()`).
+        The stream of a Task that is already done is closed.
+
+        Example::
+
+            async for line in task_view.stream('stdout'):
+                if 'converged' in line:
+                    ...
+        """
+        if self._streams is None:
+            self._streams = dict()
+        if name not in self._streams:
+            stream = OutputStream()
+            if self.done():
+                stream.close()
+            self._streams[name] = stream
+        return self._streams[name]
+
+    def subscribed_streams(self) -> typing.Mapping[str, OutputStream]:
+        """Get the output streams that have been requested with `stream()`."""
+        if self._streams is None:
+            return {}
+        return self._streams
+
     def __getattr__(self, item):
+        # Fall back to the encoded record for members without a dedicated accessor.
+        # Note: Missing instance attributes (slots) also end up here, so be careful
+        # not to recurse.
         # TODO: Manage internal state updates.
         # TODO: Respect different attribute type semantics.
+        if item.startswith('_'):
+            raise AttributeError(item)
         try:
-            decoded_record = json.loads(self._encoded)
-            logger.debug('Decoded {}: {}'.format(type(decoded_record).__name__, str(decoded_record)))
+            decoded_record = self._decode()
             value = decoded_record[item]
-        except json.JSONDecodeError as e:
+        except (json.JSONDecodeError, ProtocolError) as e:
             raise AttributeError('Problem retrieving "{}"'.format(item)) from e
         except KeyError as e:
             logger.debug('Did not find "{}" in {}'.format(item, self._encoded))
             raise AttributeError('Problem retrieving "{}"'.format(item)) from e
         return value
 
-    def __init__(self, context, record):
-        self._encoded = str(record)
-        decoded_record = json.loads(self._encoded)
+    # Tasks are numerous, and are accessed frequently while dispatching.
+    # Decode the record once, at creation, and store its members in slots.
+    __slots__ = ('_encoded', '_codec', '_uid', '_description', '_input', '_dependencies',
+                 '_done', '_result', '_exception', '_context', '_streams', '_callbacks')
+
+    def __init__(self, context, record, codec=None):
+        # *codec* is a scalems.serialization.Codec. The default is JSON.
+        if codec is not None and codec.binary:
+            self._encoded = bytes(record)
+        else:
+            self._encoded = str(record)
+        self._codec = codec
+        decoded_record = self._decode()
 
         self._uid = bytes.fromhex(decoded_record['uid'])
         if not len(self._uid) == 256//8:
             raise ProtocolError('UID is supposed to be a 256-bit hash digest. Got {}'.format(repr(self._uid)))
+        resource_type = ResourceType(tuple(decoded_record['type']))
+        shape = tuple(decoded_record.get('shape', (1,)))
+        self._description = Description(resource_type=resource_type, shape=shape)
+        self._input = decoded_record.get('input', {})
+        self._dependencies = tuple(bytes.fromhex(uid) for uid in decoded_record.get('depends', ()))
         self._done = asyncio.Event()
         self._result = None
+        self._exception = None
+        # Output streams and done callbacks are created on demand.
+        self._streams = None
+        self._callbacks = None
 
         # As long as we are storing Tasks in the context, we cannot store contexts in Tasks.
         self._context = weakref.ref(context)
@@ -291,15 +463,21 @@ class Task:
         if self._done.is_set():
             raise ProtocolError('Result is already set for {}.'.format(repr(self)))
         self._result = result
-        self._done.set()
+        self._finalize()
         logger.debug('Result set for {} in {}'.format(self.uid().hex(), str(self._context())))
 
+    def set_exception(self, exception: BaseException):
+        # Not thread-safe.
+        if self._done.is_set():
+            raise ProtocolError('Result is already set for {}.'.format(repr(self)))
+        self._exception = exception
+        self._finalize()
+        logger.debug('Exception set for {} in {}'.format(self.uid().hex(), str(self._context())))
+
     # @classmethod
     # def deserialize(cls, context, record: str):
     #     item_view = context.add_item(record)
     #     return item_view
-    # def serialize(self):
-    #     ...
 
 
 # TODO: Incorporate into WorkflowContext interface.
@@ -453,6 +631,17 @@ class WorkflowManager(abc.ABC):
         """
         ...
 
+    def add_items(self, task_descriptions) -> list:
+        """Add several tasks to the workflow.
+
+        WorkflowManager implementations may override this method to reduce the
+        per-task overhead of adding large numbers of tasks.
+
+        Returns:
+            References to the new tasks, in the order of *task_descriptions*.
+        """
+        return [self.add_item(task_description) for task_description in task_descriptions]
+
 
 class DefaultContext(WorkflowManager):
     """Manage workflow data and metadata, but defer execution to sub-contexts.
@@ -0,0 +1,436 @@
+"""Control flow for workflows: subgraphs and loops.
+
+Implements :py:func:`scalems.subgraph`, :py:func:`scalems.while_loop`, and
+:py:func:`scalems.logical_not`.
+
+Operations configured within the ``with`` block of a `Subgraph` are recorded
+as a template, rather than being added to a workflow. The template describes
+one iteration. Variables of the subgraph are placeholders for the values at the
+start of the iteration, and assignments to the variables define their values
+at the end of the iteration.
+
+A `while_loop` is a single workflow item. When executed, it instantiates the
+template in the workflow one iteration at a time (see `Subgraph.instantiate()`),
+while the condition holds. Only :py:func:`scalems.function_wrapper` operations
+can currently be used in subgraphs.
+"""
+import dataclasses
+import logging
+import typing
+import weakref
+
+from .exceptions import DuplicateKeyError, MissingImplementationError, ProtocolError, ScopeError
+from .serialization import fingerprint
+from . import context as _context
+from . import function as _function
+
+logger = logging.getLogger(__name__)
+logger.debug('Importing {}'.format(__name__))
+
+
+class VariableReference:
+    """Reference the value of a subgraph variable at the start of an iteration.
+
+    Outside of the subgraph definition, refers to the current value of the variable.
+    """
+    def __init__(self, subgraph: 'Subgraph', name: str, negate: bool = False):
+        self.subgraph = subgraph
+        self.name = name
+        self.negate = negate
+
+    def __repr__(self):
+        return '<{} {}{}>'.format(type(self).__name__, 'not ' if self.negate else '', self.name)
+
+
+class _TemplateRecorder(_context.WorkflowManager):
+    """Record the operations configured while defining a subgraph."""
+    def __init__(self):
+        # Recorded items (with normalized input), in the order in which they were added.
+        self.items: typing.List[typing.Tuple[bytes, _function.FunctionInput]] = list()
+
+    def add_item(self, task_description) -> _context.ItemView:
+        if not isinstance(task_description, _function.Function):
+            raise MissingImplementationError('Only wrapped functions are supported in subgraphs.')
+        # Items in the template do not have a meaningful fingerprint yet, so
+        # we assign placeholder uids, determined by the position and input of the
+        # item (including the placeholders of earlier items that it references).
+        task_input = task_description.input_collection()
+        uid = fingerprint({'item': len(self.items), 'input': _template_identity(task_input)})
+        self.items.append((uid, task_input))
+        return _context.ItemView(context=self, uid=uid)
+
+    def item(self, identifier):
+        raise ScopeError('Subgraph items cannot be accessed until the subgraph is instantiated.')
+
+
+def _identity(value):
+    """Get a JSON-compatible representation of a (normalized) template value."""
+    if isinstance(value, VariableReference):
+        if value.negate:
+            return {'variable': value.name, 'negate': True}
+        return {'variable': value.name}
+    if isinstance(value, (list, tuple)):
+        return [_identity(element) for element in value]
+    if isinstance(value, dict):
+        return {key: _identity(element) for key, element in value.items()}
+    return value
+
+
+def _template_identity(task_input: _function.FunctionInput) -> list:
+    """Get a JSON-compatible representation of the input of a template item."""
+    # Note: dataclasses.asdict() would copy the subgraph through the variable references.
+    return [task_input.function, _identity(task_input.args), _identity(task_input.kwargs),
+            list(task_input.outputs), task_input.execution]
+
+
+def _reference(context, record: dict):
+    """Get a reference object for a normalized reference *record*."""
+    view = _context.ItemView(context=context, uid=bytes.fromhex(record['reference']))
+    if 'output' in record:
+        return _function.OutputReference(view, record['output'])
+    return view
+
+
+def _is_reference_record(value) -> bool:
+    return isinstance(value, dict) and 'reference' in value and set(value.keys()) <= {'reference', 'output'}
+
+
+# Subgraphs that may be instantiated by executing workflow items, by key.
+# Equivalent definitions share a key, and the first (live) definition is registered.
+# Entries are kept while the subgraph is referenced by its definitions
+# or by workflows containing loops over it (see `_in_use`).
+_subgraphs: typing.MutableMapping[str, 'Subgraph'] = weakref.WeakValueDictionary()
+
+# The subgraphs of the loops added to each workflow manager.
+_in_use: typing.MutableMapping[typing.Any, typing.Set['Subgraph']] = weakref.WeakKeyDictionary()
+
+
+def lookup(key: str) -> 'Subgraph':
+    """Get the subgraph identified by *key*."""
+    try:
+        return _subgraphs[key]
+    except KeyError:
+        raise ProtocolError('Unknown subgraph {}.'.format(key))
+
+
+class Subgraph:
+    """A template for a group of operations with persistent variables.
+
+    See :py:func:`scalems.subgraph`.
+    """
+    def __init__(self, variables: typing.Mapping[str, typing.Any] = None):
+        if variables is None:
+            variables = {}
+        dependencies = list()
+        self.__dict__.update({
+            '_variables': {name: _function._normalize(value, dependencies) for name, value in variables.items()},
+            '_dependencies': dependencies,
+            '_recorder': None,
+            '_scope': None,
+            '_assignments': dict(),
+            '_items': None,
+            '_key': None,
+            '_registered': None
+        })
+
+    def __enter__(self):
+        if self._items is not None or self._recorder is not None:
+            raise ProtocolError('A subgraph can only be defined once.')
+        self.__dict__['_recorder'] = _TemplateRecorder()
+        scope = _context.scope(self._recorder)
+        scope.__enter__()
+        self.__dict__['_scope'] = scope
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        scope = self._scope
+        self.__dict__['_scope'] = None
+        scope.__exit__(exc_type, exc_val, exc_tb)
+        if exc_type is None:
+            self.__dict__['_items'] = tuple(self._recorder.items)
+            self.__dict__['_assignments'] = _function._normalize(self._assignments, [])
+            identity = {
+                'items': [[uid.hex()] + _template_identity(task_input) for uid, task_input in self._items],
+                'assignments': _identity(self._assignments)
+            }
+            key = fingerprint(identity).hex()
+            self.__dict__['_key'] = key
+            registered = _subgraphs.setdefault(key, self)
+            if registered is not self:
+                # Keep the registered equivalent definition alive with this one.
+                self.__dict__['_registered'] = registered
+        else:
+            self.__dict__['_recorder'] = None
+        return False
+
+    def __getattr__(self, name):
+        if name.startswith('_') or (name not in self._variables and name not in self._assignments):
+            raise AttributeError(name)
+        if self._scope is not None and name in self._assignments:
+            # Use the updated value for the rest of the definition.
+            return self._assignments[name]
+        return VariableReference(self, name)
+
+    def __setattr__(self, name, value):
+        if self._scope is None:
+            raise ScopeError('Subgraph variables can only be assigned while defining the subgraph.')
+        if name.startswith('_') or name in type(self).__dict__:
+            raise AttributeError('{} cannot be used as a subgraph variable.'.format(name))
+        # Note: Names that were not declared with an initial value do not have
+        # a value until the subgraph has run.
+        self._assignments[name] = value
+
+    @property
+    def key(self) -> str:
+        """Identify the subgraph definition."""
+        if self._key is None:
+            raise ProtocolError('Subgraph is not yet defined.')
+        return self._key
+
+    @property
+    def variables(self) -> typing.Tuple[str, ...]:
+        """Names of the declared variables, followed by any other assigned names."""
+        return tuple(self._variables.keys()) + tuple(name for name in self._assignments if name not in self._variables)
+
+    def initial_values(self, context) -> dict:
+        """Get the initial variable bindings, with references in the scope of *context*."""
+        return self.bind(context, self._variables)
+
+    def bind(self, context, variables: typing.Mapping[str, typing.Any]) -> dict:
+        """Get variable bindings for normalized *variables*, with references in the scope of *context*."""
+        return {name: self._substitute(context, value, {}, {}) for name, value in variables.items()}
+
+    def _substitute(self, context, value, bindings: dict, views: dict):
+        """Replace placeholders in a template *value* for an instance of the subgraph."""
+        if isinstance(value, VariableReference):
+            return bindings[value.name]
+        if isinstance(value, (_context.ItemView, _function.OutputReference)):
+            value = _function._normalize(value, [])
+        if _is_reference_record(value):
+            if value['reference'] in views:
+                view = views[value['reference']]
+                if 'output' in value:
+                    return getattr(view.output, value['output'])
+                return view
+            return _reference(context, value)
+        if isinstance(value, (list, tuple)):
+            return [self._substitute(context, element, bindings, views) for element in value]
+        if isinstance(value, dict):
+            return {key: self._substitute(context, element, bindings, views) for key, element in value.items()}
+        return value
+
+    def instantiate(self, context, bindings: typing.Mapping[str, typing.Any]) \
+            -> typing.Tuple[dict, typing.List[bytes], typing.List[bytes]]:
+        """Add the operations for one iteration to the workflow managed by *context*.
+
+        Arguments:
+            context: the workflow manager.
+            bindings: variable values (or references) at the start of the iteration.
+
+        Equivalent operations refer to the same workflow item, so an iteration
+        may use items that were already present in the workflow.
+
+        Returns:
+            The variable bindings at the end of the iteration, the uids of the
+            items used by the iteration, and the uids of the items that were added.
+        """
+        if self._items is None:
+            raise ProtocolError('Subgraph is not yet defined.')
+        views = dict()
+        uids = list()
+        added = list()
+        for uid, task_input in self._items:
+            item = _function.Function(_function.FunctionInput(
+                function=task_input.function,
+                args=self._substitute(context, task_input.args, bindings, views),
+                kwargs=self._substitute(context, task_input.kwargs, bindings, views),
+                outputs=task_input.outputs,
+                execution=task_input.execution))
+            try:
+                context.item(item.uid())
+            except KeyError:
+                added.append(item.uid())
+            view = _context.workflow_item_director_factory(item, context=context)()
+            views[uid.hex()] = view
+            uids.append(view.uid())
+        updated = dict(bindings)
+        for name, value in self._assignments.items():
+            updated[name] = self._substitute(context, value, bindings, views)
+        return updated, uids, added
+
+    def __call__(self, **kwargs) -> 'SubgraphInstance':
+        """Get an instance of the subgraph, with optional initial values for the variables."""
+        return SubgraphInstance(self, **kwargs)
+
+
+class SubgraphInstance:
+    """A single iteration of a subgraph, evaluated directly in the calling thread."""
+    def __init__(self, subgraph: Subgraph, **kwargs):
+        self._subgraph = subgraph
+        for name in kwargs:
+            if name not in subgraph.variables:
+                raise TypeError('{} is not a variable of the subgraph.'.format(name))
+        values = dict()
+        for name in subgraph._variables:
+            if name in kwargs:
+                values[name] = kwargs[name]
+            else:
+                values[name] = subgraph._variables[name]
+            if _is_reference_record(values[name]) or isinstance(values[name], _context.ItemView):
+                raise MissingImplementationError('Subgraph instances require concrete initial values.')
+        self.values = values
+
+    def run(self):
+        """Evaluate the operations of the subgraph, updating `values`."""
+        subgraph = self._subgraph
+        results = dict()
+
+        def resolve(value):
+            if isinstance(value, VariableReference):
+                return self.values[value.name]
+            if isinstance(value, (_context.ItemView, _function.OutputReference)):
+                value = _function._normalize(value, [])
+            if _is_reference_record(value):
+                try:
+                    result = results[value['reference']]
+                except KeyError:
+                    raise MissingImplementationError('Subgraph instances cannot use external references.')
+                if 'output' in value:
+                    return result[value['output']]
+                return result
+            if isinstance(value, (list, tuple)):
+                return [resolve(element) for element in value]
+            if isinstance(value, dict):
+                return {key: resolve(element) for key, element in value.items()}
+            return value
+
+        if subgraph._items is None:
+            raise ProtocolError('Subgraph is not yet defined.')
+        for uid, task_input in subgraph._items:
+            results[uid.hex()] = _function.call(task_input.function,
+                                                resolve(task_input.args),
+                                                resolve(task_input.kwargs),
+                                                task_input.outputs)
+        self.values = {name: resolve(subgraph._assignments.get(name, VariableReference(subgraph, name)))
+                       for name in subgraph.variables}
+
+
+@dataclasses.dataclass
+class WhileLoopInput:
+    """Input for a WhileLoopTask.
+
+    *variables* holds the (normalized) initial values of the subgraph variables.
+    """
+    subgraph: str
+    condition: str
+    negate: bool = False
+    variables: typing.Mapping[str, typing.Any] = dataclasses.field(default_factory=dict)
+    max_iteration: int = 10
+
+
+class WhileLoopTask:
+    """Describe the type of resource provided by a WhileLoop command."""
+    @classmethod
+    def scoped_identifier(cls):
+        return ('scalems', 'control', 'WhileLoopTask')
+
+    @classmethod
+    def identifier(cls):
+        return '.'.join(cls.scoped_identifier())
+
+    @classmethod
+    def input_type(cls) -> type:
+        return WhileLoopInput
+
+
+class WhileLoop:
+    """A loop over instances of a subgraph, as a workflow item."""
+    @classmethod
+    def resource_type(cls):
+        return WhileLoopTask()
+
+    def __init__(self, input: WhileLoopInput):
+        dependencies = list()
+        self._bound_input = dataclasses.replace(input,
+                                                variables=_function._normalize(dict(input.variables), dependencies))
+        self._dependencies = tuple(dependencies)
+        self._uid = None
+
+    def input_collection(self):
+        return self._bound_input
+
+    def dependencies(self) -> typing.Tuple[bytes, ...]:
+        return self._dependencies
+
+    def uid(self) -> bytes:
+        if self._uid is None:
+            self._uid = fingerprint({
+                'type': self.resource_type().scoped_identifier(),
+                'input': dataclasses.asdict(self._bound_input)
+            })
+        return self._uid
+
+
+# Register a director for WhileLoop workflow items.
+@_context.workflow_item_director_factory.register
+def _(item: WhileLoop, *, context: _context.WorkflowManager, label: str = None):
+    def director():
+        try:
+            task_view = context.add_item(item)
+        except DuplicateKeyError:
+            task_view = _context.ItemView(context=context, uid=item.uid())
+        subgraph = lookup(item.input_collection().subgraph)
+        # Keep the subgraph available for as long as the workflow exists.
+        _in_use.setdefault(context, set()).add(subgraph)
+        outputs = subgraph.variables
+        return _function.OperationView(context, task_view.uid(), outputs=outputs)
+    return director
+
+
+def while_loop(*, function: Subgraph, condition: VariableReference, max_iteration=10, **kwargs):
+    """Implements :py:func:`scalems.while_loop`.
+
+    *function* is a `Subgraph` and *condition* is a (possibly negated) reference
+    to one of its variables. The subgraph is iterated while the condition is
+    true, or until *max_iteration* iterations have been executed. If the
+    condition refers to a variable without an initial value, the first
+    iteration is always executed. Key word arguments override the initial values
+    of the subgraph variables.
+
+    Returns:
+        A callable that adds the loop to the current workflow and returns a view
+        with an output for each subgraph variable.
+    """
+    if not isinstance(function, Subgraph):
+        raise MissingImplementationError('while_loop currently requires a scalems.subgraph.')
+    if not isinstance(condition, VariableReference) or condition.subgraph is not function:
+        raise MissingImplementationError('*condition* must refer to a variable of the subgraph.')
+    subgraph = function
+    for name in kwargs:
+        if name not in subgraph.variables:
+            raise TypeError('{} is not a variable of the subgraph.'.format(name))
+
+    def loop(context=None):
+        if context is None:
+            context = _context.get_context()
+        variables = subgraph.initial_values(context)
+        variables.update(kwargs)
+        item = WhileLoop(WhileLoopInput(subgraph=subgraph.key,
+                                        condition=condition.name,
+                                        negate=condition.negate,
+                                        variables=variables,
+                                        max_iteration=max_iteration))
+        return _context.workflow_item_director_factory(item, context=context)()
+    return loop
+
+
+def logical_not(value):
+    """Implements :py:func:`scalems.logical_not`."""
+    if isinstance(value, VariableReference):
+        return VariableReference(value.subgraph, value.name, negate=not value.negate)
+    if isinstance(value, (_context.ItemView, _function.OutputReference)):
+        item = _function.Function(_function.FunctionInput(function='operator:not_',
+                                                          args=(value,),
+                                                          execution='inline'))
+        return _context.workflow_item_director_factory(item, context=_context.get_context())()
+    return not value
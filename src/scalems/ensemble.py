@@ -0,0 +1,174 @@
+"""Ensemble data containers.
+
+Implements :py:func:`scalems.gather` and :py:func:`scalems.scatter`.
+
+Ensemble data is stored contiguously, with one row per ensemble member, so that
+gathering per-member data produces a single (N, M) array and scattering the
+array produces views of its rows without copying.
+
+NumPy is used for storage, if available. Otherwise, storage is provided by the
+built-in :py:mod:`array` module, and rows are provided as :py:class:`memoryview` slices.
+"""
+import array
+import logging
+import typing
+
+from .exceptions import MissingImplementationError
+from . import context as _context
+from . import function as _function
+
+logger = logging.getLogger(__name__)
+logger.debug('Importing {}'.format(__name__))
+
+
+def _numpy():
+    """Get the numpy module, if available."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _is_reference(value) -> bool:
+    return isinstance(value, (_context.ItemView, _function.OutputReference))
+
+
+class EnsembleData:
+    """Contiguous storage for an ensemble of equal-length vectors.
+
+    Element *i* is a view of row *i* of the (N, M) storage, not a copy.
+
+    Arguments:
+        storage: A C-contiguous buffer of N*M elements (such as a numpy.ndarray or array.array).
+        shape: The ensemble shape (N, M).
+    """
+    def __init__(self, storage, shape: typing.Tuple[int, int]):
+        num_members, width = (int(extent) for extent in shape)
+        view = memoryview(storage)
+        if not view.c_contiguous:
+            raise ValueError('Ensemble storage must be contiguous.')
+        flat = view.cast('B').cast(view.format)
+        if len(flat) != num_members * width:
+            raise ValueError('Storage of {} elements does not have shape {}.'.format(len(flat), repr(shape)))
+        self._storage = storage
+        self._flat = flat
+        self._shape = (num_members, width)
+        numpy = _numpy()
+        self._rows = None
+        if numpy is not None and isinstance(storage, numpy.ndarray):
+            self._rows = storage.reshape(self._shape)
+
+    @classmethod
+    def from_members(cls, members: typing.Iterable, typecode: str = 'd') -> 'EnsembleData':
+        """Copy the vectors in *members* into new contiguous storage.
+
+        *typecode* is an :py:mod:`array` type code (default ``'d'`` for double precision).
+        """
+        members = list(members)
+        num_members = len(members)
+        width = len(members[0]) if num_members > 0 else 0
+        for member in members:
+            if len(member) != width:
+                raise ValueError('Ensemble members must have the same length.')
+        numpy = _numpy()
+        if numpy is not None:
+            storage = numpy.empty((num_members, width), dtype=numpy.dtype(typecode))
+            for i, member in enumerate(members):
+                storage[i] = member
+            return cls(storage, (num_members, width))
+        storage = array.array(typecode, bytes(num_members * width * array.array(typecode).itemsize))
+        flat = memoryview(storage)
+        for i, member in enumerate(members):
+            try:
+                row = memoryview(member)
+            except TypeError:
+                row = None
+            if row is None or row.format != typecode or not row.c_contiguous:
+                row = memoryview(array.array(typecode, member))
+            else:
+                row = row.cast('B').cast(typecode)
+            flat[i * width:(i + 1) * width] = row
+        return cls(storage, (num_members, width))
+
+    @property
+    def shape(self) -> typing.Tuple[int, int]:
+        return self._shape
+
+    @property
+    def storage(self):
+        """The underlying (contiguous) storage object."""
+        return self._storage
+
+    def __len__(self):
+        return self._shape[0]
+
+    def __getitem__(self, item: int):
+        """Get a view of the data for ensemble member *item*."""
+        num_members, width = self._shape
+        if not isinstance(item, int):
+            raise TypeError('Ensemble members are indexed by integer.')
+        if item < 0:
+            item += num_members
+        if not 0 <= item < num_members:
+            raise IndexError('Ensemble member {} out of range.'.format(item))
+        if self._rows is not None:
+            return self._rows[item]
+        return self._flat[item * width:(item + 1) * width]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def tolist(self) -> list:
+        """Copy the data to nested lists."""
+        return [list(row) for row in self]
+
+
+def gather(iterable, *, typecode: str = 'd', context=None):
+    """Implements :py:func:`scalems.gather`.
+
+    Copy per-member vectors into an `EnsembleData` container.
+
+    If any element of *iterable* is a workflow reference, the gather operation is
+    added to the workflow (in the *context* scope), and a reference to the
+    gathered data is returned.
+    """
+    members = list(iterable)
+    if any(_is_reference(member) for member in members):
+        if context is None:
+            context = _context.get_context()
+        item = _function.Function(_function.FunctionInput(
+            function=_function.function_name(gather),
+            args=(members,),
+            kwargs={'typecode': typecode},
+            execution='inline'))
+        return _context.workflow_item_director_factory(item, context=context)()
+    return EnsembleData.from_members(members, typecode=typecode)
+
+
+def scatter(ensemble, axis: int = 1, *, context=None):
+    """Implements :py:func:`scalems.scatter`.
+
+    Get views of the members of *ensemble* (an `EnsembleData` or a two-dimensional
+    numpy array). No data is copied.
+
+    If *ensemble* is a workflow reference, the scatter operation is added to the
+    workflow (in the *context* scope), and a reference to the list of members is
+    returned.
+    """
+    if axis != 1:
+        raise MissingImplementationError('Only the outer dimension can be scattered.')
+    if _is_reference(ensemble):
+        if context is None:
+            context = _context.get_context()
+        item = _function.Function(_function.FunctionInput(
+            function=_function.function_name(scatter),
+            args=(ensemble,),
+            execution='inline'))
+        return _context.workflow_item_director_factory(item, context=context)()
+    if isinstance(ensemble, EnsembleData):
+        return list(ensemble)
+    numpy = _numpy()
+    if numpy is not None and isinstance(ensemble, numpy.ndarray) and ensemble.ndim == 2:
+        return list(ensemble)
+    raise TypeError('Cannot scatter {}.'.format(repr(ensemble)))
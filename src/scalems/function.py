@@ -0,0 +1,338 @@
+"""Define the ScaleMS Function command.
+
+scalems.function_wrapper() converts a Python function into a workflow operation.
+Calling the wrapped function adds a task to the current workflow and returns a
+view of the task, through which named outputs can be referenced or retrieved.
+
+The task is represented by ``scalems.function.FunctionTask``, with input
+described by ``scalems.function.FunctionInput``.
+
+Wrapped functions are identified by import path. The function must be importable
+(defined at module level) so that it can be resolved in the process that executes
+the task. Arguments must be serializable (as for the workflow record), and may
+include references to the results of other workflow items.
+"""
+import dataclasses
+import functools
+import importlib
+import inspect
+import json
+import logging
+import typing
+
+from .exceptions import DuplicateKeyError, InternalError, ProtocolError
+from .serialization import fingerprint
+from . import context as _context
+
+logger = logging.getLogger(__name__)
+logger.debug('Importing {}'.format(__name__))
+
+
+@dataclasses.dataclass
+class FunctionInput:
+    """Input for a FunctionTask.
+
+    *args* and *kwargs* are normalized such that references to workflow items
+    are represented as ``{'reference': uid_hex}`` or, for named outputs,
+    ``{'reference': uid_hex, 'output': name}``.
+
+    *execution* is a hint to the execution environment (see `function_wrapper()`).
+    """
+    function: str
+    args: typing.Sequence[typing.Any] = ()
+    kwargs: typing.Mapping[str, typing.Any] = dataclasses.field(default_factory=dict)
+    outputs: typing.Sequence[str] = ()
+    execution: str = 'process'
+
+
+# Execution hints for wrapped functions.
+execution_classes = ('inline', 'thread', 'process')
+
+
+class FunctionTask:
+    """Describe the type of resource provided by a Function command."""
+    @classmethod
+    def scoped_identifier(cls):
+        return ('scalems', 'function', 'FunctionTask')
+
+    @classmethod
+    def identifier(cls):
+        return '.'.join(cls.scoped_identifier())
+
+    @classmethod
+    def input_type(cls) -> type:
+        return FunctionInput
+
+
+def function_name(function: typing.Callable) -> str:
+    """Get the import path by which *function* can be located in another process."""
+    module = getattr(function, '__module__', None)
+    qualname = getattr(function, '__qualname__', None)
+    if module is None or qualname is None or '<locals>' in qualname or '<lambda>' in qualname:
+        raise ValueError('{} is not importable. Wrapped functions must be defined at module level.'.format(
+            repr(function)))
+    return '{}:{}'.format(module, qualname)
+
+
+def _normalize(value, dependencies: list):
+    """Replace workflow references in *value* with reference records.
+
+    The uids of referenced items are appended to *dependencies*.
+    """
+    if isinstance(value, OutputReference):
+        uid = value.uid()
+        if uid not in dependencies:
+            dependencies.append(uid)
+        return {'reference': uid.hex(), 'output': value.name}
+    if isinstance(value, _context.ItemView):
+        uid = value.uid()
+        if uid not in dependencies:
+            dependencies.append(uid)
+        return {'reference': uid.hex()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(element, dependencies) for element in value]
+    if isinstance(value, dict):
+        return {key: _normalize(element, dependencies) for key, element in value.items()}
+    return value
+
+
+class Function:
+    """A call to a wrapped function, as a workflow item."""
+    @classmethod
+    def resource_type(cls):
+        return FunctionTask()
+
+    def __init__(self, input: FunctionInput):
+        dependencies = []
+        self._bound_input = FunctionInput(
+            function=input.function,
+            args=_normalize(list(input.args), dependencies),
+            kwargs=_normalize(dict(input.kwargs), dependencies),
+            outputs=list(input.outputs),
+            execution=input.execution
+        )
+        self._dependencies = tuple(dependencies)
+        self._uid = None
+
+    def input_collection(self):
+        return self._bound_input
+
+    def dependencies(self) -> typing.Tuple[bytes, ...]:
+        """Get the uids of workflow items that provide arguments to this call."""
+        return self._dependencies
+
+    def uid(self) -> bytes:
+        """Get the 256-bit fingerprint of the task.
+
+        The fingerprint is determined by the function and its (normalized)
+        arguments, so equivalent calls refer to the same workflow item.
+        The execution hint does not contribute.
+        """
+        if self._uid is None:
+            bound_input = self._bound_input
+            identity = {
+                'type': self.resource_type().scoped_identifier(),
+                'function': bound_input.function,
+                'args': bound_input.args,
+                'kwargs': bound_input.kwargs,
+                'outputs': bound_input.outputs
+            }
+            value = fingerprint(identity)
+            if not len(value) == 256//8:
+                raise ProtocolError('UID is supposed to be a 256-bit hash digest.')
+            self._uid = value
+        return self._uid
+
+
+class OutputReference:
+    """Reference a named output of a workflow item.
+
+    Can be used as an argument to other operations, or resolved locally
+    with `result()` after the item has executed.
+    """
+    def __init__(self, item: _context.ItemView, name: str):
+        self._item = item
+        self.name = name
+
+    def uid(self) -> bytes:
+        return self._item.uid()
+
+    def done(self) -> bool:
+        return self._item.done()
+
+    def add_done_callback(self, fn):
+        """Call *fn* with the reference when the referenced item is done."""
+        self._item.add_done_callback(lambda _: fn(self))
+
+    def result(self):
+        result = self._item.result()
+        if isinstance(result, typing.Mapping):
+            return result[self.name]
+        return getattr(result, self.name)
+
+    def __repr__(self):
+        return '<{} {}.{}>'.format(type(self).__name__, self.uid().hex(), self.name)
+
+
+class OutputCollection:
+    """Provide the named outputs of a workflow item as attributes."""
+    def __init__(self, item: _context.ItemView, names: typing.Iterable[str]):
+        self._item = item
+        self._names = tuple(names)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._names:
+            raise AttributeError('No output named {}.'.format(name))
+        return OutputReference(self._item, name)
+
+    def __dir__(self):
+        return list(self._names)
+
+
+class OperationView(_context.ItemView):
+    """View of a Function workflow item, with access to named outputs.
+
+    Named outputs are available both through the ``output`` attribute and as
+    attributes of the view itself.
+    """
+    def __init__(self, context, uid: bytes, outputs: typing.Iterable[str] = ()):
+        super().__init__(context=context, uid=uid)
+        self._outputs = tuple(outputs)
+        self.output = OutputCollection(self, self._outputs)
+
+    def __getattr__(self, item):
+        if not item.startswith('_') and item in self.__dict__.get('_outputs', ()):
+            return OutputReference(self, item)
+        return super().__getattr__(item)
+
+
+class _OutputPublisher:
+    """Receive the named outputs of a wrapped function."""
+    def __init__(self, names: typing.Iterable[str]):
+        object.__setattr__(self, '_values', dict.fromkeys(names))
+
+    def __setattr__(self, name, value):
+        if name not in self._values:
+            raise AttributeError('No output named {}.'.format(name))
+        self._values[name] = value
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError('No output named {}.'.format(name))
+
+
+def import_function(name: str) -> typing.Callable:
+    """Locate the function identified by *name* (``module:qualname``).
+
+    Returns the undecorated function, if the object found is a wrapper
+    produced by :py:func:`scalems.function_wrapper`.
+    """
+    module_name, _, qualname = name.partition(':')
+    obj = importlib.import_module(module_name)
+    for attribute in qualname.split('.'):
+        obj = getattr(obj, attribute)
+    return inspect.unwrap(obj)
+
+
+def call(name: str,
+         args: typing.Sequence,
+         kwargs: typing.Mapping[str, typing.Any],
+         outputs: typing.Sequence[str]):
+    """Call the function identified by *name* for a Function task.
+
+    Execution environments call this function in the thread or process that
+    executes the task, so the arguments and result may need to be picklable.
+
+    Returns:
+        A dictionary of the named *outputs*, if any, or else the return value
+        of the function.
+    """
+    function = import_function(name)
+    if len(outputs) == 0:
+        return function(*args, **kwargs)
+    if 'output' in inspect.signature(function).parameters:
+        publisher = _OutputPublisher(outputs)
+        function(*args, output=publisher, **kwargs)
+        return dict(publisher._values)
+    if len(outputs) > 1:
+        raise ProtocolError('{} must accept an `output` argument to publish several outputs.'.format(name))
+    return {outputs[0]: function(*args, **kwargs)}
+
+
+def call_each(name: str,
+              arguments: typing.Iterable,
+              outputs: typing.Sequence[str]) -> list:
+    """Implement `call()` for a sequence of single (positional) *arguments*.
+
+    Allows several calls to be made by a single task.
+    """
+    return [call(name, (argument,), {}, outputs) for argument in arguments]
+
+
+# Register a director for Function workflow items.
+@_context.workflow_item_director_factory.register
+def _(item: Function, *, context: _context.WorkflowManager, label: str = None):
+    def director(*args, **kwargs):
+        if len(args) > 0:
+            raise TypeError('Unexpected positional arguments.')
+        if len(kwargs) > 0:
+            raise TypeError('Unexpected key word arguments: {}'.format(', '.join(kwargs.keys())))
+        try:
+            task_view = context.add_item(item)
+        except DuplicateKeyError:
+            # Calls with identical arguments refer to the same workflow item.
+            task_view = _context.ItemView(context=context, uid=item.uid())
+        return OperationView(context, task_view.uid(), outputs=item.input_collection().outputs)
+    return director
+
+
+def function_wrapper(output: dict = None, *, execution: str = 'process'):
+    """Generate a decorator for wrapped functions with signature manipulation.
+
+    Implements :py:func:`scalems.function_wrapper`.
+
+    If the wrapped function accepts an ``output`` argument, the function is
+    called with an object on which to set the named outputs. Otherwise, the return
+    value of the function provides the (single) named output.
+
+    *execution* tells the execution environment how to call the function.
+
+    * ``inline``: call the function directly in the dispatching thread. Suitable
+      for cheap functions, which do not warrant the cost of transferring data to
+      and from a worker.
+    * ``thread``: call the function in a thread pool. Suitable for functions that
+      release the GIL, such as NumPy operations or I/O.
+    * ``process`` (default): call the function in a process pool. Suitable for
+      pure-Python, CPU-bound functions. Arguments and results are pickled.
+    """
+    if execution not in execution_classes:
+        raise ValueError('*execution* must be one of {}.'.format(', '.join(execution_classes)))
+    if output is None:
+        output = {}
+    output_names = tuple(output.keys())
+
+    def decorator(function: typing.Callable):
+        name = function_name(function)
+        if len(output_names) > 1 and 'output' not in inspect.signature(function).parameters:
+            raise ValueError('Functions with several named outputs must accept an `output` argument.')
+
+        @functools.wraps(function)
+        def operation(*args, context=None, **kwargs):
+            if context is None:
+                context = _context.get_context()
+            item = Function(FunctionInput(function=name, args=args, kwargs=kwargs, outputs=output_names,
+                                          execution=execution))
+            director = _context.workflow_item_director_factory(item, context=context)
+            try:
+                return director()
+            except json.JSONDecodeError as e:
+                logger.critical('Malformed data: ' + e.msg)
+                raise InternalError('Bug: internal data is not being conditioned properly') from e
+        # Allow other commands (such as scalems.map) to describe calls to the function.
+        operation.function_name = name
+        operation.outputs = output_names
+        operation.execution = execution
+        return operation
+    return decorator
@@ -0,0 +1,391 @@
+"""Generate and consume collections of workflow operations.
+
+Implements :py:func:`scalems.map`, :py:func:`scalems.as_completed`,
+:py:func:`scalems.desequence`, and :py:func:`scalems.reduce`.
+
+Mapping over a large iterable does not add all of the tasks to the workflow at
+once. Tasks are added as the results of earlier tasks are consumed, keeping a
+bounded number of tasks in flight, so the iteration must be driven by a client
+(``async for``) while the workflow is being dispatched. Where the workflow
+manager supports it (see `scalems.local.AsyncWorkflowManager.hold()`), the
+tasks are released from the workflow once their results have been consumed.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import typing
+
+from .exceptions import ProtocolError
+from . import context as _context
+from . import function as _function
+
+logger = logging.getLogger(__name__)
+logger.debug('Importing {}'.format(__name__))
+
+
+class _Completions:
+    """Receive workflow references in the order in which they complete.
+
+    Completion is detected with done callbacks, so references are not polled.
+    Callbacks may be called in other threads (e.g. by RP), so keys are delivered
+    to the queue in the event loop in which the reference was added.
+    """
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        # Number of added references that have not been retrieved.
+        self.pending = 0
+
+    def add(self, reference, key=None):
+        """Add a reference to a workflow item.
+
+        *key* (default: *reference*) is retrieved when the item is done.
+        """
+        if key is None:
+            key = reference
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+
+        def done_callback(_, key=key):
+            try:
+                loop.call_soon_threadsafe(self._queue.put_nowait, key)
+            except RuntimeError:
+                # The event loop is closed. Nobody is waiting.
+                ...
+
+        reference.add_done_callback(done_callback)
+
+    async def get(self):
+        """Get the key for the next reference to complete."""
+        key = await self._queue.get()
+        self.pending -= 1
+        return key
+
+
+class Map:
+    """An asynchronous iterable of the results of a function applied to each element.
+
+    See `map()`.
+    """
+    def __init__(self, function, iterable, *,
+                 shape=None,
+                 ordered: bool = True,
+                 window: int = None,
+                 chunksize: int = 1,
+                 context=None):
+        if chunksize < 1:
+            raise ValueError('*chunksize* must be a positive integer.')
+        if window is None:
+            window = 2 * (os.cpu_count() or 1)
+        if window < 1:
+            raise ValueError('*window* must be a positive integer.')
+        if chunksize > 1 and not hasattr(function, 'function_name'):
+            raise ValueError('*chunksize* requires a function produced by scalems.function_wrapper.')
+        if shape is not None:
+            shape = tuple(shape)
+            if len(shape) != 1:
+                raise ValueError('Only one-dimensional maps are supported.')
+        self.function = function
+        self.shape = shape
+        self.ordered = ordered
+        self.window = window
+        self.chunksize = chunksize
+        self._iterable = iterable
+        self._context = context
+        self._iterating = False
+
+    def _add(self, context, chunk: list) -> typing.Tuple[_context.ItemView, bool]:
+        """Add a task for the elements in *chunk*.
+
+        Tasks of wrapped functions are held (see `AsyncWorkflowManager.hold()`)
+        if the map added them, or if they are held by other users.
+
+        Returns:
+            The view of the task, and whether the task is held by the map.
+        """
+        function = self.function
+        if not hasattr(function, 'function_name'):
+            view = function(chunk[0], context=context)
+            if not isinstance(view, _context.ItemView):
+                raise ProtocolError('{} did not produce a workflow item.'.format(repr(function)))
+            return view, False
+        if self.chunksize == 1:
+            # Equivalent to calling the wrapped function.
+            item = _function.Function(_function.FunctionInput(
+                function=function.function_name,
+                args=(chunk[0],),
+                kwargs={},
+                outputs=function.outputs,
+                execution=function.execution))
+        else:
+            item = _function.Function(_function.FunctionInput(
+                function=_function.function_name(_function.call_each),
+                args=(function.function_name, chunk, function.outputs),
+                execution=function.execution))
+        uid = item.uid()
+        try:
+            context.item(uid)
+        except KeyError:
+            added = True
+        else:
+            added = False
+        view = _context.workflow_item_director_factory(item, context=context)()
+        held = hasattr(context, 'hold') and (added or context.held(uid))
+        if held:
+            context.hold(uid)
+        return view, held
+
+    def _results(self, view: _context.ItemView) -> list:
+        if self.chunksize == 1:
+            return [view.result()]
+        return view.result()
+
+    def __aiter__(self):
+        if self._iterating:
+            raise ProtocolError('Map objects can only be iterated once.')
+        self._iterating = True
+        return self._iterate()
+
+    async def _iterate(self):
+        context = self._context
+        if context is None:
+            context = _context.get_context()
+        elements = iter(self._iterable)
+        chunksize = self.chunksize
+        window = self.window
+
+        # Tasks in flight, by chunk index, with whether they are held.
+        in_flight = dict()
+        # Completed chunks (for ordered iteration), by chunk index, with whether they are held.
+        pending = dict()
+        # Chunk indices in order of completion.
+        completed = _Completions()
+        next_chunk = 0
+        next_to_yield = 0
+        count = 0
+        exhausted = False
+
+        try:
+            while True:
+                # Unconsumed results count against the window, to bound memory use
+                # when the next result in order is slow.
+                while not exhausted and len(in_flight) + len(pending) < window:
+                    chunk = list(itertools.islice(elements, chunksize))
+                    if len(chunk) == 0:
+                        exhausted = True
+                        break
+                    count += len(chunk)
+                    view, held = self._add(context, chunk)
+                    in_flight[next_chunk] = (view, held)
+                    completed.add(view, next_chunk)
+                    next_chunk += 1
+                if len(in_flight) == 0 and len(pending) == 0:
+                    break
+
+                index = await completed.get()
+                if self.ordered:
+                    pending[index] = in_flight.pop(index)
+                    while next_to_yield in pending:
+                        view, held = pending[next_to_yield]
+                        for result in self._results(view):
+                            yield result
+                        del pending[next_to_yield]
+                        next_to_yield += 1
+                        if held:
+                            context.unhold(view.uid())
+                else:
+                    view, held = in_flight[index]
+                    for result in self._results(view):
+                        yield result
+                    del in_flight[index]
+                    if held:
+                        context.unhold(view.uid())
+        finally:
+            # Release the remaining tasks if the iteration is abandoned.
+            for view, held in itertools.chain(in_flight.values(), pending.values()):
+                if held:
+                    context.unhold(view.uid())
+
+        if self.shape is not None and self.shape[0] != count:
+            raise ValueError('Expected {} elements, but found {}.'.format(self.shape[0], count))
+
+    async def collect(self) -> list:
+        """Get all of the results as a list."""
+        return [result async for result in self]
+
+
+def map(function, iterable, shape=None, *,
+        ordered: bool = True,
+        window: int = None,
+        chunksize: int = 1,
+        context=None) -> Map:
+    """Implements :py:func:`scalems.map`.
+
+    Arguments:
+        function: A workflow operation, such as a function produced by `scalems.function_wrapper`.
+        iterable: Elements to which to apply *function*.
+        shape: Expected shape of the generated collection, if known.
+        ordered: Produce results in the order of *iterable* (default), or as they become available.
+        window: Maximum number of tasks in flight (default: twice the number of cores).
+        chunksize: Number of elements to process in each task.
+        context: Workflow manager to which to add tasks (default: current context).
+
+    With *chunksize* greater than one, each task calls the function for several
+    elements, which reduces the per-task overhead for cheap functions.
+    Tasks are added to the workflow as the iteration proceeds.
+
+    Example::
+
+        async with context.dispatch():
+            async for result in scalems.map(simulate, inputs, window=100, ordered=False):
+                ...
+
+    Returns:
+        An asynchronous iterable of the results.
+    """
+    return Map(function, iterable, shape=shape, ordered=ordered, window=window, chunksize=chunksize,
+               context=context)
+
+
+async def as_completed(references: typing.Iterable, *,
+                       batch_size: int = None,
+                       window: float = None):
+    """Implements :py:func:`scalems.as_completed`.
+
+    Arguments:
+        references: Views of workflow items (or references to their outputs).
+        batch_size: Maximum number of references to deliver at a time.
+        window: Maximum time (in seconds) to wait for a batch to fill.
+
+    Without *batch_size* or *window*, references are produced one at a time, as
+    their items complete. Otherwise, lists of references are produced. A batch is
+    delivered when it has *batch_size* elements, or when *window* seconds have
+    passed since its first element completed, whichever is first. The final batch
+    may be smaller.
+    """
+    if batch_size is not None and batch_size < 1:
+        raise ValueError('*batch_size* must be a positive integer.')
+    completions = _Completions()
+    for reference in references:
+        completions.add(reference)
+
+    if batch_size is None and window is None:
+        while completions.pending > 0:
+            yield await completions.get()
+        return
+
+    loop = asyncio.get_running_loop()
+    while completions.pending > 0:
+        batch = [await completions.get()]
+        if window is not None:
+            deadline = loop.time() + window
+        while completions.pending > 0 and (batch_size is None or len(batch) < batch_size):
+            if window is None:
+                batch.append(await completions.get())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            # Note: Cancelling a pending Queue.get() does not lose an item.
+            getter = asyncio.ensure_future(completions.get())
+            await asyncio.wait((getter,), timeout=remaining)
+            if not getter.done():
+                getter.cancel()
+                break
+            batch.append(getter.result())
+        yield batch
+
+
+def desequence(iterable):
+    """Implements :py:func:`scalems.desequence`.
+
+    For a `Map`, produce a copy of the map that delivers results as they
+    become available. Otherwise, *iterable* provides references to workflow items,
+    which are produced as they complete (see `as_completed()`).
+    """
+    if isinstance(iterable, Map):
+        return Map(iterable.function, iterable._iterable,
+                   shape=iterable.shape,
+                   ordered=False,
+                   window=iterable.window,
+                   chunksize=iterable.chunksize,
+                   context=iterable._context)
+    return as_completed(iterable)
+
+
+def _is_reference(value) -> bool:
+    return isinstance(value, (_context.ItemView, _function.OutputReference))
+
+
+def _operand(function, view: _context.ItemView):
+    """Get a reference to the value produced by *view* for use as an operand of *function*."""
+    outputs = getattr(function, 'outputs', ())
+    if len(outputs) == 0:
+        return view
+    if len(outputs) > 1:
+        raise ValueError('Reduction requires a function with a single output.')
+    return getattr(view.output, outputs[0])
+
+
+async def _reduce_unordered(function, operands: list, context):
+    completions = _Completions()
+    # Operands are combined in the order in which they become ready.
+    ready = list()
+    for operand in operands:
+        if _is_reference(operand):
+            completions.add(operand)
+        else:
+            ready.append(operand)
+    while True:
+        while len(ready) >= 2:
+            lhs = ready.pop()
+            rhs = ready.pop()
+            completions.add(_operand(function, function(lhs, rhs, context=context)))
+        if completions.pending == 0:
+            break
+        ready.append(await completions.get())
+    return ready[0]
+
+
+def reduce(function, iterable, *, ordered: bool = True, context=None):
+    """Implements :py:func:`scalems.reduce`.
+
+    Arguments:
+        function: A workflow operation mapping (T, T) -> T, such as a function
+            produced by `scalems.function_wrapper` (with no more than one output).
+        iterable: Operands (values or workflow references).
+        ordered: Preserve the order of the operands (default), or combine operands
+            as they become available.
+        context: Workflow manager to which to add tasks (default: current context).
+
+    For *ordered* reduction, the operations are added immediately, as a balanced
+    binary tree, so the reduction has depth O(log N) and the result is a reference to
+    the root of the tree. *function* must be associative.
+
+    If *ordered* is False, *function* must also be commutative. The result is an
+    awaitable, which must be awaited while the workflow is dispatched. Operands
+    are combined pairwise as soon as any two are available, and the awaitable
+    produces a reference to the final combination.
+
+    Example::
+
+        total = scalems.reduce(add_counts, counts)
+        async with context.dispatch():
+            total = await scalems.reduce(add_counts, counts, ordered=False)
+
+    If there is only one operand, it is the result.
+    """
+    if context is None:
+        context = _context.get_context()
+    operands = list(iterable)
+    if len(operands) == 0:
+        raise TypeError('reduce() of empty iterable.')
+    if not ordered:
+        return _reduce_unordered(function, operands, context)
+    while len(operands) > 1:
+        level = [_operand(function, function(lhs, rhs, context=context))
+                 for lhs, rhs in zip(operands[0::2], operands[1::2])]
+        if len(operands) % 2 == 1:
+            level.append(operands[-1])
+        operands = level
+    return operands[0]
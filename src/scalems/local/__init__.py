@@ -12,12 +12,17 @@ Example:
 
 
 import asyncio
+import collections
 import concurrent.futures
 import contextlib
 import contextvars
 import dataclasses
-import json
+import functools
+import gc
+import itertools
 import logging
+import os
+import pathlib
 import queue
 import threading
 import warnings
@@ -25,11 +30,18 @@ import weakref
 from typing import Any, Callable
 
 import scalems.context
+import scalems.control
+import scalems.function
+import scalems.subprocess
 import typing
-from scalems.exceptions import DuplicateKeyError, InternalError, MissingImplementationError, ProtocolError
-from scalems.serialization import Encoder
+from scalems.exceptions import DispatchError, DuplicateKeyError, InternalError, MissingImplementationError, \
+    ProtocolError
+from scalems.serialization import Codec, get_codec, WorkflowReader, WorkflowWriter
 
 from . import operations
+from .cache import cache_key, ResultCache
+from .graph import DependencyIndex
+from .scheduling import cores_required, Scheduler
 
 logger = logging.getLogger(__name__)
 logger.debug('Importing {}'.format(__name__))
@@ -39,8 +51,34 @@ class QueueItem:
     """Queue items are either workflow items or control messages."""
 
 
-# TO DO NEXT: Implement the queue, dispatcher, executor (and internal queue)
-# and, come on... add the fingerprinter... and the basic serializer...  `
+@functools.lru_cache(maxsize=None)
+def _field_names(input_type: type) -> typing.Tuple[str, ...]:
+    return tuple(field.name for field in dataclasses.fields(input_type))
+
+
+# Workflow items that can be added to the AsyncWorkflowManager.
+_supported_items = (scalems.subprocess.Subprocess, scalems.function.Function, scalems.control.WhileLoop)
+
+
+def _make_record(task_description: typing.Union[_supported_items]) -> dict:
+    """Prepare the workflow record for a task."""
+    record = {
+        'uid': task_description.uid().hex(),
+        'type': task_description.resource_type().scoped_identifier(),
+        'input': {},
+        'depends': [dependency.hex() for dependency in task_description.dependencies()]
+    }
+    shape = getattr(task_description, 'shape', None)
+    if shape is not None and shape() != (1,):
+        record['shape'] = list(shape())
+    task_input = task_description.input_collection()
+    for name in _field_names(type(task_input)):
+        try:
+            # TODO: Need serialization typing.
+            record['input'][name] = getattr(task_input, name)
+        except AttributeError as e:
+            raise InternalError('Unexpected missing field.') from e
+    return record
 
 
 class AsyncWorkflowManager(scalems.context.WorkflowManager):
@@ -49,10 +87,51 @@ class AsyncWorkflowManager(scalems.context.WorkflowManager):
     Uses the asyncio module to allow commands to be staged as asyncio coroutines.
 
     There is no implicit OS level multithreading or multiprocessing.
+
+    Subprocess tasks are launched concurrently, subject to the resources they
+    declare (see :py:func:`scalems.executable`). While dispatching, a
+    :py:class:`~scalems.local.scheduling.Scheduler` manages a pool of *cores*
+    (default: :py:func:`os.cpu_count()`).
+
+    If a *result_cache* is provided, results of previous executions of identical
+    tasks are reused instead of executing the tasks again.
+
+    Each task executes in a private working directory, named for the task uid,
+    within *directory* (default: the current working directory when the manager
+    is created). See `task_directory()`.
+
+    Task records are encoded with *codec* (default ``'json'``). The ``'binary'``
+    codec uses less memory per task.
+
+    With *stream_output*, subprocess stdout and stderr are captured through pipes
+    while the process runs, and are available line by line through the ``stream()``
+    method of the task view, in addition to the usual output files. Output is only
+    captured for streams that were requested before the task was launched.
     """
-    def __init__(self):
+    def __init__(self, *, cores: int = None, result_cache: ResultCache = None, directory=None,
+                 stream_output: bool = False, codec: typing.Union[str, Codec] = None):
+        # Encoding of task records (see scalems.serialization.get_codec()).
+        # Codecs are reusable and relatively expensive to create, so we use a
+        # single instance instead of json.dumps(..., cls=Encoder) for every record.
+        self.codec = get_codec(codec)
+        # Deliver subprocess output to Task streams while the subprocess runs.
+        self.stream_output = stream_output
+        if directory is None:
+            directory = os.getcwd()
+        # Root of the task working directories.
+        self.directory = os.path.abspath(directory)
+        # Size of the resource pool for dispatched work.
+        self.cores = cores
+        # Optional persistent store of results from previous executions.
+        self.result_cache = result_cache
         # Basic Context implementation details
         self.task_map = dict()  # Map UIDs to task Futures.
+        # Track the readiness of the managed items as they are added and completed.
+        self._dependencies = DependencyIndex()
+        # Reference counts of items held by loop iterations. See hold().
+        self._holds = dict()
+        # While dispatching, set when no items are ready or executing.
+        self._idle: typing.Union[asyncio.Event, None] = None
         # Note: We actually need multiple queues and a queue monitor to move
         # items between queues. The Executor will have a sense of "scope" for
         # tasks that are grouped by data locality or resource requirements, as
@@ -71,7 +150,12 @@ class AsyncWorkflowManager(scalems.context.WorkflowManager):
         # Consider just providing a queue manager and default dispatcher for use
         # by the base class.
         self._dispatcher: typing.Union[weakref.ref, None] = None
+        # Thread-safe callable with which to wake the dispatcher after adding to the queue.
+        self._notify_dispatcher: typing.Union[Callable[[], Any], None] = None
         self._dispatcher_lock = asyncio.Lock()
+        # Maximum number of messages the dispatcher handles at a time,
+        # and maximum number of commands queued for the executor.
+        self.dispatch_batch_size = 1000
         # Rely on the GIL to provide a simple event hook.
         # self._event_hooks = {'add_item': {}}
 
@@ -109,59 +193,111 @@ class AsyncWorkflowManager(scalems.context.WorkflowManager):
             if self._queue is not None:
                 raise ProtocolError('Found unexpected dispatcher queue.')
             dispatcher_queue = queue.SimpleQueue()
+            wakeup = asyncio.Event()
+            loop = asyncio.get_running_loop()
             self._queue = dispatcher_queue
+            self._notify_dispatcher = functools.partial(loop.call_soon_threadsafe, wakeup.set)
 
             # 2. Get snapshot of current workflow state with which to initialize the dispatcher.
-            # TODO: Topologically sort DAG!
-            initial_task_list = list(self.task_map.keys())
+            # Items are indexed as they are added, but items may also have been
+            # inserted directly into the task_map.
+            if len(self._dependencies) < len(self.task_map):
+                for key, item in self.task_map.items():
+                    if key not in self._dependencies:
+                        self._index_item(key, item)
+            # Only items with satisfied dependencies are dispatched. Others are
+            # dispatched as their dependencies complete.
+            initial_task_list = self._dependencies.ready()
+            self._idle = asyncio.Event()
+            if len(initial_task_list) == 0:
+                self._idle.set()
+            dispatcher_queue.put({'add_items': initial_task_list})
             #  It is now okay to yield.
 
             # 3. Bind a new executor to its queue.
             # Note: if there were a reason to decouple the executor lifetime from this scope,
             # we could consider a more object-oriented interface with it.
-            executor_queue = asyncio.Queue()
-            for key in initial_task_list:
-                await executor_queue.put({'add_item': key})
-            executor = run_executor(source_context=self, command_queue=executor_queue)
+            executor_queue = asyncio.Queue(maxsize=self.dispatch_batch_size)
+            scheduler = Scheduler(cores=self.cores)
+            # Workers for Python functions are started on demand.
+            executors = {
+                'thread': concurrent.futures.ThreadPoolExecutor(max_workers=scheduler.capacity,
+                                                                thread_name_prefix='scalems'),
+                'process': concurrent.futures.ProcessPoolExecutor(max_workers=scheduler.capacity)
+            }
+            executor = run_executor(source_context=self,
+                                    command_queue=executor_queue,
+                                    scheduler=scheduler,
+                                    result_cache=self.result_cache,
+                                    executors=executors)
 
             # 4. Bind a dispatcher to the executor_queue and the dispatcher_queue.
             # TODO: We should bind the dispatcher directly to the executor, but that requires
             #  that we make an Executor class with concurrency-safe methods.
-            # dispatcher = run_dispatcher(dispatcher_queue, executor_queue)
-            # self._dispatcher = weakref.ref(dispatcher)
+            dispatcher = run_dispatcher(dispatcher_queue, executor_queue,
+                                        wakeup=wakeup,
+                                        batch_size=self.dispatch_batch_size)
             # TODO: Toggle active dispatcher state.
             # scalems.context._dispatcher.set(...)
 
             # 5. Allow the executor and dispatcher to start using the event loop.
             executor_task = asyncio.create_task(executor)
-            # asyncio.create_task(dispatcher)
+            dispatcher_task = asyncio.create_task(dispatcher)
+            self._dispatcher = weakref.ref(dispatcher_task)
 
+        # Cancellation (or another BaseException) also interrupts the dispatching context.
+        interrupted = True
         try:
             # We can surrender control here and leave the executor and dispatcher tasks running
             # while evaluating a `with` block suite for the `dispatch` context manager.
             yield
+            interrupted = False
 
         except Exception as e:
             logger.exception('Uncaught exception while in dispatching context: {}'.format(str(e)))
             raise e
 
         finally:
+            if not interrupted:
+                # Run the remaining work, including items that become ready as their
+                # dependencies complete, unless dispatching has already failed.
+                idle = asyncio.create_task(self._idle.wait())
+                await asyncio.wait((idle, dispatcher_task, executor_task), return_when=asyncio.FIRST_COMPLETED)
+                idle.cancel()
+            waiting = self._dependencies.waiting()
+            if waiting > 0:
+                logger.warning('{} items were not dispatched because of incomplete dependencies.'.format(waiting))
             async with self._dispatcher_lock:
                 self._dispatcher = None
                 self._queue = None
-            # dispatcher_queue.put({'control': 'stop'})
-            # await dispatcher
-            # TODO: Make sure the dispatcher hasn't died. Look for acknowledgement
-            #  of receipt of the Stop command.
-            # TODO: Check status...
-            if not dispatcher_queue.empty():
-                logger.error('Dispatcher finished while items remain in dispatcher queue. Approximate size: {}'.format(dispatcher_queue.qsize()))
+                self._notify_dispatcher = None
+                self._idle = None
+            # Items added after this point are not dispatched in this session.
+            # Tell the dispatcher to forward the items it has already received, then stop.
+            dispatcher_queue.put({'control': 'stop'})
+            wakeup.set()
+            # The dispatcher can be blocked on a full executor queue if the executor fails.
+            await asyncio.wait((dispatcher_task, executor_task), return_when=asyncio.FIRST_COMPLETED)
+            if not dispatcher_task.done():
+                logger.error('Executor stopped before the dispatcher. Cancelling dispatcher.')
+                dispatcher_task.cancel()
+                await asyncio.wait((dispatcher_task,))
+            elif dispatcher_task.exception() is not None:
+                logger.error('Dispatcher failed. Stopping executor.')
 
             # Stop the executor.
-            executor_queue.put_nowait({'control': 'stop'})
-            await executor_task
+            if not executor_task.done():
+                await executor_queue.put({'control': 'stop'})
+            await asyncio.wait((executor_task,))
+            # All launched items are done, so this does not block for long.
+            for pool in executors.values():
+                pool.shutdown(wait=True)
             if executor_task.exception() is not None:
                 raise executor_task.exception()
+            if not dispatcher_task.cancelled() and dispatcher_task.exception() is not None:
+                raise dispatcher_task.exception()
+            if not dispatcher_queue.empty():
+                raise InternalError('Bug: Dispatcher left items in the queue without raising an exception.')
 
             # Check that the queue drained.
             # WARNING: The queue will never finish draining if executor_task fails.
@@ -180,6 +316,10 @@ class AsyncWorkflowManager(scalems.context.WorkflowManager):
             # Do we want to close the event loop here, as part of scalems.run(), or somewhere else?
             # loop.close()
 
+    def task_directory(self, uid: bytes):
+        """Get the filesystem location for the execution of the task *uid*."""
+        return operations.task_directory(self.directory, uid)
+
     def item(self, uid: bytes):
         """Interact with a managed item.
 
@@ -200,33 +340,21 @@ class AsyncWorkflowManager(scalems.context.WorkflowManager):
         # #  to resources owned by other Contexts.
         # if not isinstance(bound_input, scalems.subprocess.SubprocessInput):
         #     raise ValueError('Only scalems.subprocess.SubprocessInput objects supported as input.')
-        if not isinstance(task_description, scalems.subprocess.Subprocess):
+        if not isinstance(task_description, _supported_items):
             raise MissingImplementationError('Operation not supported.')
         uid = task_description.uid()
         if uid in self.task_map:
             # TODO: Consider decreasing error level to `warning`.
             raise DuplicateKeyError('Task already present in workflow.')
         logger.debug('Adding {} to {}'.format(str(task_description), str(self)))
-        record = {
-            'uid': task_description.uid().hex(),
-            'type': task_description.resource_type().scoped_identifier(),
-            'input': {}
-        }
-        task_input = task_description.input_collection()
-        for field in dataclasses.fields(task_input):
-            name = field.name
-            try:
-                # TODO: Need serialization typing.
-                record['input'][name] = getattr(task_input, name)
-            except AttributeError as e:
-                raise InternalError('Unexpected missing field.') from e
-        record = json.dumps(record, cls=Encoder)
+        record = self.codec.encode(_make_record(task_description))
 
         # TODO: Make sure there are no artifacts of shallow copies that may result in a user modifying nested objects unexpectedly.
-        item = scalems.context.Task(self, record)
+        item = scalems.context.Task(self, record, codec=self.codec)
         # TODO: Check for ability to dispatch.
 
         self.task_map[uid] = item
+        ready = self._index_item(uid, item)
 
         # TODO: Register task factory (dependent on executor).
         # TODO: Register input factory (dependent on dispatcher and task factory / executor).
@@ -242,14 +370,241 @@ class AsyncWorkflowManager(scalems.context.WorkflowManager):
         dispatcher_queue = self._queue
         # self._queue may be removed by another thread before we add the item to it,
         # but that is fine. There is nothing wrong with abandoning an unneeded queue.
-        if dispatcher_queue is not None:
+        if dispatcher_queue is not None and ready:
             logger.debug('Running dispatcher detected. Entering live dispatching hook.')
             # Add the AddItem message to the queue.
             assert isinstance(dispatcher_queue, queue.SimpleQueue)
-            dispatcher_queue.put({'add_item': task_description})
+            dispatcher_queue.put({'add_item': uid})
+            self._wake_dispatcher()
 
         return task_view
 
+    def _index_item(self, uid: bytes, item: scalems.context.Task) -> bool:
+        """Track the dependencies of a new item.
+
+        Returns:
+            True if the item is ready to be dispatched.
+        """
+        ready = self._dependencies.add(uid, item.dependencies())
+        if ready and self._idle is not None:
+            self._idle.clear()
+        item.add_done_callback(self._item_done)
+        return ready and not item.done()
+
+    def _item_done(self, item: scalems.context.Task):
+        """Release the successors of a completed item to the dispatcher."""
+        ready = self._dependencies.complete(item.uid())
+        dispatcher_queue = self._queue
+        if dispatcher_queue is not None and len(ready) > 0:
+            dispatcher_queue.put({'add_items': ready})
+            self._wake_dispatcher()
+        if self._idle is not None and self._dependencies.ready_count() == 0:
+            self._idle.set()
+
+    def _wake_dispatcher(self):
+        notify = self._notify_dispatcher
+        if notify is not None:
+            try:
+                notify()
+            except RuntimeError:
+                # The event loop is closed. The dispatcher is no longer running.
+                ...
+
+    def release(self, uid: bytes):
+        """Stop managing the completed item *uid*.
+
+        Allows the memory for the item and its result to be reclaimed. Views of
+        the item can no longer be used. If an equivalent item is added later, it
+        is executed again.
+        """
+        item = self.task_map[uid]
+        if not item.done():
+            raise ProtocolError('Cannot release incomplete item {}.'.format(uid.hex()))
+        self._dependencies.discard(uid)
+        self._holds.pop(uid, None)
+        del self.task_map[uid]
+
+    def hold(self, uid: bytes):
+        """Add a reference to the item *uid* on behalf of a transient user, such as a loop iteration.
+
+        Equivalent items are shared, so several loops may use the same item.
+        Held items are released by `unhold()` when their last reference is removed.
+        """
+        if uid not in self.task_map:
+            raise KeyError('{} is not in the workflow.'.format(uid.hex()))
+        self._holds[uid] = self._holds.get(uid, 0) + 1
+
+    def held(self, uid: bytes) -> bool:
+        """Whether the item *uid* has references from `hold()`."""
+        return uid in self._holds
+
+    def unhold(self, uid: bytes) -> bool:
+        """Remove a reference added by `hold()`.
+
+        When the last reference is removed from a completed item, the item is released.
+
+        Returns:
+            True if the item was released.
+        """
+        count = self._holds[uid] - 1
+        if count > 0:
+            self._holds[uid] = count
+            return False
+        del self._holds[uid]
+        if self.task_map[uid].done():
+            self.release(uid)
+            return True
+        return False
+
+    def add_items(self, task_descriptions: typing.Iterable) -> typing.List[scalems.context.ItemView]:
+        """Add several tasks to the workflow.
+
+        Equivalent to calling `add_item()` for each element of *task_descriptions*,
+        but records are prepared in a single pass and a running dispatcher is
+        notified once for the whole batch. If any element cannot be added,
+        no elements are added.
+
+        Example::
+
+            tasks = [scalems.subprocess.Subprocess(scalems.subprocess.SubprocessInput(argv=('sim', str(seed))))
+                     for seed in range(100000)]
+            views = context.add_items(tasks)
+
+        Returns:
+            Views of the new tasks, in the order of *task_descriptions*.
+        """
+        task_descriptions = list(task_descriptions)
+        uids = list()
+        batch = set()
+        for task_description in task_descriptions:
+            if not isinstance(task_description, _supported_items):
+                raise MissingImplementationError('Operation not supported.')
+            uid = task_description.uid()
+            if uid in self.task_map or uid in batch:
+                raise DuplicateKeyError('Task {} already present in workflow.'.format(uid.hex()))
+            batch.add(uid)
+            uids.append(uid)
+        logger.debug('Adding {} tasks to {}'.format(len(uids), str(self)))
+
+        # The new records are long-lived and do not form reference cycles, but
+        # allocating them in large numbers triggers repeated (and increasingly
+        # expensive) garbage collection passes. Suspend collection for the batch.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            encode = self.codec.encode
+            codec = self.codec
+            items = [scalems.context.Task(self, encode(_make_record(task_description)), codec=codec)
+                     for task_description in task_descriptions]
+            self.task_map.update(zip(uids, items))
+            ready = [uid for uid, item in zip(uids, items) if self._index_item(uid, item)]
+            task_views = [scalems.context.ItemView(context=self, uid=uid) for uid in uids]
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        dispatcher_queue = self._queue
+        if dispatcher_queue is not None and len(ready) > 0:
+            logger.debug('Running dispatcher detected. Entering live dispatching hook.')
+            assert isinstance(dispatcher_queue, queue.SimpleQueue)
+            dispatcher_queue.put({'add_items': ready})
+            self._wake_dispatcher()
+
+        return task_views
+
+    def _topological_order(self) -> typing.List[bytes]:
+        """Get the uids of the managed items, such that items follow their dependencies."""
+        task_map = self.task_map
+        order = list()
+        visited = set()
+        for root in task_map:
+            if root in visited:
+                continue
+            visited.add(root)
+            # Iterative depth-first search, with items listed after their dependencies.
+            stack = [(root, iter(task_map[root].dependencies()))]
+            while stack:
+                uid, dependencies = stack[-1]
+                for dependency in dependencies:
+                    if dependency not in visited and dependency in task_map:
+                        visited.add(dependency)
+                        stack.append((dependency, iter(task_map[dependency].dependencies())))
+                        break
+                else:
+                    stack.pop()
+                    order.append(uid)
+        return order
+
+    def dump(self, fp: typing.Union[typing.TextIO, typing.BinaryIO], *, codec: typing.Union[str, Codec] = None):
+        """Write the managed workflow to *fp* as a ``scalems_workflow_1`` document.
+
+        Records are written in topological order, without building the document
+        in memory. Results are not included.
+        See :py:class:`scalems.serialization.WorkflowWriter`.
+
+        The document is written with *codec* (default: the codec of the manager).
+        Records are written as they were created if the codecs match.
+        """
+        codec = self.codec if codec is None else get_codec(codec)
+        with WorkflowWriter(fp, codec=codec) as writer:
+            for uid in self._topological_order():
+                item = self.task_map[uid]
+                if codec is self.codec:
+                    writer.write_encoded(item.serialize(), uid=uid, depends=item.dependencies())
+                else:
+                    writer.write(self.codec.decode(item.serialize()))
+
+    def load(self, fp: typing.Union[typing.TextIO, typing.BinaryIO], *, codec: typing.Union[str, Codec] = None) -> int:
+        """Add the workflow items from a ``scalems_workflow_1`` document.
+
+        The document is read with *codec* (default: the codec of the manager).
+
+        The document is read incrementally (see
+        :py:class:`scalems.serialization.WorkflowReader`). Records are added in
+        batches of `dispatch_batch_size`, and a running dispatcher is notified
+        for each batch. If the document is invalid, the items before the error
+        have been added.
+
+        Returns:
+            The number of items added.
+        """
+        count = 0
+        batch = list()
+        # As in add_items(), suspend garbage collection while allocating the
+        # (acyclic) records. Decoding also allocates many objects.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            codec = self.codec if codec is None else get_codec(codec)
+            for text, record in WorkflowReader(fp, codec=codec).encoded():
+                uid = bytes.fromhex(record['uid'])
+                if uid in self.task_map:
+                    raise DuplicateKeyError('Task {} already present in workflow.'.format(uid.hex()))
+                if codec is not self.codec:
+                    text = self.codec.encode(record)
+                batch.append((uid, text))
+                if len(batch) >= self.dispatch_batch_size:
+                    count += self._load_batch(batch)
+                    batch = list()
+            count += self._load_batch(batch)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return count
+
+    def _load_batch(self, batch: typing.List[typing.Tuple[bytes, typing.Union[str, bytes]]]) -> int:
+        ready = list()
+        for uid, record in batch:
+            item = scalems.context.Task(self, record, codec=self.codec)
+            self.task_map[uid] = item
+            if self._index_item(uid, item):
+                ready.append(uid)
+        dispatcher_queue = self._queue
+        if dispatcher_queue is not None and len(ready) > 0:
+            dispatcher_queue.put({'add_items': ready})
+            self._wake_dispatcher()
+        return len(batch)
+
     async def run(self, task=None, **kwargs):
         """Run the configured workflow.
 
@@ -297,35 +652,86 @@ class AsyncWorkflowManager(scalems.context.WorkflowManager):
     #     raise MissingImplementationError()
 
 
-async def run_executor(source_context: AsyncWorkflowManager, command_queue: asyncio.Queue):
-    """Process workflow messages until a stop message is received.
+async def run_dispatcher(source: queue.SimpleQueue, command_queue: asyncio.Queue, *,
+                         wakeup: asyncio.Event,
+                         batch_size: int = 1000):
+    """Forward workflow items from the dispatcher queue to the executor.
 
-    Initial implementation processes commands serially without regard for possible
-    concurrency.
+    The *source* queue is thread-safe and is fed by the ``add_item`` hook of
+    the workflow manager, which sets the *wakeup* Event (in a thread-safe manner)
+    after adding to the queue.
+    Messages are handled in batches of up to *batch_size* before yielding to
+    the event loop. Forwarding waits when the executor *command_queue* is full,
+    so the executor regulates the rate at which the dispatcher consumes messages.
 
-    Towards concurrency:
-        We can create all tasks without awaiting any of them.
+    Items are forwarded as they are received. (The executor ignores items that
+    it has already launched.) The dispatcher returns when it receives a stop
+    message, after forwarding the items received before the stop message.
+    """
+    while True:
+        # Clear before draining so that a notification for a message that we
+        # do not drain will wake us up again.
+        wakeup.clear()
+        batch = []
+        while len(batch) < batch_size:
+            try:
+                batch.append(source.get_nowait())
+            except queue.Empty:
+                break
+        if len(batch) == 0:
+            await wakeup.wait()
+            continue
+        logger.debug('Dispatcher handling {} messages.'.format(len(batch)))
+        for message in batch:
+            if 'control' in message:
+                if message['control'] == 'stop':
+                    return
+                else:
+                    raise ProtocolError('Unknown command: {}'.format(message['control']))
+            if 'add_item' in message:
+                keys = (message['add_item'],)
+            elif 'add_items' in message:
+                keys = message['add_items']
+            else:
+                raise MissingImplementationError('Dispatcher has no implementation for {}'.format(str(message)))
+            for key in keys:
+                await command_queue.put({'add_item': key})
+        # Allow other tasks (including the executor) to run between batches.
+        await asyncio.sleep(0)
+
+
+async def run_executor(source_context: AsyncWorkflowManager, command_queue: asyncio.Queue, *,
+                       concurrent: bool = True,
+                       scheduler: Scheduler = None,
+                       result_cache: ResultCache = None,
+                       executors: typing.Mapping[str, concurrent.futures.Executor] = None):
+    """Process workflow messages until a stop message is received.
 
-        Some tasks will be awaiting results from other tasks.
+    Each workflow item is launched as its own asyncio.Task as soon as it is
+    received. Items only wait for the items on which they depend, so independent
+    work proceeds concurrently. With ``concurrent=False``, the executor awaits each
+    item before handling the next command (the original serial behavior).
 
-        All tasks will be awaiting a asyncio.Lock or asyncio.Condition for each
-        required resource, but must do so indirectly.
+    When the stop message is received, the executor stops accepting commands and
+    waits for launched items to finish. The first exception raised by a launched
+    item (in launch order) is re-raised after all launched items have finished.
+    Items that are already running or done when received again are not relaunched.
 
-        To avoid dead-locks, we can't have a Lock object for each resource unless
-        they are managed by an intermediary that can do some serialization of requests.
-        In other words, we need a Scheduler that tracks the resource pool, packages
-        resource locks only when they can all be acquired without race conditions or blocking,
-        and which then notifies the Condition for each task that it is allowed to run.
+    If a *scheduler* is provided, items acquire an allocation for their declared
+    resource requirements after their dependencies are satisfied and hold it
+    while executing. Allocations are only requested by items that are otherwise
+    ready to run, so waiting items do not hold resources.
 
-        It should not do so until the dependencies of the task are known to have
-        all of the resources they need to complete (running with any dynamic dependencies
-        also running) and, preferably, complete.
+    If a *result_cache* is provided, it is consulted before an item is launched.
+    Items with cached results are completed from the cache without execution.
+    Results of successful (zero exit code) subprocesses are added to the cache.
 
-        Alternatively, the Scheduler can operate in blocks, allocating all resources,
-        offering the locks to tasks, waiting for all resources to be released, then repeating.
-        We can allow some conditions to "wake up" the scheduler to back fill a block
-        of resources, but we should be careful with that.
+    Wrapped Python functions are called according to their *execution* hint
+    (see :py:func:`scalems.function.function_wrapper`): directly in the event loop
+    (``inline``), or in the ``thread`` or ``process`` pool from *executors*.
+    The default executor of the event loop is used if a pool is not provided.
 
+    Towards dynamic work:
         (We still need to consider dynamic tasks that
         generate other tasks. I think the only way to distinguish tasks which can't be
         dynamic from those which might be would be with the `def` versus `async def` in
@@ -339,62 +745,396 @@ async def run_executor(source_context: AsyncWorkflowManager, command_queue: asyn
         command like add_item while in an executing context.)
 
     """
-    # Could also accept a "stop" Event object, but we would need some other way to yield
-    # on an empty queue.
-    while True:
-        command = await command_queue.get()
-        try:
-            logger.debug('Executor is handling {}'.format(repr(command)))
-
-            # TODO: Use formal RPC protocol.
-            if 'control' in command:
-                if command['control'] == 'stop':
-                    return
-                else:
-                    raise ProtocolError('Unknown command: {}'.format(command['control']))
-            if 'add_item' not in command:
-                raise MissingImplementationError('Executor has no implementation for {}'.format(str(command)))
-            key = command['add_item']
-            item = source_context.item(key)
-            if not isinstance(item, scalems.context.Task):
-                raise InternalError('Expected {}.item() to return a scalems.context.Task'.format(repr(source_context)))
-
-            # TODO: Ensemble handling
-            item_shape = item.description().shape()
-            if len(item_shape) != 1 or item_shape[0] != 1:
-                raise MissingImplementationError('Executor cannot handle multidimensional tasks yet.')
-
-            # TODO: Automatically resolve resource types.
-            task_type_identifier = item.description().type().identifier()
-            if task_type_identifier != 'scalems.subprocess.SubprocessTask':
-                raise MissingImplementationError('Executor does not have an implementation for {}'.format(str(task_type_identifier)))
-            task_type = scalems.subprocess.SubprocessTask()
-
-            # TODO: Use abstract input factory.
-            logger.debug('Resolving input for {}'.format(str(item)))
-            input_type = task_type.input_type()
-            input_record = input_type(**item.input)
-            input_resources = operations.input_resource_scope(context=source_context, task_input=input_record)
-
+    # Launched items that have not finished, by uid.
+    # Finished items are not retained, so that long-running sessions
+    # (such as while loops) do not accumulate state.
+    running = dict()
+    # Exceptions from finished items, with the launch order of the items.
+    failures = list()
+    launch_order = itertools.count()
+
+    def finished(key, index, awaitable: asyncio.Task):
+        if running.get(key) is awaitable:
+            del running[key]
+        # Retrieve all exceptions (so that asyncio does not warn about unretrieved
+        # exceptions), but only raise the first.
+        if not awaitable.cancelled() and awaitable.exception() is not None:
+            failures.append((index, awaitable.exception()))
+
+    try:
+        # Could also accept a "stop" Event object, but we would need some other way to yield
+        # on an empty queue.
+        while True:
+            command = await command_queue.get()
+            try:
+                logger.debug('Executor is handling {}'.format(repr(command)))
+
+                # TODO: Use formal RPC protocol.
+                if 'control' in command:
+                    if command['control'] == 'stop':
+                        break
+                    else:
+                        raise ProtocolError('Unknown command: {}'.format(command['control']))
+                if 'add_item' not in command:
+                    raise MissingImplementationError('Executor has no implementation for {}'.format(str(command)))
+                key = command['add_item']
+                item = source_context.item(key)
+                if not isinstance(item, scalems.context.Task):
+                    raise InternalError('Expected {}.item() to return a scalems.context.Task'.format(repr(source_context)))
+                if key in running or item.done():
+                    logger.debug('{} is already launched.'.format(key.hex()))
+                    continue
+
+                logger.debug('Creating asyncio Task for {}'.format(str(item)))
+                awaitable = asyncio.create_task(
+                    _execute_item(source_context, item,
+                                  scheduler=scheduler,
+                                  result_cache=result_cache,
+                                  executors=executors))
+                running[key] = awaitable
+                awaitable.add_done_callback(functools.partial(finished, key, next(launch_order)))
+                if not concurrent:
+                    await asyncio.wait((awaitable,))
+            finally:
+                logger.debug('Releasing "{}" from command queue.'.format(str(command)))
+                command_queue.task_done()
+    finally:
+        # Don't abandon running subprocesses, even if we are leaving due to an error.
+        pending = list(running.values())
+        if len(pending) > 0:
+            logger.debug('Executor waiting for {} launched tasks.'.format(len(pending)))
+            await asyncio.wait(pending)
+    # Note: the done callbacks are called before asyncio.wait() returns.
+    if len(failures) > 0:
+        index, task_exception = min(failures, key=lambda failure: failure[0])
+        logger.exception('Task raised exception {}'.format(str(task_exception)))
+        raise task_exception
+
+
+@contextlib.asynccontextmanager
+async def _unscheduled():
+    """Placeholder allocation when the executor is not managing resources."""
+    yield
+
+
+async def _execute_item(source_context: AsyncWorkflowManager, item: scalems.context.Task,
+                        scheduler: Scheduler = None,
+                        result_cache: ResultCache = None,
+                        executors: typing.Mapping[str, concurrent.futures.Executor] = None):
+    """Execute a workflow item once its dependencies are satisfied.
+
+    The result (or exception) is published through the managed Task, so that
+    dependent items and client views can observe completion.
+    """
+    try:
+        for dependency in item.dependencies():
+            try:
+                upstream = source_context.item(dependency)
+            except KeyError as e:
+                raise DispatchError('Dependency {} is not managed by {}.'.format(dependency.hex(),
+                                                                                  repr(source_context))) from e
+            if not upstream.done():
+                logger.debug('{} is waiting for {}.'.format(item.uid().hex(), dependency.hex()))
+                await upstream.wait()
+            if upstream.exception() is not None:
+                raise DispatchError('Dependency {} failed.'.format(dependency.hex()))
+
+        item_shape = item.description().shape()
+        # TODO: Automatically resolve resource types.
+        task_type_identifier = item.description().type().identifier()
+        if item_shape != (1,) and (len(item_shape) != 1
+                                   or task_type_identifier != scalems.subprocess.SubprocessTask.identifier()):
+            raise MissingImplementationError('Executor can only handle (N,) shaped Subprocess ensembles.')
+
+        if task_type_identifier == scalems.subprocess.SubprocessTask.identifier() and item_shape != (1,):
+            result = await _execute_ensemble(source_context, item, scheduler=scheduler)
+        elif task_type_identifier == scalems.subprocess.SubprocessTask.identifier():
+            result = await _execute_subprocess(source_context, item,
+                                               scheduler=scheduler,
+                                               result_cache=result_cache)
+        elif task_type_identifier == scalems.function.FunctionTask.identifier():
+            result = await _execute_function(source_context, item,
+                                             scheduler=scheduler,
+                                             executors=executors)
+        elif task_type_identifier == scalems.control.WhileLoopTask.identifier():
+            result = await _execute_while_loop(source_context, item)
+        else:
+            raise MissingImplementationError('Executor does not have an implementation for {}'.format(str(task_type_identifier)))
+    except Exception as e:
+        logger.debug('Setting exception for {}'.format(str(item)))
+        item.set_exception(e)
+        raise
+    else:
+        # TODO: Use abstract results handler.
+        logger.debug('Setting result for {}'.format(str(item)))
+        item.set_result(result)
+    finally:
+        # Release subscribers, even if the subprocess did not run.
+        for stream in item.subscribed_streams().values():
+            stream.close()
+
+
+def _input_files(input_record: scalems.subprocess.SubprocessInput) -> typing.List[pathlib.Path]:
+    """Get the paths of the files read by a subprocess task.
+
+    These are the *stdin* file, the *inputs* files, and the output files of the
+    workflow items referenced in *inputs*.
+    """
+    files = []
+    if isinstance(input_record.stdin, (str, os.PathLike)):
+        files.append(pathlib.Path(input_record.stdin))
+    for key, value in input_record.inputs.items():
+        for candidate in value if isinstance(value, (list, tuple)) else (value,):
+            if isinstance(candidate, scalems.context.ItemView):
+                result = candidate.result()
+                files.extend(pathlib.Path(path) for path in getattr(result, 'file', {}).values())
+            elif isinstance(candidate, (str, os.PathLike)):
+                files.append(pathlib.Path(candidate))
+    return files
+
+
+async def _execute_subprocess(source_context: AsyncWorkflowManager, item: scalems.context.Task,
+                              scheduler: Scheduler = None,
+                              result_cache: ResultCache = None) -> scalems.subprocess.SubprocessResult:
+    task_type = scalems.subprocess.SubprocessTask()
+
+    # TODO: Use abstract input factory.
+    logger.debug('Resolving input for {}'.format(str(item)))
+    input_type = task_type.input_type()
+    input_record = input_type(**item.input)
+
+    loop = asyncio.get_running_loop()
+    workdir = source_context.task_directory(item.uid())
+    result = None
+    if result_cache is not None:
+        # Results depend on the contents of the input files, too.
+        result_key = await loop.run_in_executor(None, cache_key, item.uid(), _input_files(input_record))
+        restore = functools.partial(result_cache.restore, result_key,
+                                    workdir=workdir,
+                                    stdout=input_record.stdout,
+                                    stderr=input_record.stderr)
+        result = await loop.run_in_executor(None, restore)
+        if result is not None:
+            logger.info('Using cached result for {}.'.format(item.uid().hex()))
+
+    if result is None:
+        if scheduler is None:
+            allocation = _unscheduled()
+        else:
+            allocation = scheduler.allocate(cores_required(input_record.resources))
+        async with allocation:
+            input_resources = operations.input_resource_scope(context=source_context,
+                                                              task_input=input_record,
+                                                              directory=workdir)
             # We need to provide a scope in which we guarantee the availability of resources,
             # such as temporary files provided for input, or other internally-generated
             # asyncio entities.
+            # Only capture output through pipes if it has subscribers.
+            streams = None
+            if source_context.stream_output:
+                streams = {name: stream for name, stream in item.subscribed_streams().items()
+                           if name in ('stdout', 'stderr')}
             async with input_resources as subprocess_input:
                 logger.debug('Creating coroutine for {}'.format(task_type.__class__.__name__))
                 # TODO: Use abstract task factory.
-                coroutine = operations.subprocessCoroutine(subprocess_input)
-                logger.debug('Creating asyncio Task for {}'.format(repr(coroutine)))
-                awaitable = asyncio.create_task(coroutine)
-
-                # TODO: Use abstract results handler.
-                logger.debug('Waiting for task to complete.')
-                result = await awaitable
-                subprocess_exception = awaitable.exception()
-                if subprocess_exception is not None:
-                    logger.exception('subprocess task raised exception {}'.format(str(subprocess_exception)))
-                    raise subprocess_exception
-                logger.debug('Setting result for {}'.format(str(item)))
-                item.set_result(result)
-        finally:
-            logger.debug('Releasing "{}" from command queue.'.format(str(command)))
-            command_queue.task_done()
+                result = await operations.subprocessCoroutine(subprocess_input, streams=streams)
+            # Provide the declared output files (relative to the task directory).
+            for key, path in input_record.outputs.items():
+                if isinstance(path, (str, os.PathLike)):
+                    path = workdir / path
+                    if path.exists():
+                        result.file[key] = path
+
+        if result_cache is not None and result.exitcode == 0:
+            store = functools.partial(result_cache.store, result_key, result, workdir=workdir)
+            try:
+                await loop.run_in_executor(None, store)
+            except OSError as e:
+                logger.warning('Could not cache result for {}: {}'.format(item.uid().hex(), str(e)))
+    return result
+
+
+async def _execute_ensemble(source_context: AsyncWorkflowManager, item: scalems.context.Task,
+                            scheduler: Scheduler = None) -> scalems.subprocess.EnsembleSubprocessResult:
+    """Launch the members of a (N,) shaped Subprocess task.
+
+    Members share the input of the task, and are scheduled individually, so
+    they run concurrently as resources allow. Member *i* executes in the
+    subdirectory ``str(i)`` of the task directory. All members are awaited
+    before the first failure (if any) is raised.
+
+    Ensemble results are not cached, and output is not streamed.
+    """
+    input_record = scalems.subprocess.SubprocessInput(**item.input)
+    directory = source_context.task_directory(item.uid())
+    num_members = item.description().shape()[0]
+    cores = cores_required(input_record.resources)
+
+    async def launch(member: int) -> int:
+        if scheduler is None:
+            allocation = _unscheduled()
+        else:
+            allocation = scheduler.allocate(cores)
+        async with allocation:
+            input_resources = operations.input_resource_scope(context=source_context,
+                                                              task_input=input_record,
+                                                              directory=directory / str(member),
+                                                              member=member)
+            async with input_resources as subprocess_input:
+                result = await operations.subprocessCoroutine(subprocess_input)
+        return result.exitcode
+
+    exitcodes = await asyncio.gather(*(launch(member) for member in range(num_members)),
+                                     return_exceptions=True)
+    for exitcode in exitcodes:
+        if isinstance(exitcode, BaseException):
+            raise exitcode
+    return scalems.subprocess.EnsembleSubprocessResult(directory=directory,
+                                                       exitcode=exitcodes,
+                                                       stdout=pathlib.Path(input_record.stdout),
+                                                       stderr=pathlib.Path(input_record.stderr))
+
+
+def _resolve(source_context: AsyncWorkflowManager, value):
+    """Replace reference records in *value* with the referenced results."""
+    if isinstance(value, dict):
+        if 'reference' in value and set(value.keys()) <= {'reference', 'output'}:
+            result = source_context.item(bytes.fromhex(value['reference'])).result()
+            if 'output' in value:
+                name = value['output']
+                if isinstance(result, typing.Mapping):
+                    return result[name]
+                return getattr(result, name)
+            return result
+        return {key: _resolve(source_context, element) for key, element in value.items()}
+    if isinstance(value, list):
+        return [_resolve(source_context, element) for element in value]
+    return value
+
+
+async def _execute_function(source_context: AsyncWorkflowManager, item: scalems.context.Task,
+                            scheduler: Scheduler = None,
+                            executors: typing.Mapping[str, concurrent.futures.Executor] = None):
+    """Call a wrapped function according to its execution hint.
+
+    ``inline`` functions are called directly in the event loop thread. Otherwise,
+    the function occupies one core of the *scheduler* pool while it executes in
+    the ``thread`` or ``process`` pool from *executors*.
+    """
+    task_input = scalems.function.FunctionInput(**item.input)
+    args = _resolve(source_context, task_input.args)
+    kwargs = _resolve(source_context, task_input.kwargs)
+    call = functools.partial(scalems.function.call, task_input.function, args, kwargs, task_input.outputs)
+    if task_input.execution == 'inline':
+        logger.debug('Calling {} for {} in the event loop'.format(task_input.function, item.uid().hex()))
+        return call()
+    if task_input.execution not in ('thread', 'process'):
+        raise DispatchError('Unknown execution hint {} for {}.'.format(task_input.execution, item.uid().hex()))
+    if executors is None:
+        pool = None
+    else:
+        pool = executors.get(task_input.execution, None)
+    if scheduler is None:
+        allocation = _unscheduled()
+    else:
+        allocation = scheduler.allocate(1)
+    loop = asyncio.get_running_loop()
+    async with allocation:
+        logger.debug('Calling {} for {}'.format(task_input.function, item.uid().hex()))
+        return await loop.run_in_executor(pool, call)
+
+
+async def _await_value(source_context: AsyncWorkflowManager, value):
+    """Wait for the workflow items referenced by *value*, then resolve it."""
+    dependencies = list()
+    value = scalems.function._normalize(value, dependencies)
+    for dependency in dependencies:
+        upstream = source_context.item(dependency)
+        if not upstream.done():
+            await upstream.wait()
+        if upstream.exception() is not None:
+            raise DispatchError('Dependency {} failed.'.format(dependency.hex()))
+    return _resolve(source_context, value)
+
+
+def _release_iterations(source_context: AsyncWorkflowManager,
+                        iterations: typing.Deque[typing.Tuple[typing.List[bytes], typing.List[bytes]]],
+                        bindings: dict,
+                        retained: typing.Counter[bytes]):
+    """Release the items of loop iterations that are no longer referenced.
+
+    The oldest iteration in *iterations* expires once the next iteration is done.
+    Its references to held items are removed (see `AsyncWorkflowManager.hold()`),
+    except for items that are still used by later iterations or by the current
+    variable *bindings*, or needed by unfinished items. Such references are
+    moved to *retained* and removed when the items are no longer needed.
+    Items shared with other loops remain until all of their references are removed.
+    """
+    while len(iterations) > 1 and all(source_context.item(uid).done() for uid in iterations[1][0]):
+        _, expired = iterations.popleft()
+        referenced = list()
+        scalems.function._normalize(bindings, referenced)
+        keep = set(referenced)
+        for uids, _ in iterations:
+            for uid in uids:
+                keep.add(uid)
+                successor = source_context.item(uid)
+                if not successor.done():
+                    keep.update(successor.dependencies())
+        retained.update(expired)
+        for uid in list(retained):
+            if uid not in keep:
+                for _ in range(retained.pop(uid)):
+                    source_context.unhold(uid)
+
+
+async def _execute_while_loop(source_context: AsyncWorkflowManager, item: scalems.context.Task) -> dict:
+    """Extend the workflow with iterations of a subgraph while the loop condition holds.
+
+    Each iteration is added when the condition for the previous iteration has
+    been resolved, and does not wait for the rest of the previous iteration.
+    Items of earlier iterations are released from the workflow as soon as they
+    are no longer referenced, so the size of the workflow does not grow with
+    the number of iterations.
+
+    Each iteration holds a reference to the items it adds, and to equivalent items
+    held by other loops, so loops over the same subgraph can share items.
+
+    Returns:
+        The values of the subgraph variables after the final iteration.
+    """
+    task_input = scalems.control.WhileLoopInput(**item.input)
+    subgraph = scalems.control.lookup(task_input.subgraph)
+    bindings = subgraph.bind(source_context, task_input.variables)
+    # For each unreleased iteration (oldest first): the items used and the items held.
+    iterations = collections.deque()
+    # References to held items of expired iterations that are still needed.
+    retained = collections.Counter()
+    try:
+        for iteration in range(task_input.max_iteration):
+            # A condition without an initial value is first evaluated after the first iteration.
+            if task_input.condition in bindings:
+                condition = await _await_value(source_context, bindings[task_input.condition])
+                if bool(condition) == task_input.negate:
+                    break
+            logger.debug('Adding iteration {} of {}.'.format(iteration, item.uid().hex()))
+            bindings, uids, added = subgraph.instantiate(source_context, bindings)
+            added = set(added)
+            held = [uid for uid in dict.fromkeys(uids) if uid in added or source_context.held(uid)]
+            for uid in held:
+                source_context.hold(uid)
+            iterations.append((uids, held))
+            _release_iterations(source_context, iterations, bindings, retained)
+        values = dict()
+        for name, value in bindings.items():
+            values[name] = await _await_value(source_context, value)
+        for uids, _ in iterations:
+            for uid in uids:
+                await _await_value(source_context, scalems.context.ItemView(source_context, uid))
+    finally:
+        for _, held in iterations:
+            retained.update(held)
+        for uid, count in retained.items():
+            for _ in range(count):
+                source_context.unhold(uid)
+    return values
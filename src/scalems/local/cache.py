@@ -0,0 +1,256 @@
+"""Persistent storage of local task results.
+
+A ResultCache maps task uids (see :py:meth:`scalems.subprocess.Subprocess.uid`)
+to the results and output artifacts of successfully completed tasks, so that
+byte-identical work does not need to be executed again.
+
+Directory layout::
+
+    <directory>/
+        <uid hex>/
+            result.json
+            stdout
+            stderr
+            file-0
+            ...
+
+Entries are written to a temporary directory and renamed into place, so
+readers never see partial entries. The modification time of ``result.json`` is
+updated when an entry is used, and is the basis for eviction.
+
+Eviction scans the cache directory, so it is not performed for every new entry.
+The cache keeps a running total of the size of the entries it adds, and scans
+when the total exceeds *max_bytes* (removing entries until the size is below a
+low-water mark) or when *max_age* has passed since the last scan.
+
+Task uids identify input files by their paths, not their contents. Results of
+tasks with input files are stored under a key that also covers the contents of
+the files. See :py:func:`cache_key`.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+import typing
+
+import scalems.subprocess
+from scalems.exceptions import DispatchError
+
+logger = logging.getLogger(__name__)
+logger.debug('Importing {}'.format(__name__))
+
+_record_name = 'result.json'
+
+# Fraction of *max_bytes* to which an oversize cache is reduced.
+_low_water = 0.75
+
+
+def _relative(path, workdir) -> str:
+    """Express *path* relative to *workdir* if it is located within *workdir*."""
+    path = os.path.abspath(path)
+    relative = os.path.relpath(path, workdir)
+    if relative.startswith(os.pardir):
+        return path
+    return relative
+
+
+def cache_key(uid: bytes, files: typing.Iterable[typing.Union[str, os.PathLike]] = ()) -> bytes:
+    """Get the cache key for task *uid* reading the given input *files*.
+
+    The key is *uid* if there are no input files. Otherwise, it is a 256-bit digest
+    of *uid* and the paths and contents of the files (in the given order), so that
+    a changed input file does not produce the result of the earlier contents.
+    Missing files contribute only their paths.
+    """
+    files = list(files)
+    if len(files) == 0:
+        return uid
+    digest = hashlib.sha256(uid)
+    for path in files:
+        path = os.path.abspath(path)
+        digest.update(os.fsencode(path) + b'\0')
+        try:
+            with open(path, 'rb') as fh:
+                content = hashlib.sha256()
+                for block in iter(lambda: fh.read(1 << 20), b''):
+                    content.update(block)
+        except FileNotFoundError:
+            digest.update(b'missing\0')
+        else:
+            digest.update(content.digest())
+    return digest.digest()
+
+
+class ResultCache:
+    """Directory-backed store of SubprocessResults keyed by task uid.
+
+    For tasks with input files, use the key from :py:func:`cache_key` in place
+    of the task uid.
+
+    Arguments:
+        directory: Filesystem location for the cache. Created if necessary.
+        max_bytes: Evict least recently used entries to keep total size below this limit.
+        max_age: Evict entries that have not been used for this many seconds.
+
+    Output artifacts are the standard output and standard error files and the
+    declared *outputs* files (the *file* member of the SubprocessResult).
+
+    Not thread-safe, but individual operations are safe to call from a worker
+    thread (e.g. with `loop.run_in_executor()`) and multiple processes may
+    share a cache directory.
+    """
+    def __init__(self, directory: typing.Union[str, os.PathLike], *,
+                 max_bytes: int = None,
+                 max_age: float = None):
+        self.directory = pathlib.Path(os.path.abspath(directory))
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # Estimated size of the cache (updated by scans and by `store()`).
+        self._usage = None
+        self._last_scan = None
+
+    def _entry(self, uid: bytes) -> pathlib.Path:
+        return self.directory / uid.hex()
+
+    def __contains__(self, uid: bytes) -> bool:
+        return os.path.exists(self._entry(uid) / _record_name)
+
+    def store(self, uid: bytes, result: scalems.subprocess.SubprocessResult, *, workdir):
+        """Add the *result* for task *uid*, copying its output artifacts.
+
+        Artifact locations are recorded relative to the task working directory,
+        *workdir*, where possible.
+        """
+        entry = self._entry(uid)
+        if os.path.exists(entry):
+            return
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='.staging-')
+        try:
+            record = {
+                'exitcode': result.exitcode,
+                'stdout': _relative(result.stdout, workdir),
+                'stderr': _relative(result.stderr, workdir),
+                'file': {}
+            }
+            shutil.copyfile(result.stdout, os.path.join(staging, 'stdout'))
+            shutil.copyfile(result.stderr, os.path.join(staging, 'stderr'))
+            for i, (key, path) in enumerate(result.file.items()):
+                artifact = 'file-{}'.format(i)
+                shutil.copyfile(path, os.path.join(staging, artifact))
+                record['file'][key] = {'path': _relative(path, workdir), 'artifact': artifact}
+            with open(os.path.join(staging, _record_name), 'w') as fh:
+                json.dump(record, fh)
+            size = sum(f.stat().st_size for f in os.scandir(staging))
+            try:
+                os.rename(staging, entry)
+            except OSError:
+                # Another writer got here first.
+                if not os.path.exists(entry):
+                    raise
+        finally:
+            if os.path.exists(staging):
+                shutil.rmtree(staging)
+        if self._usage is not None:
+            self._usage += size
+        if self._eviction_due():
+            self.evict()
+
+    def _eviction_due(self) -> bool:
+        if self.max_age is None and self.max_bytes is None:
+            return False
+        if self._usage is None:
+            return True
+        if self.max_bytes is not None and self._usage > self.max_bytes:
+            return True
+        return self.max_age is not None and time.time() - self._last_scan > self.max_age
+
+    def restore(self, uid: bytes, *, workdir, stdout, stderr) -> typing.Optional[scalems.subprocess.SubprocessResult]:
+        """Get the cached result for task *uid*, if available.
+
+        Output artifacts are copied back to *stdout*, *stderr*, and the recorded
+        output file locations (interpreted relative to *workdir*).
+
+        Returns:
+            SubprocessResult describing the restored artifacts, or None if *uid* is not in the cache.
+        """
+        entry = self._entry(uid)
+        try:
+            with open(entry / _record_name, 'r') as fh:
+                record = json.load(fh)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable cache entry {}: {}'.format(uid.hex(), str(e)))
+            return None
+        try:
+            stdout = pathlib.Path(os.path.join(workdir, stdout))
+            stderr = pathlib.Path(os.path.join(workdir, stderr))
+            os.makedirs(stdout.parent, exist_ok=True)
+            os.makedirs(stderr.parent, exist_ok=True)
+            shutil.copyfile(entry / 'stdout', stdout)
+            shutil.copyfile(entry / 'stderr', stderr)
+            files = dict()
+            for key, artifact in record['file'].items():
+                path = pathlib.Path(os.path.join(workdir, artifact['path']))
+                os.makedirs(path.parent, exist_ok=True)
+                shutil.copyfile(entry / artifact['artifact'], path)
+                files[key] = path
+        except FileNotFoundError as e:
+            # The entry may have been evicted while we were reading it.
+            logger.debug('Cache entry {} disappeared: {}'.format(uid.hex(), str(e)))
+            return None
+        except OSError as e:
+            raise DispatchError('Could not restore cached results for {}.'.format(uid.hex())) from e
+        # Mark the entry as recently used.
+        try:
+            os.utime(entry / _record_name)
+        except OSError:
+            pass
+        logger.debug('Restored cached result for {}.'.format(uid.hex()))
+        return scalems.subprocess.SubprocessResult(exitcode=record['exitcode'],
+                                                   stdout=stdout,
+                                                   stderr=stderr,
+                                                   file=files)
+
+    def evict(self):
+        """Remove entries according to the *max_age* and *max_bytes* limits.
+
+        If the cache exceeds *max_bytes*, least recently used entries are removed
+        until it is below 75% of *max_bytes*, so that eviction is not repeated
+        for each new entry.
+        """
+        if self.max_age is None and self.max_bytes is None:
+            return
+        now = time.time()
+        entries = []
+        with os.scandir(self.directory) as it:
+            for dir_entry in it:
+                if dir_entry.name.startswith('.') or not dir_entry.is_dir():
+                    continue
+                try:
+                    last_used = os.stat(os.path.join(dir_entry.path, _record_name)).st_mtime
+                    size = sum(f.stat().st_size for f in os.scandir(dir_entry.path))
+                except OSError:
+                    continue
+                entries.append((last_used, size, dir_entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        limit = None
+        if self.max_bytes is not None and total > self.max_bytes:
+            limit = _low_water * self.max_bytes
+        for last_used, size, path in entries:
+            expired = self.max_age is not None and now - last_used > self.max_age
+            oversize = limit is not None and total > limit
+            if not (expired or oversize):
+                continue
+            logger.debug('Evicting cache entry {}.'.format(path))
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        self._usage = total
+        self._last_scan = now
@@ -0,0 +1,133 @@
+"""Dependency tracking for local workflow execution.
+
+The DependencyIndex determines which workflow items are ready to be dispatched,
+so that the executor only receives items whose inputs are available.
+"""
+
+import logging
+import typing
+
+from scalems.exceptions import DuplicateKeyError, ProtocolError
+
+logger = logging.getLogger(__name__)
+logger.debug('Importing {}'.format(__name__))
+
+
+class DependencyIndex:
+    """Incrementally maintained index of the dependencies between workflow items.
+
+    For each item, the index keeps the list of items that depend on it (its
+    successors) and the number of its dependencies that are not yet complete
+    (its in-degree). Items are *ready* when their in-degree is zero, until they
+    are marked complete.
+
+    Adding an item costs O(number of dependencies), and completing an item
+    costs O(number of successors), regardless of the size of the graph.
+    Since items only become ready after all of their dependencies are complete,
+    the order in which items become ready is a topological order of the graph.
+
+    Dependencies do not need to be indexed before their successors. An item
+    that depends on an item that has not been added remains waiting until
+    the dependency is added and completed.
+
+    Example::
+
+        index = DependencyIndex()
+        index.add(b'a', ())  # True: ready
+        index.add(b'b', (b'a',))  # False: waiting
+        index.complete(b'a')  # [b'b']
+
+    Warning:
+        Not thread-safe.
+    """
+    def __init__(self):
+        # Map items to the items that depend on them.
+        self._successors: typing.Dict[bytes, typing.List[bytes]] = dict()
+        # Number of incomplete dependencies of each incomplete item.
+        self._indegree: typing.Dict[bytes, int] = dict()
+        # Ready and incomplete items, in the order in which they became ready.
+        # (A dict serves as an insertion-ordered set.)
+        self._ready: typing.Dict[bytes, None] = dict()
+        self._completed = set()
+
+    def __len__(self):
+        return len(self._indegree) + len(self._completed)
+
+    def __contains__(self, uid: bytes):
+        return uid in self._indegree or uid in self._completed
+
+    def add(self, uid: bytes, dependencies: typing.Iterable[bytes]) -> bool:
+        """Add the item *uid*, which depends on the items in *dependencies*.
+
+        Returns:
+            True if the item is ready.
+        """
+        if uid in self:
+            raise DuplicateKeyError('{} is already indexed.'.format(uid.hex()))
+        completed = self._completed
+        successors = self._successors
+        indegree = 0
+        for dependency in set(dependencies):
+            if dependency not in completed:
+                indegree += 1
+                if dependency in successors:
+                    successors[dependency].append(uid)
+                else:
+                    successors[dependency] = [uid]
+        self._indegree[uid] = indegree
+        if indegree == 0:
+            self._ready[uid] = None
+            return True
+        return False
+
+    def complete(self, uid: bytes) -> typing.List[bytes]:
+        """Mark the item *uid* complete.
+
+        Items are complete when they are done, whether or not they succeeded.
+        (Successors of failed items are released so that the executor can
+        report the failure for them.)
+
+        Returns:
+            The items that became ready, in the order in which they were added.
+        """
+        if uid in self._completed:
+            return []
+        self._completed.add(uid)
+        self._ready.pop(uid, None)
+        self._indegree.pop(uid, None)
+        ready = list()
+        indegree = self._indegree
+        for successor in self._successors.pop(uid, ()):
+            if successor not in indegree:
+                # The successor was completed without waiting for its dependencies.
+                continue
+            indegree[successor] -= 1
+            if indegree[successor] == 0:
+                self._ready[successor] = None
+                ready.append(successor)
+        return ready
+
+    def discard(self, uid: bytes):
+        """Remove the complete item *uid* from the index.
+
+        Items added later that depend on *uid* wait for it to be added and
+        completed again.
+        """
+        if uid in self._indegree:
+            raise ProtocolError('Cannot discard incomplete item {}.'.format(uid.hex()))
+        self._completed.discard(uid)
+
+    def ready(self) -> typing.List[bytes]:
+        """Get the items that are ready and not complete.
+
+        Items are listed in the order in which they became ready.
+        """
+        return list(self._ready)
+
+    def ready_count(self) -> int:
+        """Get the number of items that are ready and not complete."""
+        return len(self._ready)
+
+    def waiting(self) -> int:
+        """Get the number of items that are waiting for incomplete dependencies."""
+        return len(self._indegree) - len(self._ready)
@@ -3,18 +3,24 @@ Specialize implementations of ScaleMS operations.
 
 """
 import asyncio
+import codecs
 import contextlib
 import dataclasses
 import inspect
+import logging
 import os
 import pathlib
 import shutil
 import tempfile
 import typing
 
+import scalems.context
 import scalems.subprocess
 from scalems.exceptions import DispatchError, InternalError
 
+logger = logging.getLogger(__name__)
+logger.debug('Importing {}'.format(__name__))
+
 
 @dataclasses.dataclass
 class SubprocessInput:
@@ -25,13 +31,75 @@ class SubprocessInput:
     stdout: typing.Union[None, typing.TextIO]
     stderr: typing.Union[None, typing.TextIO]
     env: typing.Union[None, typing.Mapping[str, str]]
+    cwd: typing.Union[None, pathlib.Path] = None
+
+
+# Command line flags for the process count of supported task launchers.
+_launcher_process_flags = {
+    'mpiexec': '-n',
+    'mpirun': '-n',
+    'srun': '-n',
+}
+
+
+def launcher_argv(resources: typing.Mapping[str, typing.Any]) -> typing.List[str]:
+    """Get the command line prefix for the *launcher* named in *resources*.
+
+    Tasks that do not name a launcher (or name the ``exec`` launcher) are
+    executed directly, and produce an empty prefix.
+    """
+    launcher = resources.get('launcher', None)
+    if launcher is None or launcher == 'exec':
+        return []
+    name = os.path.basename(launcher)
+    if name not in _launcher_process_flags:
+        raise DispatchError('No local support for launcher {}.'.format(launcher))
+    procs_per_task = int(resources.get('procs_per_task', 1))
+    return [launcher, _launcher_process_flags[name], str(procs_per_task)]
+
 
+# Maximum number of bytes to transfer at a time when capturing output through a pipe.
+_stream_chunk_size = 1 << 16
 
-async def subprocessCoroutine(signature: SubprocessInput):
+
+async def _capture(reader: asyncio.StreamReader, sink: typing.BinaryIO, stream: scalems.context.OutputStream):
+    """Copy *reader* to the *sink* file and deliver complete lines to *stream*.
+
+    Data is written through to *sink* in the (large) chunks in which it is read,
+    while line splitting is only performed for the subscribers of *stream*.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    try:
+        while True:
+            chunk = await reader.read(_stream_chunk_size)
+            if not chunk:
+                break
+            sink.write(chunk)
+            *lines, pending = (pending + decoder.decode(chunk)).split('\n')
+            if len(lines) > 0:
+                stream.feed(line + '\n' for line in lines)
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            stream.feed((pending,))
+        sink.flush()
+    finally:
+        stream.close()
+
+
+async def subprocessCoroutine(signature: SubprocessInput,
+                              streams: typing.Mapping[str, scalems.context.OutputStream] = None):
     """Implement Subprocess in the local execution context.
 
     Use this coroutine as the basis for a Task that will provide the Future[SubprocessResult] interface.
+
+    If *streams* are provided for ``stdout`` and/or ``stderr``, the corresponding
+    output is read from a pipe while the process runs. The output is written
+    through to the file provided by *signature* and delivered line by line to
+    the stream. Otherwise, the process writes directly to the file.
     """
+    if streams is None:
+        streams = {}
     kwargs = {
 
         'stdin': signature.stdin,
@@ -52,10 +120,18 @@ async def subprocessCoroutine(signature: SubprocessInput):
         os.fsencode(signature.program),
         *signature.args,
         stdin=signature.stdin,
-        stdout=signature.stdout,
-        stderr=signature.stderr,
-        env=signature.env
+        stdout=asyncio.subprocess.PIPE if 'stdout' in streams else signature.stdout,
+        stderr=asyncio.subprocess.PIPE if 'stderr' in streams else signature.stderr,
+        env=signature.env,
+        cwd=signature.cwd
     )
+    readers = []
+    if 'stdout' in streams:
+        readers.append(_capture(process.stdout, signature.stdout.buffer, streams['stdout']))
+    if 'stderr' in streams:
+        readers.append(_capture(process.stderr, signature.stderr.buffer, streams['stderr']))
+    # Drain the pipes before waiting for the process so that it cannot block on a full pipe.
+    await asyncio.gather(*readers)
     returncode = await process.wait()
 
     # TODO: How to do the output file staging?
@@ -65,14 +141,36 @@ async def subprocessCoroutine(signature: SubprocessInput):
     return result
 
 
+def task_directory(root: typing.Union[str, os.PathLike], uid: bytes) -> pathlib.Path:
+    """Get the working directory for the task identified by *uid*.
+
+    Each task executes in its own directory, named by the hexadecimal
+    representation of the task uid, within the *root* directory.
+    """
+    return pathlib.Path(os.path.abspath(root)) / uid.hex()
+
+
 @contextlib.asynccontextmanager
-async def input_resource_scope(context, task_input: typing.Union[scalems.subprocess.SubprocessInput, typing.Awaitable[scalems.subprocess.SubprocessInput]]):
+async def input_resource_scope(context,
+                               task_input: typing.Union[scalems.subprocess.SubprocessInput, typing.Awaitable[scalems.subprocess.SubprocessInput]],
+                               *,
+                               directory: typing.Union[str, os.PathLike],
+                               member: int = None):
     """Manage the actual execution context of the asyncio.subprocess.Process.
 
     Translate a scalems.subprocess.SubprocessInput to a local SubprocessInput instance.
 
     InputResource factory for *subprocess* based implementations.
 
+    The subprocess executes in a private working *directory* (see `task_directory()`),
+    which is created when entering the scope. Relative *stdout* and *stderr* paths
+    are interpreted relative to *directory*. Staged input (such as the file
+    providing *stdin*) is removed when leaving the scope. If the scope exits with
+    an exception, the directory is removed.
+
+    For a *member* of an ensemble task, the member index is provided to the
+    subprocess in the ``SCALEMS_ENSEMBLE_MEMBER`` environment variable.
+
     TODO: How should this be composed in terms of the context and (local) resource type?
     """
     # Await the inputs.
@@ -84,65 +182,78 @@ async def input_resource_scope(context, task_input: typing.Union[scalems.subproc
     # TODO: What sort of validation or normalization do we want to do for the executable name?
     if not isinstance(task_input, scalems.subprocess.SubprocessInput):
         raise InternalError('Unexpected input type.')
-    program = pathlib.Path(shutil.which(task_input.argv[0]))
+    argv = launcher_argv(task_input.resources) + list(task_input.argv)
+    executable = shutil.which(argv[0])
+    if executable is None:
+        raise DispatchError('Could not find executable {}.'.format(argv[0]))
+    program = pathlib.Path(executable)
     if not program.exists():
         raise InternalError('Could not find executable. Input should be vetted before this point.')
-    args = list(str(arg) for arg in task_input.argv[1:])
-
-    # Warning: If subprocess.Popen receives *env* argument that is not None, it **replaces** the
-    # default environment (a duplicate of the caller's environment). We might want to provide
-    # fancier semantics to copy or reject select variables from the environment or to
-    # dynamically read the default environment at execution time (note that the results of
-    # such an operation would not represent a unique result!)
-    get_env = lambda : None
+    args = list(str(arg) for arg in argv[1:])
 
-    get_stdin = lambda : None
-    if task_input.stdin is not None:
-        # TODO: Strengthen the typing for stdin parameter.
-        if not isinstance(task_input.stdin, (os.PathLike, str, list, tuple)):
+    for stream in ('stdout', 'stderr'):
+        if not isinstance(getattr(task_input, stream), (os.PathLike, str)):
             # Note: this is an internal error indicating a bug in SCALEMS.
-            raise InternalError('No handler for stdin argument of this form.' + repr(task_input.stdin))
-        if isinstance(task_input.stdin, (list, tuple)):
-            # TODO: Assign appropriate responsibility for maintaining filesystem artifacts.
-            infile = 'stdin'
-            with open(infile, 'w') as fp:
-                # Normalize line endings for local environment.
-                fp.writelines([line.rstrip() for line in task_input.stdin])
-        else:
-            infile = task_input.stdin
-        get_stdin = lambda path=os.fsencode(infile): open(os.path.abspath(path), 'r')
-
-    stdout = task_input.stdout
-    if stdout is None:
-        stdout = 'stdout'
-    if not isinstance(task_input.stdout, (os.PathLike, str)):
-        # Note: this is an internal error indicating a bug in SCALEMS.
-        raise InternalError('No handler for stdout argument of this form. ' + repr(task_input.stdout))
-    if os.path.exists(stdout):
-        raise InternalError('Dirty working directory is not recoverable in current implementation.')
-    get_stdout = lambda path=os.path.abspath(stdout) : open(path, 'w')
-
-    stderr = task_input.stderr
-    if stderr is None:
-        stderr = 'stderr'
-    if not isinstance(task_input.stderr, (os.PathLike, str)):
+            raise InternalError('No handler for {} argument of this form. '.format(stream)
+                                + repr(getattr(task_input, stream)))
+    if task_input.stdin is not None and not isinstance(task_input.stdin, (os.PathLike, str, list, tuple)):
+        # TODO: Strengthen the typing for stdin parameter.
         # Note: this is an internal error indicating a bug in SCALEMS.
-        raise InternalError('No handler for stderr argument of this form.' + repr(task_input.stderr))
-    if os.path.exists(stderr):
-        raise InternalError('Dirty working directory is not recoverable in current implementation.')
-    get_stderr = lambda path=os.path.abspath(stderr) : open(path, 'w')
-
-    # Create scoped resources. This depends somewhat on the input.
-    # For each non-None stdio stream, we need to provide an open file-like handle.
-    # Note: there may be a use case for scoped run-time determination of *env*,
-    # but we have not yet allowed for that.
-    with get_stdin() as fh_in, get_stdout() as fh_out, get_stderr() as fh_err:
-        try:
+        raise InternalError('No handler for stdin argument of this form.' + repr(task_input.stdin))
+
+    # The task directory is named for the (content-addressed) task uid, so an
+    # existing directory holds the artifacts of an earlier, incomplete attempt.
+    directory = pathlib.Path(os.path.abspath(directory))
+    if directory.exists():
+        logger.info('Replacing stale task directory {}'.format(directory))
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    staged = []
+
+    try:
+        # Warning: If subprocess.Popen receives *env* argument that is not None, it **replaces** the
+        # default environment (a duplicate of the caller's environment). We might want to provide
+        # fancier semantics to copy or reject select variables from the environment or to
+        # dynamically read the default environment at execution time (note that the results of
+        # such an operation would not represent a unique result!)
+        get_env = lambda : None
+        if member is not None:
+            get_env = lambda : dict(os.environ, SCALEMS_ENSEMBLE_MEMBER=str(member))
+
+        get_stdin = lambda : None
+        if task_input.stdin is not None:
+            if isinstance(task_input.stdin, (list, tuple)):
+                infile = directory / 'stdin'
+                with open(infile, 'w') as fp:
+                    # Normalize line endings for local environment.
+                    fp.writelines([line.rstrip() for line in task_input.stdin])
+                staged.append(infile)
+            else:
+                infile = task_input.stdin
+            get_stdin = lambda path=os.fsencode(infile): open(os.path.abspath(path), 'r')
+
+        get_stdout = lambda path=directory / task_input.stdout: open(path, 'w')
+        get_stderr = lambda path=directory / task_input.stderr: open(path, 'w')
+
+        # Create scoped resources. This depends somewhat on the input.
+        # For each non-None stdio stream, we need to provide an open file-like handle.
+        # Note: there may be a use case for scoped run-time determination of *env*,
+        # but we have not yet allowed for that.
+        with get_stdin() as fh_in, get_stdout() as fh_out, get_stderr() as fh_err:
             # TODO: Create SubprocessInput with a coroutine so that we can yield an awaitable.
-            subprocess_input = SubprocessInput(program, args, stdin=fh_in, stdout=fh_out, stderr=fh_err, env=get_env())
+            subprocess_input = SubprocessInput(program, args,
+                                               stdin=fh_in,
+                                               stdout=fh_out,
+                                               stderr=fh_err,
+                                               env=get_env(),
+                                               cwd=directory)
             # Provide resources to the implementation coroutine.
             yield subprocess_input  # needs to be an awaitable... ?
-        finally:
-            # Clean up scoped resources.
-            # Deliver output files?
-            ...
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    else:
+        # Clean up scoped resources.
+        for path in staged:
+            os.unlink(path)
+
@@ -0,0 +1,112 @@
+"""Resource management for local workflow execution.
+
+The Scheduler owns a pool of processor cores and grants allocations to tasks
+according to their declared resource requirements.
+"""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import typing
+
+from scalems.exceptions import DispatchError
+
+logger = logging.getLogger(__name__)
+logger.debug('Importing {}'.format(__name__))
+
+
+def cores_required(resources: typing.Mapping[str, typing.Any]) -> int:
+    """Get the number of cores needed for a task with the given *resources*.
+
+    Interprets the ``procs_per_task`` and ``threads_per_proc`` keys described
+    for :py:func:`scalems.executable`. Each defaults to 1.
+    """
+    procs_per_task = int(resources.get('procs_per_task', 1))
+    threads_per_proc = int(resources.get('threads_per_proc', 1))
+    if procs_per_task < 1 or threads_per_proc < 1:
+        raise DispatchError('Invalid resource requirements: {}'.format(repr(resources)))
+    return procs_per_task * threads_per_proc
+
+
+class Scheduler:
+    """Grant resource allocations from a fixed pool of cores.
+
+    Tasks request cores with the `allocate()` asynchronous context manager.
+    Requests are granted in submission order when they fit in the free pool.
+    When cores are released, the waiting requests are scanned in order and every
+    request that fits is granted immediately, so small tasks backfill slots that
+    cannot (yet) be used by larger tasks.
+
+    Note that backfilling favors throughput over fairness. A large request may
+    wait for a long time while a stream of small requests keeps the pool busy.
+
+    Not thread-safe. The Scheduler must only be used from within the event loop.
+    """
+    def __init__(self, cores: int = None):
+        if cores is None:
+            cores = os.cpu_count()
+            if cores is None:
+                cores = 1
+        if cores < 1:
+            raise DispatchError('Scheduler needs at least one core.')
+        self._capacity = int(cores)
+        self._available = self._capacity
+        # Waiting requests, as (cores, future) pairs.
+        self._waiting = collections.deque()
+
+    @property
+    def capacity(self) -> int:
+        """Total number of cores managed by the Scheduler."""
+        return self._capacity
+
+    @property
+    def available(self) -> int:
+        """Number of cores not currently allocated."""
+        return self._available
+
+    @contextlib.asynccontextmanager
+    async def allocate(self, cores: int = 1):
+        """Acquire *cores* from the pool for the duration of the context manager.
+
+        Raises:
+            DispatchError if the request can never be satisfied by the pool.
+        """
+        if cores > self._capacity:
+            raise DispatchError(
+                'Task requires {} cores, but only {} are available to the Scheduler.'.format(cores, self._capacity))
+        if cores <= self._available:
+            self._available -= cores
+        else:
+            granted = asyncio.get_running_loop().create_future()
+            request = (cores, granted)
+            self._waiting.append(request)
+            logger.debug('Waiting for {} cores ({} available).'.format(cores, self._available))
+            try:
+                await granted
+            except asyncio.CancelledError:
+                if granted.done() and not granted.cancelled():
+                    # The allocation was granted just before cancellation.
+                    self._release(cores)
+                else:
+                    self._waiting.remove(request)
+                raise
+        try:
+            yield cores
+        finally:
+            self._release(cores)
+
+    def _release(self, cores: int):
+        self._available += cores
+        self._backfill()
+
+    def _backfill(self):
+        for request in list(self._waiting):
+            if self._available == 0:
+                break
+            cores, granted = request
+            if cores <= self._available:
+                self._waiting.remove(request)
+                self._available -= cores
+                granted.set_result(cores)
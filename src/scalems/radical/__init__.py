@@ -30,16 +30,21 @@ import asyncio
 import concurrent.futures
 import contextlib
 import logging
+import json
 import os
+import sys
+import threading
+import uuid
 import warnings
 import weakref
 from concurrent.futures import Future
 from types import TracebackType
-from typing import Any, Callable, Optional, Tuple
+from typing import Any, Callable, List, Optional, Sequence, Tuple
 
 import scalems.context
 from scalems.context import ItemView
-from scalems.exceptions import DispatchError, DuplicateKeyError, MissingImplementationError, ProtocolError
+from scalems.exceptions import DispatchError, DuplicateKeyError, InternalError, MissingImplementationError, \
+    ProtocolError
 
 logger = logging.getLogger(__name__)
 logger.debug('Importing {}'.format(__name__))
@@ -71,41 +76,77 @@ class RPWorkflowContext(scalems.context.WorkflowManager):
         return self.task_map[identifier]
 
     # TODO: Consider allowing the user to provide a rp.Session
-    def __init__(self):
-        # Import locally so that radical.pilot is only a dependency when used.
-        import radical.pilot as rp
+    def __init__(self, *, batch_size: int = 256, batch_interval: float = 0.1,
+                 bundle_size: int = None, bundle_cores: int = 1, bundle_directory: str = None,
+                 pilots: Sequence[dict] = None, config: str = None,
+                 rp=None):
+        """Create a RADICAL Pilot workflow context.
+
+        Pilot descriptions are given by *pilots* (a list of dictionaries) or by
+        the *config* file. See :py:func:`pilot_descriptions`. By default, a single
+        pilot uses one core of ``local.localhost``. Units are placed on the pilot
+        with the most free capacity when they are submitted.
+
+        Task descriptions are submitted to the UnitManager in batches of up to
+        *batch_size* units. A partial batch is submitted *batch_interval* seconds
+        after its first task is added (while dispatching).
+
+        If *bundle_size* is given, single-core tasks are packed into bundles of up to
+        *bundle_size* tasks. Each bundle is one compute unit with *bundle_cores* cores,
+        running :py:mod:`scalems.radical.worker` to execute the tasks concurrently.
+        Bundles are exchanged through files in *bundle_directory* (default:
+        ``scalems_bundles`` in the current working directory), which must be on a
+        filesystem shared with the compute units. A partial bundle is submitted
+        with the next batch.
+
+        *rp* may provide an alternative implementation of the radical.pilot module
+        interface, such as :py:mod:`scalems.radical.fake`.
+        """
+        if rp is None:
+            # Import locally so that radical.pilot is only a dependency when used.
+            import radical.pilot as rp
+            if not 'RADICAL_PILOT_DBURL' in os.environ:
+                raise DispatchError('RADICAL Pilot environment is not available.')
 
         # TODO: Eliminate use cases that require this exposure.
         self.rp = rp
 
         self.__rp_cfg = dict()
-        if not 'RADICAL_PILOT_DBURL' in os.environ:
-            raise DispatchError('RADICAL Pilot environment is not available.')
-
-        resource = 'local.localhost'
-        # TODO: Find default config?
-        resource_config = {resource: {}}
-        # TODO: Get from user or local config files.
-        resource_config[resource].update({
-            'project': None,
-            'queue': None,
-            'schema': None,
-            'cores': 1,
-            'gpus': 0
-        })
-        pilot_description = dict(resource=resource,
-                                 runtime=30,
-                                 exit_on_error=True,
-                                 project=resource_config[resource]['project'],
-                                 queue=resource_config[resource]['queue'],
-                                 cores=resource_config[resource]['cores'],
-                                 gpus=resource_config[resource]['gpus'])
-        self.resource_config = resource_config
-        self.pilot_description = pilot_description
+
+        self.pilot_descriptions = pilot_descriptions(config=config, pilots=pilots)
+        # Map pilot uids to [cores, cores assigned to unfinished units].
+        self._capacity = dict()
+        self._capacity_lock = threading.Lock()
         self.session = None
         self._finalizer = None
         self.umgr = None
 
+        if batch_size < 1:
+            raise ValueError('batch_size must be a positive integer.')
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        # (task description, RPFuture) pairs waiting for submission.
+        self._pending = list()
+        self._flush_handle = None
+        # While dispatching, blocking UnitManager calls run in a single thread
+        # (preserving submission order) instead of in the event loop.
+        self._submitter = None
+        self._submissions = set()  # asyncio Futures of in-flight submissions.
+
+        if bundle_size is not None and bundle_size < 1:
+            raise ValueError('bundle_size must be a positive integer.')
+        self.bundle_size = bundle_size
+        self.bundle_cores = bundle_cores
+        if bundle_directory is None:
+            bundle_directory = os.path.join(os.getcwd(), 'scalems_bundles')
+        self.bundle_directory = bundle_directory
+        # (task description, RPFuture) pairs waiting for a bundle.
+        self._bundle = list()
+        self._bundle_count = 0
+        # Distinguish the bundle files of this context from those of other
+        # (including earlier) workflows in the same directory.
+        self._bundle_token = uuid.uuid4().hex[:12]
+
         # Basic Context implementation details
         self.task_map = dict()  # Map UIDs to task Futures.
 
@@ -140,6 +181,186 @@ class RPWorkflowContext(scalems.context.WorkflowManager):
         self.task_map[uid] = task
         return task
 
+    def submit(self, task_description) -> 'RPFuture':
+        """Queue a ComputeUnitDescription for (batched) submission.
+
+        The returned Future is bound to its ComputeUnit when the batch is
+        submitted. See :py:func:`RPWorkflowContext.flush`.
+        """
+        future = RPFuture(rp=self.rp)
+        if self.bundle_size is not None and task_description.get('cpu_processes', 1) == 1:
+            self._bundle.append((task_description, future))
+            if len(self._bundle) >= self.bundle_size:
+                self._submit_bundle()
+        else:
+            self._pending.append((task_description, future))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        else:
+            self._schedule_flush()
+        return future
+
+    def _schedule_flush(self):
+        if self._flush_handle is not None or self.umgr is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Without an event loop, the queue is flushed when it is full
+            # or when the dispatching context exits.
+            pass
+        else:
+            self._flush_handle = loop.call_later(self.batch_interval, self.flush)
+
+    def _submit_bundle(self):
+        """Queue a compute unit for the bundled tasks."""
+        from . import worker
+        bundle = self._bundle
+        self._bundle = list()
+        if len(bundle) == 0:
+            return
+        os.makedirs(self.bundle_directory, exist_ok=True)
+        name = 'bundle_{}_{}'.format(self._bundle_token, self._bundle_count)
+        self._bundle_count += 1
+        path = os.path.join(self.bundle_directory, name + '.json')
+        results = os.path.join(self.bundle_directory, name + '.results')
+        tasks = list()
+        for i, (description, _) in enumerate(bundle):
+            task_name = description.get('name', None) or '{}_{}'.format(name, i)
+            task = {'name': task_name,
+                    'executable': description['executable'],
+                    'arguments': list(description.get('arguments', ())),
+                    'directory': os.path.join(self.bundle_directory, task_name)}
+            if description.get('environment', None):
+                task['environment'] = dict(description['environment'])
+            tasks.append(task)
+        worker.write_bundle(path, tasks=tasks, cores=self.bundle_cores, results=results)
+        description = self.rp.ComputeUnitDescription({
+            'name': name,
+            'executable': sys.executable,
+            'arguments': ['-m', 'scalems.radical.worker', path],
+            'cpu_processes': self.bundle_cores})
+        bundle_future = RPFuture(rp=self.rp)
+        self._pending.append((description, bundle_future))
+        logger.debug('Bundled {} tasks in {}.'.format(len(tasks), path))
+
+        def resolve(future: RPFuture):
+            # Called in the thread of the RP state callback.
+            reported = worker.read_results(results)
+            for task, (_, task_future) in zip(tasks, bundle):
+                result = reported.get(task['name'], None)
+                if result is None:
+                    if future.exception() is not None:
+                        error = DispatchError('Bundle {} failed: {}'.format(name, future.exception()))
+                    else:
+                        error = DispatchError('No result for task {} in bundle {}.'.format(task['name'], name))
+                    task_future.set_exception(error)
+                elif result['exitcode'] == 0:
+                    task_future.set_result(RPResult())
+                elif result['exitcode'] is None:
+                    task_future.set_exception(DispatchError('Could not launch task {}: {}'.format(
+                        task['name'], result.get('error', ''))))
+                else:
+                    task_future.set_exception(DispatchError('Task {} failed with exit code {}.'.format(
+                        task['name'], result['exitcode'])))
+
+        bundle_future.add_done_callback(resolve)
+
+    def flush(self):
+        """Submit the queued task descriptions with a single UnitManager call.
+
+        In bundling mode, a partial bundle is completed and submitted, too.
+        Queued tasks are kept until the dispatching context provides a UnitManager.
+
+        Within a running event loop (while dispatching), the UnitManager call is
+        made in a separate thread, so that its round trip to the RP components does
+        not block the event loop, and the Futures are bound to their ComputeUnits
+        when the call returns. Otherwise, the call is made directly.
+
+        If the submission fails, the Futures of the submitted tasks are resolved
+        with a DispatchError and the exception is re-raised. For a submission in
+        the background, the exception is logged, and is raised by the dispatching
+        context if the submission is still in flight when the context exits.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self.umgr is None:
+            return
+        self._submit_bundle()
+        if len(self._pending) == 0:
+            return
+        pending = self._pending
+        self._pending = list()
+        logger.debug('Submitting {} RP task(s).'.format(len(pending)))
+        for description, future in pending:
+            self._place(description, future)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or self._submitter is None:
+            self._submit_units(pending)
+        else:
+            submission = loop.run_in_executor(self._submitter, self._submit_units, pending)
+            self._submissions.add(submission)
+            submission.add_done_callback(self._submitted)
+
+    def _submit_units(self, pending: List[Tuple[Any, 'RPFuture']]):
+        """Submit the placed task descriptions and bind their Futures."""
+        try:
+            units = self.umgr.submit_units([description for description, _ in pending])
+            if len(units) != len(pending):
+                raise InternalError('Submitted {} units, but RP returned {}.'.format(len(pending), len(units)))
+        except Exception as e:
+            logger.error('Failed to submit {} RP task(s): {}'.format(len(pending), str(e)))
+            # Note that resolving the Futures also releases their pilot capacity. See _place().
+            for _, future in pending:
+                if not future.done():
+                    error = DispatchError('Could not submit RP task: {}'.format(str(e)))
+                    error.__cause__ = e
+                    future.set_exception(error)
+            raise
+        for unit, (_, future) in zip(units, pending):
+            future.bind(weakref.ref(unit))
+
+    def _submitted(self, submission: asyncio.Future):
+        self._submissions.discard(submission)
+        # Retrieve the exception, so that it is not reported again as unhandled.
+        # The failure has already been logged and reported through the task Futures.
+        if not submission.cancelled():
+            submission.exception()
+
+    def _place(self, description, future: 'RPFuture'):
+        """Assign the unit to the pilot with the most free capacity.
+
+        The pilot with the lowest fraction of its cores assigned (after placing the
+        unit) is chosen, so that oversubscription is spread proportionally to the
+        pilot sizes. Units that already name a pilot are not moved, but are counted.
+        Assigned cores are released when *future* is done.
+        """
+        if len(self._capacity) == 0:
+            return
+        cores = description.get('cpu_processes', 1) or 1
+        with self._capacity_lock:
+            pilot = description.get('pilot', None)
+            if pilot is None:
+                def load(uid):
+                    capacity, assigned = self._capacity[uid]
+                    return (assigned + cores) / capacity, assigned - capacity
+
+                pilot = min(self._capacity, key=load)
+                description['pilot'] = pilot
+            if pilot not in self._capacity:
+                return
+            self._capacity[pilot][1] += cores
+
+        def release(_):
+            with self._capacity_lock:
+                self._capacity[pilot][1] -= cores
+
+        future.add_done_callback(release)
+
     async def run(self, task=None):
         """Run the configured workflow.
 
@@ -151,11 +372,8 @@ class RPWorkflowContext(scalems.context.WorkflowManager):
         """
         if task is not None:
             raise MissingImplementationError('Semantics for run(task) are not yet defined.')
-        # Bypass the need for asyncio.run()
-        # if self.event_loop is None:
-        #     raise RuntimeError('No event loop!')
-        # loop = self.event_loop
-        return await asyncio.wait(self.task_map.values())
+        self.flush()
+        return await asyncio.wait([future.awaitable() for future in self.task_map.values()])
 
     def shutdown(self):
         if self.active():
@@ -181,16 +399,78 @@ class RPWorkflowContext(scalems.context.WorkflowManager):
             self.session = self.rp.Session()
             pmgr = self.rp.PilotManager(session=self.session)
             self.umgr = self.rp.UnitManager(session=self.session)
-            pilot = pmgr.submit_pilots(self.rp.ComputePilotDescription(self.pilot_description))
-            self.umgr.add_pilots(pilot)
-            # Note: We should have an active session now, ready to receive tasks, but
-            # no tasks have been submitted.
-            # TODO: Process the queue of tasks submitted before entering the dispatcher context.
+            pilots = pmgr.submit_pilots([self.rp.ComputePilotDescription(description)
+                                         for description in self.pilot_descriptions])
+            self.umgr.add_pilots(pilots)
+            self._capacity = {pilot.uid: [int(description.get('cores', 1)), 0]
+                              for pilot, description in zip(pilots, self.pilot_descriptions)}
+            self._submitter = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                    thread_name_prefix='scalems_rp_submit')
+            # Note: We should have an active session now, ready to receive tasks.
+            # Submit the tasks added before entering the dispatcher context.
+            self.flush()
             yield self
         finally:
             logger.debug('Awaiting RP tasks.')
-            await asyncio.wait(self.task_map.values())
-            self.shutdown()
+            try:
+                if self.umgr is not None:
+                    self.flush()
+                    # Any submission failure is raised here.
+                    await asyncio.gather(*self._submissions)
+                    # Wait for the RP state callbacks without blocking the event loop.
+                    # Task failures remain available from the task Futures.
+                    await asyncio.gather(*(future.awaitable() for future in self.task_map.values()),
+                                         return_exceptions=True)
+            finally:
+                if self._submitter is not None:
+                    self._submitter.shutdown(wait=True)
+                    self._submitter = None
+                self.shutdown()
+
+
+def pilot_descriptions(config: str = None, pilots: Sequence[dict] = None) -> List[dict]:
+    """Get the pilot descriptions for a RPWorkflowContext.
+
+    *pilots* is a list of (partial) pilot descriptions. Alternatively, *config*
+    names a JSON file containing such a list, or an object with a ``pilots`` list.
+    For example::
+
+        {"pilots": [{"resource": "local.localhost", "cores": 4},
+                    {"resource": "xsede.comet_ssh", "cores": 24, "runtime": 60,
+                     "project": "abc123", "queue": "compute"}]}
+
+    Missing keys get default values. With neither argument, one default pilot is
+    described.
+    """
+    if config is not None:
+        if pilots is not None:
+            raise TypeError('Provide pilot descriptions or a config file, not both.')
+        with open(config, 'r') as fp:
+            pilots = json.load(fp)
+        if isinstance(pilots, dict):
+            pilots = pilots.get('pilots', None)
+        if not isinstance(pilots, list):
+            raise ValueError('{} does not contain a list of pilot descriptions.'.format(config))
+    if pilots is None:
+        pilots = [dict()]
+    elif isinstance(pilots, dict):
+        pilots = [pilots]
+    descriptions = list()
+    for pilot in pilots:
+        description = dict(resource='local.localhost',
+                           runtime=30,
+                           exit_on_error=True,
+                           project=None,
+                           queue=None,
+                           cores=1,
+                           gpus=0)
+        description.update(pilot)
+        if int(description['cores']) < 1:
+            raise ValueError('A pilot needs at least one core: {}'.format(repr(pilot)))
+        descriptions.append(description)
+    if len(descriptions) == 0:
+        raise ValueError('No pilots described.')
+    return descriptions
 
 
 class RPResult:
@@ -203,15 +483,61 @@ class RPResult:
 
 
 class RPFuture(concurrent.futures.Future):
-    """Future interface for RADICAL Pilot tasks."""
+    """Future interface for RADICAL Pilot tasks.
+
+    The Future is resolved from the state callback of its rp ComputeUnit, in
+    whichever thread RP delivers the callback. Coroutines should ``await`` the
+    RPFuture instead of calling :py:func:`~RPFuture.result`: the awaitable is an
+    asyncio.Future that is resolved in its event loop with ``loop.call_soon_threadsafe``,
+    so awaiting one task does not block the event loop or wait on other tasks.
+    """
 
-    def __init__(self, task: weakref.ref) -> None:
-        # Import locally so that radical.pilot is only a dependency when used.
-        import radical.pilot as rp
+    def __init__(self, task: weakref.ref = None, *, rp=None) -> None:
         super().__init__()
+        if rp is None:
+            # Import locally so that radical.pilot is only a dependency when used.
+            import radical.pilot as rp
+        self._rp = rp
+        self._awaitables = dict()  # Map event loops to asyncio Futures.
+        self.task = None
+        if task is not None:
+            self.bind(task)
+
+    def bind(self, task: weakref.ref):
+        """Attach the Future to its (submitted) rp ComputeUnit.
+
+        Subscribe to the state updates of the ComputeUnit.
+        """
+        rp = self._rp
+        if self.task is not None:
+            raise ProtocolError('Future is already bound to a RP task.')
         if not callable(task) or not isinstance(task(), rp.ComputeUnit):
             raise TypeError('Provide a callable that produces the rp ComputeUnit.')
         self.task = task
+        if not self.set_running_or_notify_cancel():
+            return
+        unit = task()
+        unit.register_callback(self._state_callback)
+        # The unit may have reached a final state before we subscribed.
+        self._state_callback(unit, unit.state)
+
+    def _state_callback(self, unit, state, *args):
+        """Resolve the Future when the ComputeUnit reaches a final state.
+
+        Called by RP (generally not in the thread of the event loop).
+        """
+        rp = self._rp
+        if state not in rp.FINAL:
+            return
+        with self._condition:
+            if self.done():
+                return
+            if state == rp.DONE:
+                self.set_result(RPResult())
+            elif state == rp.CANCELED:
+                self.set_exception(DispatchError('RP task {} was canceled.'.format(unit.uid)))
+            else:
+                self.set_exception(DispatchError('RP task {} failed with state {}.'.format(unit.uid, state)))
 
     def cancel(self) -> bool:
         raise MissingImplementationError()
@@ -220,26 +546,32 @@ class RPFuture(concurrent.futures.Future):
         return super().cancelled()
 
     def running(self) -> bool:
-        raise MissingImplementationError()
+        """The ComputeUnit has been submitted and has not reached a final state."""
+        return super().running()
 
     def add_done_callback(self, fn: Callable[[Future], Any]) -> None:
-        # TODO: more complete type hinting.
-        raise MissingImplementationError()
+        """Call *fn* with the Future when it is done.
 
-    def result(self, timeout: Optional[float] = ...) -> RPResult:
-        if not self.done():
-            # Note that task.wait() seems not to work reliably.
-            # TODO: task.umgr.wait_units(uids=taskid)
-            # Warning: Waiting on all units will deadlock in non-trivial cases.
-            task = self.task()
-            task.umgr.wait_units(uids=task.uid, timeout=timeout)
-        return super().result()
+        If the Future is not yet done, *fn* is called in the thread that delivers
+        the RP state callback.
+        """
+        super().add_done_callback(fn)
+
+    def result(self, timeout: Optional[float] = None) -> RPResult:
+        """Wait up to *timeout* seconds for the task result.
+
+        Warning:
+            Do not block the thread of the event loop with this function.
+            Use ``await`` in a coroutine.
+        """
+        return super().result(timeout)
 
     def set_running_or_notify_cancel(self) -> bool:
-        raise MissingImplementationError()
+        return super().set_running_or_notify_cancel()
 
-    def exception(self, timeout: Optional[float] = ...) -> Optional[BaseException]:
-        raise MissingImplementationError()
+    def exception(self, timeout: Optional[float] = None) -> Optional[BaseException]:
+        """Wait up to *timeout* seconds for the task to finish and get its exception (or None)."""
+        return super().exception(timeout)
 
     def set_exception(self, exception: Optional[BaseException]) -> None:
         super().set_exception(exception)
@@ -249,3 +581,34 @@ class RPFuture(concurrent.futures.Future):
 
     def set_exception_info(self, exception: Any, traceback: Optional[TracebackType]) -> None:
         super().set_exception_info(exception, traceback)
+
+    def awaitable(self) -> asyncio.Future:
+        """Get an asyncio.Future for the task in the running event loop.
+
+        One asyncio.Future is created per event loop and reused.
+        """
+        loop = asyncio.get_running_loop()
+        awaitable = self._awaitables.get(loop)
+        if awaitable is None:
+            awaitable = loop.create_future()
+            self._awaitables[loop] = awaitable
+
+            def resolve(future: 'RPFuture'):
+                if awaitable.cancelled():
+                    return
+                exception = future.exception()
+                if exception is None:
+                    awaitable.set_result(future.result())
+                else:
+                    awaitable.set_exception(exception)
+
+            def done_callback(future: 'RPFuture'):
+                # Deliver the result to the event loop thread.
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(resolve, future)
+
+            self.add_done_callback(done_callback)
+        return awaitable
+
+    def __await__(self):
+        return self.awaitable().__await__()
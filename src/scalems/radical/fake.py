@@ -0,0 +1,358 @@
+"""Local stand-in for the parts of radical.pilot used by scalems.radical.
+
+Provides Session, PilotManager, UnitManager, and ComputeUnit implementations
+that run compute units as local subprocesses on worker threads (one worker
+thread per pilot core), so that the scalems side of RADICAL Pilot dispatching
+can be tested and benchmarked without a RADICAL Pilot installation, MongoDB
+instance, or resource allocation.
+
+The costs of the real RP stack can be approximated with injected latencies.
+See :py:class:`Session`.
+
+Example:
+    >>> import scalems.radical
+    >>> import scalems.radical.fake
+    >>> context = scalems.radical.RPWorkflowContext(rp=scalems.radical.fake)
+
+Only the interfaces used by scalems are implemented. Compute unit descriptions
+are plain dictionaries, and only the *executable*, *arguments*, *environment*,
+*sandbox*, and *pilot* keys are used. Each unit occupies one pilot core,
+regardless of *cpu_processes*.
+"""
+
+import concurrent.futures
+import itertools
+import logging
+import os
+import subprocess
+import threading
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+logger.debug('Importing {}'.format(__name__))
+
+# Compute unit states (a subset of the radical.pilot states).
+NEW = 'NEW'
+UMGR_SCHEDULING = 'UMGR_SCHEDULING'
+AGENT_EXECUTING = 'AGENT_EXECUTING'
+DONE = 'DONE'
+FAILED = 'FAILED'
+CANCELED = 'CANCELED'
+FINAL = (DONE, FAILED, CANCELED)
+
+# Pilot states.
+PMGR_ACTIVE = 'PMGR_ACTIVE'
+
+# Default latencies (in seconds) for new Sessions. See :py:class:`Session`.
+submit_latency = 0.
+launch_latency = 0.
+pilot_latency = 0.
+
+
+class ComputePilotDescription(dict):
+    """Pilot description.
+
+    The *cores* key determines the number of worker threads (and concurrently
+    executing compute units) of the pilot.
+    """
+
+
+class ComputeUnitDescription(dict):
+    """Compute unit description."""
+
+
+class Session:
+    """Local session.
+
+    Latencies default to the module attributes of the same names, so that
+    Sessions created by scalems (e.g. in `RPWorkflowContext.dispatch`) can be
+    configured.
+
+    Arguments:
+        submit_latency: Seconds added to each UnitManager.submit_units() call
+            (the round trip to the RP client components).
+        launch_latency: Seconds added before each compute unit is executed
+            (agent scheduling and launch overhead).
+        pilot_latency: Seconds added to each PilotManager.submit_pilots() call.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, *, submit_latency: float = None, launch_latency: float = None, pilot_latency: float = None):
+        self.uid = 'session.{:04d}'.format(next(self._ids))
+        module = globals()
+        self.submit_latency = module['submit_latency'] if submit_latency is None else submit_latency
+        self.launch_latency = module['launch_latency'] if launch_latency is None else launch_latency
+        self.pilot_latency = module['pilot_latency'] if pilot_latency is None else pilot_latency
+        self._pilots = list()
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self):
+        """Stop the pilots of the session.
+
+        Compute units that have not started are canceled. Executing units are
+        allowed to finish.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for pilot in self._pilots:
+            pilot._shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ComputePilot:
+    """A pool of worker threads, one per core."""
+    _ids = itertools.count()
+
+    def __init__(self, session: Session, description: ComputePilotDescription):
+        self.uid = 'pilot.{:04d}'.format(next(self._ids))
+        self.session = session
+        self.description = ComputePilotDescription(description)
+        self.cores = int(self.description.get('cores', 1))
+        if self.cores < 1:
+            raise ValueError('A pilot needs at least one core.')
+        self.state = PMGR_ACTIVE
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.cores,
+                                                               thread_name_prefix=self.uid)
+        self._lock = threading.Lock()
+        self._units = set()
+
+    @property
+    def load(self) -> int:
+        """Number of units assigned to the pilot that have not reached a final state."""
+        with self._lock:
+            return len(self._units)
+
+    def _execute(self, unit: 'ComputeUnit'):
+        with self._lock:
+            self._units.add(unit)
+        unit.pilot = self.uid
+        try:
+            self._executor.submit(self._run, unit)
+        except RuntimeError:
+            # The executor has been shut down.
+            self._finish(unit, CANCELED)
+
+    def _run(self, unit: 'ComputeUnit'):
+        if unit.state in FINAL:
+            # Canceled before execution.
+            self._finish(unit, unit.state)
+            return
+        if self.session.launch_latency > 0:
+            time.sleep(self.session.launch_latency)
+        unit._advance(AGENT_EXECUTING)
+        if unit.state in FINAL:
+            # Canceled during launch.
+            self._finish(unit, unit.state)
+            return
+        description = unit.description
+        argv = [description['executable']] + [str(arg) for arg in description.get('arguments', ())]
+        env = description.get('environment', None)
+        if env is not None:
+            env = dict(os.environ, **env)
+        try:
+            process = subprocess.run(argv,
+                                     stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     cwd=description.get('sandbox', None),
+                                     env=env)
+        except OSError as e:
+            unit.stderr = str(e)
+            self._finish(unit, FAILED)
+            return
+        unit.exit_code = process.returncode
+        unit.stdout = process.stdout.decode(errors='replace')
+        unit.stderr = process.stderr.decode(errors='replace')
+        self._finish(unit, DONE if process.returncode == 0 else FAILED)
+
+    def _finish(self, unit: 'ComputeUnit', state: str):
+        with self._lock:
+            self._units.discard(unit)
+        unit._advance(state)
+
+    def _shutdown(self):
+        # Cancel the units that have not started, so that the worker threads skip them.
+        # (ThreadPoolExecutor.shutdown() has no *cancel_futures* before Python 3.9.)
+        with self._lock:
+            queued = [unit for unit in self._units if unit.state in (NEW, UMGR_SCHEDULING)]
+        for unit in queued:
+            unit._advance(CANCELED)
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            remaining = list(self._units)
+            self._units.clear()
+        for unit in remaining:
+            unit._advance(CANCELED)
+
+
+class PilotManager:
+    def __init__(self, session: Session):
+        self.session = session
+
+    def submit_pilots(self, descriptions):
+        """Start one pilot per description.
+
+        Returns a single pilot for a single description, or a list of pilots.
+        """
+        single = isinstance(descriptions, dict)
+        if single:
+            descriptions = [descriptions]
+        if self.session.closed:
+            raise RuntimeError('Session is closed.')
+        if self.session.pilot_latency > 0:
+            time.sleep(self.session.pilot_latency)
+        pilots = [ComputePilot(self.session, description) for description in descriptions]
+        self.session._pilots.extend(pilots)
+        return pilots[0] if single else pilots
+
+
+class ComputeUnit:
+    """A task executed by a (fake) pilot.
+
+    State callbacks are called with ``(unit, state)`` in the thread that advances
+    the state, which is generally not the thread that submitted the unit.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, umgr: 'UnitManager', description: ComputeUnitDescription):
+        self.uid = 'unit.{:06d}'.format(next(self._ids))
+        self.umgr = umgr
+        self.description = description
+        self.state = NEW
+        self.pilot = None
+        self.exit_code = None
+        self.stdout = None
+        self.stderr = None
+        self._callbacks = list()
+        self._lock = threading.Lock()
+        self._final = threading.Event()
+
+    def register_callback(self, cb: typing.Callable):
+        with self._lock:
+            self._callbacks.append(cb)
+
+    def _advance(self, state: str):
+        with self._lock:
+            if self.state in FINAL:
+                return
+            self.state = state
+            callbacks = list(self._callbacks) + list(self.umgr._callbacks)
+        for cb in callbacks:
+            try:
+                cb(self, state)
+            except Exception as e:
+                logger.exception('State callback for {} raised {}'.format(self.uid, repr(e)))
+        if state in FINAL:
+            self._final.set()
+
+    def wait(self, timeout: float = None):
+        self._final.wait(timeout)
+        return self.state
+
+    def cancel(self):
+        self._advance(CANCELED)
+
+
+class UnitManager:
+    """Assign compute units to pilots.
+
+    A unit description may name a pilot (by uid) with the *pilot* key. Otherwise,
+    the unit is assigned to the pilot with the most free cores.
+    Units submitted before any pilots are added are held until `add_pilots`.
+    """
+    def __init__(self, session: Session):
+        self.session = session
+        self.pilots = dict()
+        self.units = dict()
+        self.submit_count = 0
+        self._callbacks = list()
+        self._held = list()
+
+    def register_callback(self, cb: typing.Callable):
+        """Register a state callback for all units of the UnitManager."""
+        self._callbacks.append(cb)
+
+    def add_pilots(self, pilots):
+        if isinstance(pilots, ComputePilot):
+            pilots = [pilots]
+        for pilot in pilots:
+            self.pilots[pilot.uid] = pilot
+        held = self._held
+        self._held = list()
+        for unit in held:
+            self._schedule(unit)
+
+    def list_pilots(self):
+        return list(self.pilots)
+
+    def _schedule(self, unit: ComputeUnit):
+        if len(self.pilots) == 0:
+            self._held.append(unit)
+            return
+        unit._advance(UMGR_SCHEDULING)
+        name = unit.description.get('pilot', None)
+        if name:
+            if name not in self.pilots:
+                unit.stderr = 'No pilot named {}'.format(name)
+                unit._advance(FAILED)
+                return
+            pilot = self.pilots[name]
+        else:
+            pilot = max(self.pilots.values(), key=lambda p: p.cores - p.load)
+        pilot._execute(unit)
+
+    def submit_units(self, descriptions):
+        """Create compute units.
+
+        Returns a single unit for a single description, or a list of units.
+        """
+        single = isinstance(descriptions, dict)
+        if single:
+            descriptions = [descriptions]
+        if self.session.closed:
+            raise RuntimeError('Session is closed.')
+        self.submit_count += 1
+        if self.session.submit_latency > 0:
+            time.sleep(self.session.submit_latency)
+        units = [ComputeUnit(self, description) for description in descriptions]
+        for unit in units:
+            self.units[unit.uid] = unit
+        for unit in units:
+            self._schedule(unit)
+        return units[0] if single else units
+
+    def get_units(self, uids=None):
+        if uids is None:
+            return list(self.units.values())
+        if isinstance(uids, str):
+            return self.units[uids]
+        return [self.units[uid] for uid in uids]
+
+    def wait_units(self, uids=None, timeout: float = None):
+        """Wait for units to reach a final state.
+
+        Returns the state of each unit.
+        """
+        single = isinstance(uids, str)
+        units = self.get_units([uids] if single else uids)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        states = list()
+        for unit in units:
+            remaining = None if deadline is None else max(0., deadline - time.monotonic())
+            states.append(unit.wait(remaining))
+        return states[0] if single else states
+
+    def cancel_units(self, uids=None):
+        for unit in self.get_units(uids):
+            unit.cancel()
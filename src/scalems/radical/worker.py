@@ -0,0 +1,119 @@
+"""Execute a bundle of subprocess tasks within a single RADICAL Pilot compute unit.
+
+Short tasks are dominated by the RP scheduling and launch overhead of their
+compute units. In bundling mode (see `scalems.radical.RPWorkflowContext`),
+many tasks are packed into one compute unit that runs this worker, which
+executes the tasks concurrently on the cores of the unit.
+
+Usage:
+    python3 -m scalems.radical.worker bundle.json
+
+The bundle file is a JSON object with the keys
+
+* *cores*: the maximum number of concurrently executing tasks,
+* *results*: the path of the results file,
+* *tasks*: a list of objects with the *name*, *executable*, *arguments*,
+  *environment* (optional), and *directory* of each task.
+
+Each task is executed in its *directory* (created, if necessary) with standard
+output and standard error redirected to ``stdout`` and ``stderr`` files.
+As each task finishes, the worker appends a line ``{"name": ..., "exitcode": ...}``
+to the results file, so the client reads the results through the (shared) filesystem.
+Tasks that cannot be launched have an *exitcode* of ``null`` and an *error* message.
+
+The worker exits with status 0 if it was able to attempt every task, regardless
+of the exit codes of the tasks.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import typing
+
+logger = logging.getLogger(__name__)
+logger.debug('Importing {}'.format(__name__))
+
+bundle_version = 'scalems_bundle_1'
+
+
+def write_bundle(path: str, *, tasks: typing.Sequence[dict], cores: int, results: str):
+    """Write a bundle file for `run_bundle`.
+
+    The *results* file is truncated, so that results are not read from an
+    earlier bundle of the same name.
+    """
+    with open(path, 'w') as fp:
+        json.dump({'version': bundle_version, 'cores': cores, 'results': results, 'tasks': list(tasks)}, fp)
+    open(results, 'w').close()
+
+
+def read_results(path: str) -> typing.Dict[str, dict]:
+    """Read the results file of a bundle, mapping task names to results.
+
+    Tasks that did not finish are absent.
+    """
+    results = dict()
+    try:
+        with open(path, 'r') as fp:
+            for line in fp:
+                if not line.endswith('\n'):
+                    # Truncated by an interrupted worker.
+                    break
+                result = json.loads(line)
+                results[result['name']] = result
+    except FileNotFoundError:
+        pass
+    return results
+
+
+async def _run_task(task: dict, semaphore: asyncio.Semaphore, results: typing.TextIO):
+    result = {'name': task['name'], 'exitcode': None}
+    async with semaphore:
+        directory = task['directory']
+        env = task.get('environment', None)
+        if env is not None:
+            env = dict(os.environ, **env)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, 'stdout'), 'w') as stdout, \
+                    open(os.path.join(directory, 'stderr'), 'w') as stderr:
+                process = await asyncio.create_subprocess_exec(
+                    task['executable'], *task.get('arguments', ()),
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=stdout,
+                    stderr=stderr,
+                    cwd=directory,
+                    env=env)
+                result['exitcode'] = await process.wait()
+        except OSError as e:
+            result['error'] = str(e)
+    # Report each result as soon as it is available.
+    results.write(json.dumps(result) + '\n')
+    results.flush()
+    return result
+
+
+async def run_bundle(path: str) -> typing.List[dict]:
+    """Execute the tasks of the bundle file at *path*."""
+    with open(path, 'r') as fp:
+        bundle = json.load(fp)
+    if bundle.get('version', None) != bundle_version:
+        raise ValueError('{} is not a {} file.'.format(path, bundle_version))
+    semaphore = asyncio.Semaphore(max(1, int(bundle['cores'])))
+    with open(bundle['results'], 'a') as results:
+        return await asyncio.gather(*(_run_task(task, semaphore, results) for task in bundle['tasks']))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 1:
+        raise RuntimeError('Usage: python -m scalems.radical.worker bundle.json')
+    results = asyncio.run(run_bundle(argv[0]))
+    logger.debug('Executed {} tasks.'.format(len(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,26 @@
+"""Encode and decode workflow data.
+
+Uids are produced by `fingerprint()`. Workflow documents in the
+``scalems_workflow_1`` format (see :doc:`serialization`) are written and read
+incrementally by `WorkflowWriter` and `WorkflowReader`.
+
+Task records are encoded with a `Codec`, selected by name from the registry
+(see `get_codec()`). JSON (``'json'``) is the default, human-readable encoding.
+The ``'binary'`` codec is a more compact encoding, which is faster to decode
+for records with a recurring structure (such as the records of many tasks of
+the same type). Encoding traverses the records in Python, and is about as fast
+as the (C accelerated) JSON encoder.
+"""
+import abc
+import functools
+import hashlib
 import json
 import os
+import struct
+import typing
+
+from .context import ItemView
+from .exceptions import DuplicateKeyError, ProtocolError
 
 
 class Encoder(json.JSONEncoder):
@@ -10,5 +31,754 @@ class Encoder(json.JSONEncoder):
             return o.hex()
         if isinstance(o, os.PathLike):
             return os.fsdecode(o)
+        if isinstance(o, ItemView):
+            # Encode workflow references as (reserved) JSON objects so that they
+            # cannot be confused with string data.
+            return {'reference': o.uid().hex()}
         # Let the base class default method raise the TypeError
         return json.JSONEncoder.default(self, o)
+
+
+def fingerprint(identity: typing.Mapping) -> bytes:
+    """Get a 256-bit fingerprint for the identifying details of a workflow item.
+
+    *identity* is encoded canonically (sorted keys, no insignificant whitespace,
+    workflow references replaced by the referenced uid) and hashed with SHA-256.
+    Callers are responsible for choosing the details that determine the identity
+    of the item, such as the resource type and its inputs.
+    Ref: :doc:`dataflow`
+
+    Returns:
+        32-byte binary digest.
+    """
+    encoded = json.dumps(identity, cls=Encoder, sort_keys=True, separators=(',', ':'), ensure_ascii=True)
+    return hashlib.sha256(encoded.encode('ascii')).digest()
+
+
+class Codec(abc.ABC):
+    """Encode and decode workflow records.
+
+    Records are mappings with (at least) ``uid`` and ``type`` members, and
+    optionally ``depends``, with uids as hexadecimal strings (as produced by
+    `Encoder`). Decoding produces an equivalent mapping.
+
+    Subclasses set *name* and *binary* (whether records are encoded as bytes
+    rather than str), and are made available with `register_codec()`.
+    """
+    name: str = None
+    binary: bool = False
+
+    @abc.abstractmethod
+    def encode(self, record: typing.Mapping) -> typing.Union[str, bytes]:
+        """Encode a workflow record."""
+
+    @abc.abstractmethod
+    def decode(self, data: typing.Union[str, bytes]) -> dict:
+        """Decode an encoded workflow record."""
+
+
+class JsonCodec(Codec):
+    """Encode records as JSON text (the default)."""
+    name = 'json'
+    binary = False
+
+    def __init__(self):
+        self._encoder = Encoder()
+
+    def encode(self, record: typing.Mapping) -> str:
+        return self._encoder.encode(record)
+
+    def decode(self, data: str) -> dict:
+        return json.loads(data)
+
+
+def _uid_bytes(uid: typing.Union[str, bytes]) -> bytes:
+    # Uids are encoded as hexadecimal strings in records.
+    if isinstance(uid, bytes):
+        return uid
+    return bytes.fromhex(uid)
+
+
+# Tokens of the structure of a packed record body. Keys are ``:`` followed by the key.
+_STRING = 's'
+_REFERENCE = 'r'
+_INT = 'q'
+_FLOAT = 'd'
+_BIG_INT = 'I'
+_literals = {'N': 'None', 'T': 'True', 'F': 'False', '{}': '{}', '[]': '[]'}
+_brackets = {'{': '{', '}': '},', '[': '[', ']': '],'}
+
+# Packed bodies with larger structures are stored as JSON.
+_max_structure = 1024
+
+
+def _classify(value_type: type) -> str:
+    """Get the kind of values of *value_type* for `_flatten()`."""
+    if value_type is str:
+        kind = _STRING
+    elif value_type is dict:
+        kind = '{'
+    elif value_type is list or value_type is tuple:
+        kind = '['
+    elif issubclass(value_type, ItemView):
+        kind = _REFERENCE
+    elif issubclass(value_type, os.PathLike):
+        kind = 'p'
+    else:
+        kind = ''
+    _kinds[value_type] = kind
+    return kind
+
+
+# Kinds of the types encountered by `_flatten()`.
+_kinds: typing.Dict[type, str] = dict()
+
+
+def _flatten(value, structure: list, strings: list, references: list, numbers: list):
+    """Separate a JSON-compatible *value* into its structure and its leaf values.
+
+    Values are converted as by `Encoder`. Workflow references are collected as
+    raw uids, and string, integer, and floating point leaves are collected in
+    document order.
+    """
+    kind = _kinds.get(type(value)) or _classify(type(value))
+    # Strings, paths, references, and empty containers are the most common
+    # members of containers, so they are handled without recursion.
+    if kind == '{':
+        if len(value) == 0:
+            structure.append('{}')
+            return
+        structure.append('{')
+        for key, element in value.items():
+            if type(key) is not str:
+                # As in JSON, keys are strings.
+                key = json.dumps(key)
+            if '\0' in key:
+                raise ValueError('Key cannot be packed.')
+            kind = _kinds.get(type(element)) or _classify(type(element))
+            if kind == _STRING:
+                structure.append(':' + key + '\0' + _STRING)
+                strings.append(element)
+            elif kind == 'p':
+                structure.append(':' + key + '\0' + _STRING)
+                strings.append(os.fsdecode(element))
+            elif kind == _REFERENCE:
+                structure.append(':' + key + '\0' + _REFERENCE)
+                references.append(element.uid())
+            elif (kind == '{' or kind == '[') and len(element) == 0:
+                structure.append(':' + key + '\0' + ('{}' if kind == '{' else '[]'))
+            else:
+                structure.append(':' + key)
+                _flatten(element, structure, strings, references, numbers)
+        structure.append('}')
+    elif kind == '[':
+        if len(value) == 0:
+            structure.append('[]')
+            return
+        structure.append('[')
+        for element in value:
+            kind = _kinds.get(type(element)) or _classify(type(element))
+            if kind == _STRING:
+                structure.append(_STRING)
+                strings.append(element)
+            else:
+                _flatten(element, structure, strings, references, numbers)
+        structure.append(']')
+    elif kind == _STRING:
+        structure.append(_STRING)
+        strings.append(value)
+    elif kind == 'p':
+        structure.append(_STRING)
+        strings.append(os.fsdecode(value))
+    elif kind == _REFERENCE:
+        structure.append(_REFERENCE)
+        references.append(value.uid())
+    elif value is None:
+        structure.append('N')
+    elif type(value) is bool:
+        structure.append('T' if value else 'F')
+    elif type(value) is int:
+        if -(1 << 63) <= value < (1 << 63):
+            structure.append(_INT)
+            numbers.append(value)
+        else:
+            structure.append(_BIG_INT)
+            strings.append(str(value))
+    elif type(value) is float:
+        structure.append(_FLOAT)
+        numbers.append(value)
+    elif isinstance(value, bytes):
+        structure.append(_STRING)
+        strings.append(value.hex())
+    elif isinstance(value, str):
+        _flatten(str(value), structure, strings, references, numbers)
+    elif isinstance(value, dict):
+        _flatten(dict(value), structure, strings, references, numbers)
+    elif isinstance(value, (list, tuple)):
+        _flatten(list(value), structure, strings, references, numbers)
+    elif isinstance(value, bool):
+        _flatten(bool(value), structure, strings, references, numbers)
+    elif isinstance(value, int):
+        _flatten(int(value), structure, strings, references, numbers)
+    elif isinstance(value, float):
+        _flatten(float(value), structure, strings, references, numbers)
+    else:
+        raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+@functools.lru_cache(maxsize=1024)
+def _builder(structure: bytes) -> typing.Tuple[typing.Callable, struct.Struct, int, int]:
+    """Get a function that assembles a value with the given (encoded) *structure* from its leaves.
+
+    The function is called with the list of strings, the hexadecimal representation
+    of the concatenated reference uids, and the tuple of numbers. Records of the same
+    type usually have the same structure, so the function is compiled once and reused.
+
+    Returns:
+        The function, the Struct of the numbers, and the numbers of strings and references.
+    """
+    parts = []
+    strings = 0
+    references = 0
+    numbers = []
+    tokens = structure.decode('utf-8').split('\0')
+    if len(tokens) > _max_structure:
+        raise ProtocolError('Malformed binary record.')
+    for token in tokens:
+        if token == _STRING:
+            parts.append('s[{}],'.format(strings))
+            strings += 1
+        elif token == _BIG_INT:
+            parts.append('int(s[{}]),'.format(strings))
+            strings += 1
+        elif token == _REFERENCE:
+            parts.append("{{'reference': h[{}:{}]}},".format(64 * references, 64 * (references + 1)))
+            references += 1
+        elif token == _INT or token == _FLOAT:
+            parts.append('n[{}],'.format(len(numbers)))
+            numbers.append(token)
+        elif token in _literals:
+            parts.append(_literals[token] + ',')
+        elif token in _brackets:
+            parts.append(_brackets[token])
+        elif token.startswith(':'):
+            # Keys are only used as (quoted) string literals.
+            parts.append(repr(token[1:]) + ':')
+        else:
+            raise ProtocolError('Malformed binary record.')
+    source = 'lambda s, h, n: ' + ''.join(parts).rstrip(',')
+    try:
+        function = eval(compile(source, '<scalems record>', 'eval'), {'__builtins__': {}, 'int': int})
+    except (SyntaxError, RecursionError) as e:
+        # Including structures that are too deeply nested.
+        raise ProtocolError('Malformed binary record.') from e
+    return function, struct.Struct('<' + ''.join(numbers)), strings, references
+
+
+class BinaryCodec(Codec):
+    """Encode records in a compact binary form, using only the standard library.
+
+    Layout (little-endian)::
+
+        u8 version | 32 bytes uid | u16 size(type) | u32 len(depends)
+        u8 format | u32 size(structure) | u32 len(references) | u32 size(strings)
+        type, as NUL-separated utf-8 strings
+        len(depends) * (32 bytes uid)
+        other members (such as ``input``)
+
+    Uids are stored as raw bytes, and the identifying members of a record can
+    be decoded (with `decode_header()`) without decoding the rest of the record.
+
+    The other members are packed (format 0) as::
+
+        structure | references | numbers | strings
+
+    *structure* describes the nesting, keys, and leaf types of the members, as
+    NUL-separated utf-8 tokens. Workflow references are stored as raw 32 byte
+    uids, numbers as 64-bit integers or doubles, and strings as NUL-separated
+    utf-8 text. Decoding assembles the members with a function compiled (and
+    cached) for the structure, so records with the same structure (such as the
+    records of tasks of the same type) are not parsed token by token.
+
+    Members that cannot be packed (because a string or key contains NUL, or the
+    structure is very large) are stored (format 1) as a compact JSON object, of
+    size(structure) bytes.
+    """
+    name = 'binary'
+    binary = True
+    version = 2
+    _header = struct.Struct('<B32sHIBIII')
+    _u16 = struct.Struct('<H')
+    _u32 = struct.Struct('<I')
+
+    def __init__(self):
+        self._encoder = Encoder(separators=(',', ':'), ensure_ascii=False)
+
+    def encode(self, record: typing.Mapping) -> bytes:
+        resource_type = '\0'.join(record['type']).encode('utf-8')
+        depends = b''.join([_uid_bytes(uid) for uid in record.get('depends', ())])
+        members = {key: value for key, value in record.items() if key not in ('uid', 'type', 'depends')}
+        structure = []
+        strings = []
+        references = []
+        numbers = []
+        try:
+            _flatten(members, structure, strings, references, numbers)
+        except ValueError:
+            # A key contains the separator.
+            structure = None
+        if structure is not None and len(structure) <= _max_structure:
+            text = '\0'.join(strings).encode('utf-8')
+            structure = '\0'.join(structure).encode('utf-8')
+            # Strings must not contain the separator.
+            if (len(strings) == 0 or text.count(b'\0') == len(strings) - 1) and self._can_build(structure):
+                if len(numbers) > 0:
+                    numbers = struct.pack('<' + ''.join([_INT if type(number) is int else _FLOAT
+                                                         for number in numbers]), *numbers)
+                else:
+                    numbers = b''
+                header = self._header.pack(self.version, _uid_bytes(record['uid']), len(resource_type),
+                                           len(depends) // 32, 0, len(structure), len(references), len(text))
+                return b''.join([header, resource_type, depends, structure] + references + [numbers, text])
+        text = self._encoder.encode(members).encode('utf-8')
+        header = self._header.pack(self.version, _uid_bytes(record['uid']), len(resource_type),
+                                   len(depends) // 32, 1, len(text), 0, 0)
+        return b''.join((header, resource_type, depends, text))
+
+    @staticmethod
+    def _can_build(structure: bytes) -> bool:
+        """Check that a packed body with *structure* can be decoded (e.g. is not too deeply nested)."""
+        try:
+            _builder(structure)
+        except ProtocolError:
+            return False
+        return True
+
+    def decode_header(self, data: bytes) -> typing.Tuple[bytes, typing.Tuple[str, ...], typing.Tuple[bytes, ...], int]:
+        """Decode the uid, type, and dependencies of an encoded record.
+
+        Returns:
+            (uid, type, depends, offset), where *offset* is the position of the
+            remaining members in *data*.
+        """
+        version, uid, type_size, num_depends, *_ = self._header.unpack_from(data)
+        if version != self.version:
+            raise ProtocolError('Unsupported binary record version {}.'.format(version))
+        offset = self._header.size
+        resource_type = tuple(bytes(data[offset:offset + type_size]).decode('utf-8').split('\0')) if type_size > 0 \
+            else ()
+        offset += type_size
+        depends = tuple(bytes(data[offset + 32 * i:offset + 32 * (i + 1)]) for i in range(num_depends))
+        offset += 32 * num_depends
+        return uid, resource_type, depends, offset
+
+    def decode(self, data: bytes) -> dict:
+        if type(data) is not bytes:
+            data = bytes(data)
+        header_size = self._header.size
+        try:
+            version, uid, type_size, num_depends, packed, structure_size, num_references, text_size = \
+                self._header.unpack_from(data)
+            if version != self.version:
+                raise ProtocolError('Unsupported binary record version {}.'.format(version))
+            offset = header_size + type_size
+            record = {'uid': uid.hex(),
+                      'type': data[header_size:offset].decode('utf-8').split('\0') if type_size > 0 else []}
+            end = offset + 32 * num_depends
+            depends = data[offset:end].hex()
+            record['depends'] = [depends[i:i + 64] for i in range(0, 64 * num_depends, 64)]
+            offset = end + structure_size
+            if packed == 1:
+                if offset != len(data):
+                    raise ProtocolError('Malformed binary record.')
+                members = json.loads(data[end:offset])
+            elif packed == 0:
+                build, numbers, num_strings, expected_references = _builder(data[end:offset])
+                end = offset + 32 * num_references
+                if num_references != expected_references or end + numbers.size + text_size != len(data):
+                    raise ProtocolError('Malformed binary record.')
+                values = numbers.unpack_from(data, end)
+                strings = data[end + numbers.size:].decode('utf-8').split('\0') if num_strings > 0 else []
+                if len(strings) != num_strings:
+                    raise ProtocolError('Malformed binary record.')
+                members = build(strings, data[offset:end].hex(), values)
+            else:
+                raise ProtocolError('Malformed binary record.')
+        except (struct.error, UnicodeDecodeError, ValueError) as e:
+            raise ProtocolError('Malformed binary record.') from e
+        if not isinstance(members, dict):
+            raise ProtocolError('Malformed binary record.')
+        record.update(members)
+        return record
+
+
+_codecs: typing.Dict[str, Codec] = dict()
+
+
+def register_codec(codec: Codec):
+    """Make *codec* available by name through `get_codec()`."""
+    if codec.name in _codecs:
+        raise DuplicateKeyError('A codec named {} is already registered.'.format(codec.name))
+    _codecs[codec.name] = codec
+
+
+def get_codec(name: typing.Union[str, Codec, None] = None) -> Codec:
+    """Get the registered codec with the given *name* (default ``'json'``).
+
+    Codec instances are returned unchanged.
+    """
+    if isinstance(name, Codec):
+        return name
+    if name is None:
+        name = 'json'
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError('No codec named {}. Registered codecs: {}.'.format(name, ', '.join(_codecs)))
+
+
+register_codec(JsonCodec())
+register_codec(BinaryCodec())
+
+
+# Version tag of the workflow document format. See :doc:`serialization`.
+workflow_version = 'scalems_workflow_1'
+
+# Workflow documents written with a binary codec start with this tag, followed by
+# a length-prefixed JSON header and length-prefixed records. A zero length ends the document.
+_binary_document_tag = b'SCALEMS\x00'
+
+
+class WorkflowWriter:
+    """Write a ``scalems_workflow_1`` document incrementally.
+
+    Referents are written to *fp* as they are provided, so the document is
+    never held in memory. Referents must be provided in a topologically valid
+    sequence: the items in the ``depends`` member of a record must already have
+    been written.
+
+    Example::
+
+        with open('workflow.json', 'w') as fp:
+            with WorkflowWriter(fp) as writer:
+                for record in records:
+                    writer.write(record)
+
+    Records are encoded with *codec* (default: JSON). For a binary codec, *fp*
+    must be opened in binary mode, and the document holds the same information
+    in a length-prefixed framing instead of JSON syntax.
+    """
+    def __init__(self, fp: typing.Union[typing.TextIO, typing.BinaryIO], *,
+                 types: typing.Mapping = None,
+                 codec: typing.Union[str, Codec] = None):
+        self._fp = fp
+        self._types = types if types is not None else {}
+        self._encoder = Encoder()
+        self._codec = get_codec(codec)
+        # Uids of the referents written so far.
+        self._written = set()
+        self._started = False
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def __len__(self):
+        return len(self._written)
+
+    def _start(self):
+        if self._codec.binary:
+            header = self._encoder.encode({'version': workflow_version,
+                                           'codec': self._codec.name,
+                                           'types': self._types}).encode('utf-8')
+            self._fp.write(_binary_document_tag + BinaryCodec._u32.pack(len(header)) + header)
+        else:
+            self._fp.write('{{"version": {}, "types": {}, "referents": [\n'.format(
+                self._encoder.encode(workflow_version),
+                self._encoder.encode(self._types)))
+        self._started = True
+
+    def write(self, record: typing.Mapping):
+        """Encode and write a workflow record."""
+        depends = [_uid_bytes(uid) for uid in record.get('depends', ())]
+        self.write_encoded(self._codec.encode(record), uid=_uid_bytes(record['uid']), depends=depends)
+
+    def write_encoded(self, text: typing.Union[str, bytes], *, uid: bytes, depends: typing.Iterable[bytes] = ()):
+        """Write a record that is already encoded with the codec of the writer (as by ``Task.serialize()``).
+
+        *uid* and *depends* must match the record. They are used to check the
+        order of the referents without decoding the record.
+        """
+        if self._closed:
+            raise ProtocolError('Workflow document is already closed.')
+        if uid in self._written:
+            raise DuplicateKeyError('{} is already written.'.format(uid.hex()))
+        for dependency in depends:
+            if dependency not in self._written:
+                raise ProtocolError('{} depends on {}, which has not been written.'.format(
+                    uid.hex(), dependency.hex()))
+        if self._codec.binary:
+            if not self._started:
+                self._start()
+            self._fp.write(BinaryCodec._u32.pack(len(text)))
+            self._fp.write(text)
+        elif not self._started:
+            self._start()
+            self._fp.write(text)
+        else:
+            self._fp.write(',\n')
+            self._fp.write(text)
+        self._written.add(uid)
+
+    def close(self):
+        """Finish the document. Does not close the file."""
+        if self._closed:
+            return
+        if not self._started:
+            self._start()
+        if self._codec.binary:
+            self._fp.write(BinaryCodec._u32.pack(0))
+        else:
+            self._fp.write('\n]}\n')
+        self._closed = True
+
+
+class WorkflowReader:
+    """Read a ``scalems_workflow_1`` document incrementally.
+
+    Iterating over the reader produces the decoded referents in document order.
+    The document is read from *fp* in chunks of *chunk_size* characters, and
+    only the unconsumed part of the current chunk and the decoded record are held
+    in memory, so the size of the document is not limited by memory.
+
+    The topological order of the referents is checked as they are read. Items
+    named in the ``depends`` member of a record must occur earlier in the document.
+
+    Other document members (*version* and *types*) are available as attributes
+    once they have been read. (Writers place them before the referents.)
+
+    Documents written with a binary *codec* (see `WorkflowWriter`) must be read
+    with the same codec, from a file opened in binary mode.
+
+    Malformed data is detected without reading the rest of the document. In
+    particular, no record (or binary frame) may exceed *max_record_size* bytes
+    (characters, for JSON documents).
+
+    Raises:
+        ProtocolError: if the document is malformed, has an unknown version,
+            or the referents are not in topological order.
+        DuplicateKeyError: if a uid occurs more than once.
+    """
+    def __init__(self, fp: typing.Union[typing.TextIO, typing.BinaryIO], *,
+                 chunk_size: int = 1 << 16,
+                 codec: typing.Union[str, Codec] = None,
+                 max_record_size: int = 1 << 26):
+        self._fp = fp
+        self._codec = get_codec(codec)
+        self._chunk_size = chunk_size
+        self._max_record_size = max_record_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        # Start of the last decoded value in the buffer.
+        self._start = 0
+        self._eof = False
+        self._iterating = False
+        self.version = None
+        self.types = None
+
+    def _read(self, size: int = None) -> bool:
+        """Read more of the document into the buffer.
+
+        Returns:
+            False if there was nothing more to read.
+        """
+        if self._eof:
+            return False
+        chunk = self._fp.read(size if size is not None else self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        # Discard the consumed part of the buffer.
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """Get the next non-whitespace character without consuming it ('' at the end of the document)."""
+        while True:
+            buffer = self._buffer
+            pos = self._pos
+            while pos < len(buffer) and buffer[pos] in ' \t\n\r':
+                pos += 1
+            self._pos = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if not self._read():
+                return ''
+
+    def _expect(self, characters: str) -> str:
+        """Consume the next token, which must be one of *characters*."""
+        token = self._peek()
+        if token == '' or token not in characters:
+            raise ProtocolError('Malformed workflow document: expected {} but found {}.'.format(
+                ' or '.join(repr(c) for c in characters), repr(token)))
+        self._pos += 1
+        return token
+
+    def _decode(self):
+        """Decode the next JSON value.
+
+        The value starts at ``self._start`` in the buffer when this returns.
+        """
+        self._peek()
+        size = self._chunk_size
+        while True:
+            self._start = self._pos
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError as e:
+                # The value may continue beyond the buffer. Errors before the end
+                # of the buffer (other than in a string that may continue) are final.
+                truncated = e.pos >= len(self._buffer) or e.msg.startswith('Unterminated string')
+                if not truncated:
+                    raise ProtocolError('Malformed workflow document: {}'.format(str(e))) from e
+                if len(self._buffer) - self._pos > self._max_record_size:
+                    raise ProtocolError('Malformed workflow document: value at {} exceeds {} characters.'.format(
+                        e.pos, self._max_record_size)) from e
+                if not self._read(size):
+                    raise ProtocolError('Malformed workflow document: {}'.format(str(e))) from e
+                # Read larger amounts for large values, to limit re-parsing.
+                size *= 2
+                continue
+            if end == len(self._buffer) and self._read(size):
+                # A number or literal could be truncated at the end of the buffer.
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self) -> typing.Iterator[dict]:
+        return (record for _, record in self.encoded())
+
+    def encoded(self) -> typing.Iterator[typing.Tuple[str, dict]]:
+        """Iterate over the referents as (encoded, decoded) pairs.
+
+        The encoded form is the text of the record in the document, which can
+        be used without encoding the decoded record again.
+        """
+        if self._iterating:
+            raise ProtocolError('Workflow documents can only be read once.')
+        self._iterating = True
+        if self._codec.binary:
+            return self._iterate_binary()
+        return self._iterate()
+
+    def _read_frame(self, record: bool = True) -> bytes:
+        """Read a length-prefixed frame of a binary document (empty for the terminating frame).
+
+        The header of a *record* frame is checked before the rest of the frame is read.
+        """
+        length, = BinaryCodec._u32.unpack(self._read_exactly(4))
+        if length > self._max_record_size:
+            raise ProtocolError('Malformed workflow document: frame of {} bytes exceeds {} bytes.'.format(
+                length, self._max_record_size))
+        if length == 0 or not record or not isinstance(self._codec, BinaryCodec):
+            return self._read_exactly(length)
+        # Check the record header before reading the rest of the record.
+        header_size = BinaryCodec._header.size
+        if length < header_size:
+            raise ProtocolError('Malformed workflow document: frame of {} bytes is too short.'.format(length))
+        header = self._read_exactly(header_size)
+        if header[0] != self._codec.version:
+            raise ProtocolError('Malformed workflow document: unsupported binary record version {}.'.format(
+                header[0]))
+        return header + self._read_exactly(length - header_size)
+
+    def _read_exactly(self, size: int) -> bytes:
+        data = self._fp.read(size)
+        if len(data) != size:
+            raise ProtocolError('Malformed workflow document: unexpected end of data.')
+        return data
+
+    def _iterate_binary(self):
+        if self._read_exactly(len(_binary_document_tag)) != _binary_document_tag:
+            raise ProtocolError('Not a binary workflow document.')
+        header = json.loads(self._read_frame(record=False))
+        if header.get('version', None) != workflow_version:
+            raise ProtocolError('Unsupported workflow document version {}.'.format(repr(header.get('version', None))))
+        if header.get('codec', None) != self._codec.name:
+            raise ProtocolError('Workflow document was written with codec {}.'.format(repr(header.get('codec', None))))
+        self.version = header['version']
+        self.types = header.get('types', None)
+        seen = set()
+        while True:
+            data = self._read_frame()
+            if len(data) == 0:
+                break
+            record = self._codec.decode(data)
+            self._check(record, seen)
+            yield data, record
+        if self._fp.read(1):
+            raise ProtocolError('Malformed workflow document: unexpected data after the document.')
+
+    @staticmethod
+    def _check(record, seen: set):
+        """Check the next referent, given the uids *seen* so far."""
+        if not isinstance(record, dict) or 'uid' not in record or 'type' not in record:
+            raise ProtocolError('Referents must be objects with "uid" and "type" members.')
+        uid = record['uid']
+        if uid in seen:
+            raise DuplicateKeyError('{} occurs more than once.'.format(uid))
+        for dependency in record.get('depends', ()):
+            if dependency not in seen:
+                raise ProtocolError('{} depends on {}, which does not occur earlier in the document.'.format(
+                    uid, dependency))
+        seen.add(uid)
+
+    def _iterate(self):
+        self._expect('{')
+        if self._peek() != '}':
+            while True:
+                key = self._decode()
+                if not isinstance(key, str):
+                    raise ProtocolError('Malformed workflow document: expected a member name.')
+                self._expect(':')
+                if key == 'referents':
+                    yield from self._referents()
+                else:
+                    value = self._decode()
+                    if key == 'version':
+                        if value != workflow_version:
+                            raise ProtocolError('Unsupported workflow document version {}.'.format(repr(value)))
+                        self.version = value
+                    elif key == 'types':
+                        self.types = value
+                if self._expect(',}') == '}':
+                    break
+        else:
+            self._pos += 1
+        if self._peek() != '':
+            raise ProtocolError('Malformed workflow document: unexpected data after the document.')
+        if self.version is None:
+            raise ProtocolError('Workflow document does not declare a version.')
+
+    def _referents(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        seen = set()
+        while True:
+            self._peek()
+            record = self._decode()
+            # Note: _decode() only discards consumed data before the start of the value.
+            text = self._buffer[self._start:self._pos]
+            self._check(record, seen)
+            yield text, record
+            if self._expect(',]') == ']':
+                return
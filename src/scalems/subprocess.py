@@ -14,6 +14,7 @@ In the first iteration, we can use dataclasses.dataclass to define input/output
 in terms of standard types. In a follow-up, we can use a scalems metaclass to define them
 in terms of Data Descriptors that support mixed scalems.Future and native constant data types.
 """
+import array
 import dataclasses
 import json
 import logging
@@ -21,7 +22,7 @@ import os
 import typing
 from pathlib import Path # We probably need a scalems abstraction for Path.
 
-from .serialization import Encoder
+from .serialization import Encoder, fingerprint, get_codec
 
 from .exceptions import InternalError, MissingImplementationError, ProtocolError
 from . import context as _context
@@ -82,6 +83,42 @@ class SubprocessResult:
     file: typing.Mapping[str, Path]
 
 
+@dataclasses.dataclass
+class EnsembleSubprocessResult:
+    """Results of the members of an ensemble Subprocess, stored by field.
+
+    Member *i* executes in ``directory / str(i)``, so the output paths are shared
+    templates relative to the member directory, and only the exit codes are stored
+    for each member. Indexing produces the `SubprocessResult` of a member.
+    """
+    directory: Path
+    exitcode: typing.Sequence[int]
+    stdout: Path
+    stderr: Path
+    file: typing.Mapping[str, Path] = dataclasses.field(default_factory=dict)
+
+    def __post_init__(self):
+        if not isinstance(self.exitcode, array.array):
+            self.exitcode = array.array('i', self.exitcode)
+
+    def __len__(self):
+        return len(self.exitcode)
+
+    def __getitem__(self, member: int) -> SubprocessResult:
+        if member < 0:
+            member += len(self)
+        if not 0 <= member < len(self):
+            raise IndexError('Ensemble member {} out of range.'.format(member))
+        directory = Path(self.directory) / str(member)
+        return SubprocessResult(exitcode=self.exitcode[member],
+                                stdout=directory / self.stdout,
+                                stderr=directory / self.stderr,
+                                file={key: directory / path for key, path in self.file.items()})
+
+    def __iter__(self):
+        return (self[member] for member in range(len(self)))
+
+
 class SubprocessTask:
     """Describe the type of resource provided by a Subprocess command."""
     @classmethod
@@ -117,9 +154,22 @@ class Subprocess:
         # model and to allow for future contextual information, such as shape.
         return SubprocessTask()
 
-    def __init__(self, input: SubprocessInput):
+    def __init__(self, input: SubprocessInput, shape: typing.Tuple[int, ...] = (1,)):
+        shape = tuple(int(extent) for extent in shape)
+        if len(shape) != 1 or shape[0] < 1:
+            raise MissingImplementationError('Subprocess ensembles must have shape (N,).')
         self._bound_input = input
+        self._shape = shape
         self._result = None
+        self._uid = None
+
+    def shape(self) -> typing.Tuple[int, ...]:
+        """Get the ensemble shape of the task.
+
+        A task of shape ``(N,)`` launches N subprocesses (ensemble members) from
+        the same input.
+        """
+        return self._shape
 
     def input_collection(self):
         return self._bound_input
@@ -127,15 +177,56 @@ class Subprocess:
     def result(self):
         return self._result
 
-    def dependencies(self):
-        ...
+    def dependencies(self) -> typing.Tuple[bytes, ...]:
+        """Get the uids of workflow items that provide input to this task.
 
-    def uid(self):
-        # Make a fake 256-bit digest.
-        value = b'\x00'*32
-        if not len(value) == 256//8:
-            raise ProtocolError('UID is supposed to be a 256-bit hash digest.')
-        return value
+        Workflow references (such as the views returned by other commands) may
+        be provided as values in *inputs*. The referenced items must be complete
+        before this task can be launched.
+        """
+        dependencies = []
+        for value in self._bound_input.inputs.values():
+            if isinstance(value, (list, tuple)):
+                candidates = value
+            else:
+                candidates = (value,)
+            for candidate in candidates:
+                if isinstance(candidate, _context.ItemView):
+                    uid = candidate.uid()
+                    if uid not in dependencies:
+                        dependencies.append(uid)
+        return tuple(dependencies)
+
+    def uid(self) -> bytes:
+        """Get the 256-bit fingerprint of the task.
+
+        The fingerprint is determined by the resource type and the inputs that
+        determine the behavior of the subprocess: the command line, environment,
+        standard input, and the identities of input files (paths, or the uids of
+        the workflow items providing them). Output file names and resource
+        requirements do not contribute, so identical work declared with different
+        output locations or launch details produces the same uid. The shape
+        contributes for ensembles.
+        """
+        if self._uid is None:
+            bound_input = self._bound_input
+            stdin = bound_input.stdin
+            if stdin is not None and not isinstance(stdin, (str, os.PathLike)):
+                stdin = list(stdin)
+            identity = {
+                'type': self.resource_type().scoped_identifier(),
+                'argv': [str(arg) for arg in bound_input.argv],
+                'environment': dict(bound_input.environment),
+                'stdin': stdin,
+                'inputs': dict(bound_input.inputs)
+            }
+            if self._shape != (1,):
+                identity['shape'] = list(self._shape)
+            value = fingerprint(identity)
+            if not len(value) == 256//8:
+                raise ProtocolError('UID is supposed to be a 256-bit hash digest.')
+            self._uid = value
+        return self._uid
 
     def serialize(self) -> str:
         """Encode the task as a JSON record.
@@ -160,17 +251,45 @@ class Subprocess:
         return serialized
 
     @classmethod
-    def deserialize(cls, record: str, context = None):
+    def deserialize(cls, record: typing.Union[str, bytes, typing.Mapping], context = None, *, codec=None):
         """Instantiate a Subprocess Task from a serialized record.
 
         In general, records should only be deserialized into a WorkflowContext
         that manages a valid work graph, but for early testing, at least,
         we have some standalone use cases.
-        """
 
+        If *context* is provided, references in *inputs* are restored as views
+        of the items in *context*, so the referenced items must already be
+        present. Otherwise, references remain in their encoded form (and do not
+        contribute to `dependencies()`).
+
+        An encoded *record* is decoded with *codec* (default: JSON).
+
+        Raises:
+            ProtocolError: if the record does not describe a Subprocess, or the
+                fingerprint of the restored task does not match the recorded uid.
+        """
+        if isinstance(record, (str, bytes)):
+            record = get_codec(codec).decode(record)
+        if tuple(record['type']) != SubprocessTask.scoped_identifier():
+            raise ProtocolError('Not a Subprocess record: {}'.format(repr(record['type'])))
+        fields = dict(record['input'])
+        for name in ('stdout', 'stderr'):
+            if fields.get(name, None) is not None:
+                fields[name] = Path(fields[name])
+        if context is not None:
+            inputs = dict()
+            for key, value in fields.get('inputs', {}).items():
+                if isinstance(value, dict) and set(value.keys()) == {'reference'}:
+                    value = _context.ItemView(context=context, uid=bytes.fromhex(value['reference']))
+                inputs[key] = value
+            fields['inputs'] = inputs
         # The record may or may not have a bound result.
         # If there is a bound result, it should be added to the workgraph first.
-        return cls()
+        task = cls(SubprocessInput(**fields), shape=tuple(record.get('shape', (1,))))
+        if task.uid().hex() != record['uid']:
+            raise ProtocolError('Record for {} does not match its fingerprint.'.format(record['uid']))
+        return task
 
     # def __await__(self) -> typing.Generator[typing.Any, None, SubprocessResult]:
     #     """Implements the asyncio protocol for a coroutine object.
@@ -255,6 +374,11 @@ def executable(*args, context=None, **kwargs):
     ability to uniquely identify the effects of a command line operation. If you
     think this disallows important use cases, please let us know.
 
+    The working directory of the process is determined by the execution
+    environment. For instance, :py:mod:`scalems.local` executes each task in
+    a directory named for the task uid, so relative paths in *argv* should not
+    be assumed to refer to the directory of the workflow script.
+
     Arguments:
          argv: a tuple (or list) to be the subprocess arguments, including the executable
 
@@ -268,6 +392,7 @@ def executable(*args, context=None, **kwargs):
          stdout (str): Capture standard out to a filesystem artifact, even if it is not consumed in the workflow.
          stderr (str): Capture standard error to a filesystem artifact, even if it is not consumed in the workflow.
          resources (Mapping): Name additional required resources, such as an MPI environment.
+         shape (tuple): Ensemble shape ``(N,)`` to launch N members from the same input (default ``(1,)``).
 
     .. todo:: Support POSIX sigaction / IPC traps?
 
@@ -295,6 +420,10 @@ def executable(*args, context=None, **kwargs):
 
     The *file* output has the same keys as the *outputs* key word argument.
 
+    For an ensemble *shape* ``(N,)``, the task is a single workflow item with an
+    `EnsembleSubprocessResult`. Each member receives its index in the
+    ``SCALEMS_ENSEMBLE_MEMBER`` environment variable.
+
     Example:
         Execute a command named ``exe`` that takes a flagged option for input
         and output file names
@@ -317,6 +446,7 @@ def executable(*args, context=None, **kwargs):
     """
     if context is None:
         context = _context.get_context()
+    shape = kwargs.pop('shape', (1,))
 
     # TODO: Figure out a reasonable way to check and catch invalid input through a dispatcher.
     # subprocess_input = context.add(Subprocess.input_type(), *args, **kwargs)
@@ -342,7 +472,7 @@ def executable(*args, context=None, **kwargs):
     # aspect by letting the return value of the director be awaitable.
 
     try:
-        task_view = director(input=bound_input)
+        task_view = director(input=bound_input, shape=shape)
     except TypeError as e:
         logger.error('Invalid input in SubprocessInput: ' + str(e))
         raise
@@ -0,0 +1,151 @@
+"""Test scalems.subgraph and scalems.while_loop with local execution."""
+
+import asyncio
+import gc
+
+import pytest
+
+import scalems
+import scalems.context
+import scalems.local
+
+
+@scalems.function_wrapper(output={'data': float}, execution='inline')
+def add_float(a: float, b: float) -> float:
+    return a + b
+
+
+@scalems.function_wrapper(output={'data': bool}, execution='inline')
+def less_than(lhs: float, rhs: float, output=None):
+    output.data = lhs < rhs
+
+
+@scalems.function_wrapper(output={'data': bool}, execution='thread')
+def at_least(value: float, threshold: float) -> bool:
+    return value >= threshold
+
+
+def test_subgraph_instance():
+    subgraph = scalems.subgraph(variables={'float_with_default': 1.0, 'bool_data': True})
+    with subgraph:
+        subgraph.float_with_default = add_float(subgraph.float_with_default, 1.).output.data
+        subgraph.bool_data = less_than(lhs=subgraph.float_with_default, rhs=6.).output.data
+    operation_instance = subgraph()
+    operation_instance.run()
+    assert operation_instance.values['float_with_default'] == 2.
+    assert operation_instance.values['bool_data'] is True
+
+    with pytest.raises(scalems.exceptions.ScopeError):
+        subgraph.float_with_default = 3.
+
+
+@pytest.mark.asyncio
+async def test_while_loop(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=1)
+    with scalems.context.scope(context):
+        subgraph = scalems.subgraph(variables={'float_with_default': 1.0, 'bool_data': True})
+        with subgraph:
+            subgraph.float_with_default = add_float(subgraph.float_with_default, 1.).output.data
+            subgraph.bool_data = less_than(lhs=subgraph.float_with_default, rhs=6.).output.data
+        loop = scalems.while_loop(function=subgraph, condition=subgraph.bool_data)
+        handle = loop()
+        # Initial values can be overridden.
+        short_loop = scalems.while_loop(function=subgraph, condition=subgraph.bool_data, float_with_default=4.)()
+        async with context.dispatch():
+            ...
+    assert handle.output.float_with_default.result() == 6
+    assert handle.bool_data.result() is False
+    assert short_loop.output.float_with_default.result() == 6
+    # Intermediate items are released from the workflow.
+    assert len(context.task_map) == 2
+
+
+@pytest.mark.asyncio
+async def test_while_loop_memory(cleandir):
+    """The workflow does not grow with the number of iterations."""
+    context = scalems.local.AsyncWorkflowManager(cores=1)
+    with scalems.context.scope(context):
+        counter = scalems.subgraph(variables={'count': 0.})
+        with counter:
+            counter.count = add_float(counter.count, 1.).output.data
+            # A variable without an initial value. (The first iteration is unconditional.)
+            counter.done = at_least(counter.count, 300.).output.data
+        loop = scalems.while_loop(function=counter,
+                                  condition=scalems.logical_not(counter.done),
+                                  max_iteration=1000)()
+        async with context.dispatch():
+            peak = 0
+            while not loop.done():
+                peak = max(peak, len(context.task_map))
+                await asyncio.sleep(0)
+    assert loop.output.count.result() == 300.
+    assert loop.output.done.result() is True
+    assert peak < 10
+    assert len(context.task_map) == 1
+
+
+@pytest.mark.asyncio
+async def test_while_loop_max_iteration(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=1)
+    with scalems.context.scope(context):
+        counter = scalems.subgraph(variables={'count': 0., 'forever': True})
+        with counter:
+            counter.count = add_float(counter.count, 1.).output.data
+        loop = scalems.while_loop(function=counter, condition=counter.forever, max_iteration=3)()
+        async with context.dispatch():
+            ...
+    assert loop.output.count.result() == 3.
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('iterations', [(50, 49), (49, 50)])
+async def test_while_loops_share_subgraph(cleandir, iterations):
+    """Loops over the same subgraph share equivalent items without releasing each other's items."""
+    context = scalems.local.AsyncWorkflowManager(cores=1)
+    with scalems.context.scope(context):
+        counter = scalems.subgraph(variables={'count': 0., 'more': True})
+        with counter:
+            counter.count = add_float(counter.count, 1.).output.data
+            counter.more = less_than(lhs=counter.count, rhs=100.).output.data
+        loops = [scalems.while_loop(function=counter, condition=counter.more, max_iteration=n)()
+                 for n in iterations]
+        async with context.dispatch():
+            ...
+    assert [loop.output.count.result() for loop in loops] == [float(n) for n in iterations]
+    # Only the loops remain.
+    assert len(context.task_map) == 2
+    assert context._holds == {}
+
+
+def test_subgraph_key():
+    """Equivalent subgraph definitions have the same key, and are only registered while referenced."""
+    def define():
+        counter = scalems.subgraph(variables={'count': 0., 'more': True})
+        with counter:
+            counter.count = add_float(counter.count, 1.).output.data
+            counter.more = less_than(lhs=counter.count, rhs=3.).output.data
+        return counter
+
+    first = define()
+    second = define()
+    assert first.key == second.key
+    assert [uid for uid, _ in first._items] == [uid for uid, _ in second._items]
+    assert scalems.control.lookup(first.key) is first
+    # Equivalent loops are the same workflow item.
+    context = scalems.local.AsyncWorkflowManager()
+    with scalems.context.scope(context):
+        loop = scalems.while_loop(function=first, condition=first.more)()
+        assert scalems.while_loop(function=second, condition=second.more)().uid() == loop.uid()
+    # The registered definition is kept alive by the equivalent definition.
+    key = first.key
+    del first
+    assert scalems.control.lookup(key) is not None
+    # The registered definition is kept alive by the workflow.
+    del second
+    assert scalems.control.lookup(key) is not None
+    del loop, context
+    # Collect the workflow, then the subgraph (which references itself through its template).
+    gc.collect()
+    gc.collect()
+    with pytest.raises(scalems.exceptions.ProtocolError):
+        scalems.control.lookup(key)
@@ -0,0 +1,59 @@
+"""Test ensemble data gathering and scattering."""
+
+import array
+
+import pytest
+
+import scalems
+import scalems.context
+import scalems.local
+from scalems.ensemble import EnsembleData
+
+
+@scalems.function_wrapper(execution='thread')
+def member_data(i: int):
+    return [float(i), float(i) + 0.5]
+
+
+def test_gather_scatter():
+    members = [[float(i), 2. * i, 3. * i] for i in range(5)]
+    members[1] = array.array('d', members[1])
+    ensemble = scalems.gather(members)
+    assert isinstance(ensemble, EnsembleData)
+    assert ensemble.shape == (5, 3)
+    assert ensemble.tolist() == [[float(i), 2. * i, 3. * i] for i in range(5)]
+
+    rows = scalems.scatter(ensemble)
+    assert len(rows) == 5
+    # Rows are views of the gathered storage.
+    rows[2][1] = -1.
+    assert ensemble[2][1] == -1.
+    assert ensemble[-1][0] == 4.
+    with pytest.raises(IndexError):
+        ensemble[5]
+
+    with pytest.raises(ValueError):
+        scalems.gather([[1.], [1., 2.]])
+
+
+def test_ensemble_storage():
+    storage = array.array('d', range(6))
+    ensemble = EnsembleData(storage, (3, 2))
+    assert ensemble.storage is storage
+    assert list(ensemble[1]) == [2., 3.]
+    storage[3] = 10.
+    assert ensemble[1][1] == 10.
+    with pytest.raises(ValueError):
+        EnsembleData(storage, (4, 2))
+
+
+@pytest.mark.asyncio
+async def test_gather_references(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    with scalems.context.scope(context):
+        gathered = scalems.gather([member_data(i) for i in range(4)])
+        members = scalems.scatter(gathered)
+        async with context.dispatch():
+            ...
+    assert gathered.result().tolist() == [[float(i), float(i) + 0.5] for i in range(4)]
+    assert [list(member) for member in members.result()] == gathered.result().tolist()
@@ -0,0 +1,100 @@
+"""Test the scalems.function_wrapper command with local execution."""
+
+import os
+import threading
+
+import pytest
+
+import scalems
+import scalems.context
+import scalems.local
+
+
+@scalems.function_wrapper(output={'spam': str, 'foo': str})
+def myfunc(parameter: str = None, output=None):
+    output.spam = parameter
+    output.foo = parameter + ' ' + parameter
+
+
+@scalems.function_wrapper(output={'data': float})
+def add_float(a: float, b: float) -> float:
+    return a + b
+
+
+@scalems.function_wrapper()
+def get_pid():
+    return os.getpid()
+
+
+@scalems.function_wrapper()
+def fail():
+    raise ValueError('Expected failure.')
+
+
+@pytest.mark.asyncio
+async def test_function_outputs(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    with scalems.context.scope(context):
+        operation1 = myfunc(parameter='spam spam')
+        total = add_float(1., 2.)
+        # Outputs can be used as input to other operations.
+        chained = add_float(total.output.data, 3.)
+        # Equivalent calls refer to the same item.
+        assert add_float(1., 2.).uid() == total.uid()
+        assert chained.uid() != total.uid()
+        pid = get_pid()
+        async with context.dispatch():
+            ...
+    assert operation1.spam.result() == 'spam spam'
+    assert operation1.foo.result() == 'spam spam spam spam'
+    assert total.output.data.result() == 3.
+    assert chained.data.result() == 6.
+    # Functions run in worker processes.
+    assert pid.result() != os.getpid()
+
+
+@pytest.mark.asyncio
+async def test_function_exception(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=1)
+    with scalems.context.scope(context):
+        failure = fail()
+        with pytest.raises(ValueError):
+            async with context.dispatch():
+                ...
+    assert isinstance(failure.exception(), ValueError)
+
+
+def test_function_not_importable():
+    def local_function():
+        ...
+    with pytest.raises(ValueError):
+        scalems.function_wrapper()(local_function)
+
+
+@scalems.function_wrapper(execution='inline')
+def inline_identity():
+    return threading.get_ident(), os.getpid()
+
+
+@scalems.function_wrapper(execution='thread')
+def thread_identity():
+    return threading.get_ident(), os.getpid()
+
+
+@pytest.mark.asyncio
+async def test_function_execution(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    with scalems.context.scope(context):
+        inline = inline_identity()
+        thread = thread_identity()
+        process = get_pid()
+        async with context.dispatch():
+            ...
+    assert inline.result() == (threading.get_ident(), os.getpid())
+    thread_id, thread_pid = thread.result()
+    assert thread_id != threading.get_ident()
+    assert thread_pid == os.getpid()
+    assert process.result() != os.getpid()
+
+    with pytest.raises(ValueError):
+        scalems.function_wrapper(execution='gpu')
@@ -0,0 +1,196 @@
+"""Test scalems.map with local execution."""
+
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+
+import pytest
+
+import scalems
+import scalems.context
+import scalems.local
+
+
+@scalems.function_wrapper(execution='thread')
+def square(x):
+    return x * x
+
+
+@scalems.function_wrapper(execution='thread')
+def delayed(x):
+    # Later elements finish first.
+    time.sleep(0.05 * (4 - x))
+    return x
+
+
+@scalems.function_wrapper(output={'value': int}, execution='process')
+def negate(x):
+    return -x
+
+
+@pytest.mark.asyncio
+async def test_map_ordered(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    with scalems.context.scope(context):
+        async with context.dispatch():
+            results = []
+            async for result in scalems.map(square, range(20), window=3):
+                results.append(result)
+                # Tasks are released when their results have been consumed.
+                assert len(context.task_map) <= 3
+                assert len(context._holds) <= 3
+    assert results == [x * x for x in range(20)]
+    assert len(context.task_map) == 0
+    assert context._holds == {}
+
+    # Tasks that the map did not add are not released.
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    with scalems.context.scope(context):
+        view = square(3)
+        async with context.dispatch():
+            results = await scalems.map(square, [1, 3, 3, 5], window=2).collect()
+    assert results == [1, 9, 9, 25]
+    assert list(context.task_map) == [view.uid()]
+    assert context._holds == {}
+
+
+@pytest.mark.asyncio
+async def test_map_window(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    with scalems.context.scope(context):
+        async with context.dispatch():
+            mapping = scalems.map(square, range(100), window=4)
+            async for result in mapping:
+                assert result == 0
+                # Tasks are added as results are consumed.
+                assert len(context.task_map) <= 4
+                break
+
+
+@pytest.mark.asyncio
+async def test_map_unordered(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=4)
+    with scalems.context.scope(context):
+        async with context.dispatch():
+            results = [result async for result in scalems.map(delayed, range(4), ordered=False, window=4)]
+    assert sorted(results) == [0, 1, 2, 3]
+    assert results != [0, 1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_map_chunks(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    with scalems.context.scope(context):
+        async with context.dispatch():
+            results = []
+            tasks = set()
+            async for result in scalems.map(negate, range(10), shape=(10,), chunksize=4):
+                results.append(result)
+                tasks.update(context.task_map)
+    assert results == [{'value': -x} for x in range(10)]
+    # One task per chunk.
+    assert len(tasks) == 3
+    assert len(context.task_map) == 0
+
+    with pytest.raises(ValueError):
+        scalems.map(os.getpid, range(10), chunksize=2)
+
+
+@pytest.mark.asyncio
+async def test_as_completed(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=4)
+    with scalems.context.scope(context):
+        views = [delayed(x) for x in range(4)]
+        async with context.dispatch():
+            completed = [view async for view in scalems.as_completed(views)]
+    assert sorted(view.result() for view in completed) == [0, 1, 2, 3]
+    # The longest task finishes last.
+    assert completed[-1].result() == 0
+
+    context = scalems.local.AsyncWorkflowManager(cores=4)
+    with scalems.context.scope(context):
+        views = [delayed(x) for x in range(4)]
+        async with context.dispatch():
+            batches = [[view.result() for view in batch]
+                       async for batch in scalems.as_completed(views, batch_size=3)]
+    assert [len(batch) for batch in batches] == [3, 1]
+    assert sorted(sum(batches, [])) == [0, 1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_as_completed_threads():
+    """References may be resolved in other threads."""
+    futures = [concurrent.futures.Future() for _ in range(3)]
+    timers = [threading.Timer(0.1 * (3 - i), future.set_result, (i,)) for i, future in enumerate(futures)]
+    for timer in timers:
+        timer.start()
+
+    async def consume():
+        return [future.result() async for future in scalems.as_completed(futures)]
+
+    start = time.monotonic()
+    assert await asyncio.wait_for(consume(), timeout=5) == [2, 1, 0]
+    assert time.monotonic() - start < 1
+
+
+@pytest.mark.asyncio
+async def test_as_completed_window(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=4)
+    with scalems.context.scope(context):
+        # Finishes at 0.05 s intervals.
+        views = [delayed(x) for x in range(4)]
+        async with context.dispatch():
+            batches = [batch async for batch in scalems.as_completed(views, batch_size=4, window=0.01)]
+    # A batch is delivered at the end of the window, even if it is not full.
+    assert len(batches) > 1
+    assert sum(len(batch) for batch in batches) == 4
+
+
+@pytest.mark.asyncio
+async def test_desequence(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=4)
+    with scalems.context.scope(context):
+        async with context.dispatch():
+            mapping = scalems.map(delayed, range(4), window=4)
+            results = [result async for result in scalems.desequence(mapping)]
+    assert sorted(results) == [0, 1, 2, 3]
+    assert results != [0, 1, 2, 3]
+
+
+@scalems.function_wrapper(execution='inline')
+def concatenate(a: str, b: str):
+    return a + b
+
+
+@scalems.function_wrapper(output={'total': int}, execution='thread')
+def add(a: int, b: int):
+    return a + b
+
+
+@pytest.mark.asyncio
+async def test_reduce_ordered(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    letters = 'abcdefghijk'
+    with scalems.context.scope(context):
+        result = scalems.reduce(concatenate, letters)
+        # Balanced tree of N - 1 operations.
+        assert len(context.task_map) == len(letters) - 1
+        async with context.dispatch():
+            ...
+    assert result.result() == letters
+
+    assert scalems.reduce(concatenate, ['a'], context=context) == 'a'
+    with pytest.raises(TypeError):
+        scalems.reduce(concatenate, [], context=context)
+
+
+@pytest.mark.asyncio
+async def test_reduce_unordered(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=4)
+    with scalems.context.scope(context):
+        operands = [add(i, 0).output.total for i in range(10)] + [100]
+        async with context.dispatch():
+            result = await scalems.reduce(add, operands, ordered=False)
+    assert result.result() == sum(range(10)) + 100
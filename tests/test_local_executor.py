@@ -0,0 +1,380 @@
+"""Test the scalems.local executor.
+
+The executor is exercised through the AsyncWorkflowManager dispatching protocol.
+"""
+
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+import scalems.context
+import scalems.subprocess
+import scalems.local
+from scalems.exceptions import DispatchError, DuplicateKeyError
+from scalems.local.cache import ResultCache
+from scalems.local.graph import DependencyIndex
+from scalems.local.scheduling import Scheduler
+from scalems.serialization import Encoder
+from scalems.subprocess import Subprocess, SubprocessInput
+
+
+def add_record(context, uid: bytes, argv, depends=(), **kwargs):
+    """Insert a SubprocessTask record directly into the workflow of *context*.
+
+    Allows independent tasks to be added without relying on task fingerprinting.
+    """
+    task_input = SubprocessInput(argv, **kwargs)
+    record = {
+        'uid': uid.hex(),
+        'type': ('scalems', 'subprocess', 'SubprocessTask'),
+        'input': {key: value for key, value in task_input.__dict__.items()},
+        'depends': [dependency.hex() for dependency in depends]
+    }
+    context.task_map[uid] = scalems.context.Task(context, json.dumps(record, cls=Encoder))
+    return scalems.context.ItemView(context=context, uid=uid)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_independent_tasks(cleandir):
+    num_tasks = 4
+    context = scalems.local.AsyncWorkflowManager(cores=num_tasks)
+    views = [
+        add_record(context, bytes([i]) * 32, ('/bin/sleep', '1'),
+                   stdout='stdout{}'.format(i), stderr='stderr{}'.format(i))
+        for i in range(num_tasks)
+    ]
+    start = time.monotonic()
+    async with context.dispatch():
+        ...
+    elapsed = time.monotonic() - start
+    assert all(view.done() for view in views)
+    assert all(view.result().exitcode == 0 for view in views)
+    assert elapsed < num_tasks - 1
+
+
+@pytest.mark.asyncio
+async def test_dependent_tasks(cleandir):
+    context = scalems.local.AsyncWorkflowManager()
+    marker = os.path.join(cleandir, 'marker')
+    producer = add_record(context, b'\x01' * 32, ('/bin/sh', '-c', 'sleep 1; echo produced > ' + marker),
+                          stdout='stdout1', stderr='stderr1')
+    consumer = add_record(context, b'\x02' * 32, ('/bin/cat', marker),
+                          depends=(producer.uid(),),
+                          stdout='stdout2', stderr='stderr2')
+    async with context.dispatch():
+        ...
+    assert producer.result().exitcode == 0
+    result = consumer.result()
+    assert result.exitcode == 0
+    with open(result.stdout) as fh:
+        assert fh.read().startswith('produced')
+
+
+@pytest.mark.asyncio
+async def test_resource_limited_tasks(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    views = [
+        add_record(context, bytes([i]) * 32, ('/bin/sleep', '1'),
+                   stdout='stdout{}'.format(i), stderr='stderr{}'.format(i),
+                   resources={'procs_per_task': 1, 'threads_per_proc': 2})
+        for i in range(2)
+    ]
+    start = time.monotonic()
+    async with context.dispatch():
+        ...
+    elapsed = time.monotonic() - start
+    assert all(view.result().exitcode == 0 for view in views)
+    # Each task occupies the whole pool, so the tasks cannot overlap.
+    assert elapsed >= 2
+
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    view = add_record(context, b'\x03' * 32, ('/bin/true',), resources={'procs_per_task': 3})
+    with pytest.raises(DispatchError):
+        async with context.dispatch():
+            ...
+    assert isinstance(view.exception(), DispatchError)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_backfill():
+    scheduler = Scheduler(cores=4)
+    events = []
+    release = {name: asyncio.Event() for name in ('a', 'b', 'c', 'd')}
+
+    async def job(name, cores):
+        async with scheduler.allocate(cores):
+            events.append(name)
+            await release[name].wait()
+
+    jobs = [asyncio.create_task(job('a', 3)), asyncio.create_task(job('b', 3)), asyncio.create_task(job('c', 1))]
+    await asyncio.sleep(0)
+    # 'b' does not fit, but 'c' can be backfilled into the remaining core.
+    assert events == ['a', 'c']
+    assert scheduler.available == 0
+    jobs.append(asyncio.create_task(job('d', 1)))
+    release['c'].set()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    # The core released by 'c' is immediately used by 'd', since 'b' still does not fit.
+    assert events == ['a', 'c', 'd']
+    release['a'].set()
+    release['d'].set()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert events == ['a', 'c', 'd', 'b']
+    release['b'].set()
+    await asyncio.gather(*jobs)
+    assert scheduler.available == scheduler.capacity
+
+
+@pytest.mark.asyncio
+async def test_result_cache(cleandir):
+    cache = ResultCache(os.path.join(cleandir, 'cache'))
+    counter = os.path.join(cleandir, 'counter')
+    argv = ('/bin/sh', '-c', 'echo run >> {}; echo hello; echo data > out.txt'.format(counter))
+
+    for stdout in ('first.txt', 'second.txt'):
+        context = scalems.local.AsyncWorkflowManager(result_cache=cache)
+        with scalems.context.scope(context):
+            cmd = scalems.executable(argv, stdout=stdout, outputs={'-o': 'out.txt'})
+            async with context.dispatch():
+                ...
+        result = cmd.result()
+        assert result.exitcode == 0
+        assert result.stdout.name == stdout
+        with open(result.stdout) as fh:
+            assert fh.read() == 'hello\n'
+        # Declared output files are restored, too.
+        with open(result.file['-o']) as fh:
+            assert fh.read() == 'data\n'
+        assert cmd.uid() in cache
+
+    # The second task was satisfied from the cache.
+    with open(counter) as fh:
+        assert fh.read() == 'run\n'
+
+    # Entries expire.
+    cache.max_age = 0
+    time.sleep(0.01)
+    cache.evict()
+    assert cmd.uid() not in cache
+
+    # Size-limited caches are reduced below the limit when it is exceeded,
+    # without scanning the directory for every new entry.
+    cache = ResultCache(os.path.join(cleandir, 'limited'), max_bytes=10000)
+    scans = []
+    evict = cache.evict
+    cache.evict = lambda: scans.append(evict())
+    for i in range(100):
+        with open('stdout', 'w') as fh:
+            fh.write('x' * 100)
+        uid = Subprocess(SubprocessInput(('/bin/true', str(i)))).uid()
+        cache.store(uid, scalems.subprocess.SubprocessResult(exitcode=0, stdout=os.path.abspath('stdout'),
+                                                               stderr=os.path.abspath('stdout'), file={}),
+                    workdir=cleandir)
+        assert cache._usage <= 10000 + 300
+    assert 1 < len(scans) < 15
+    assert sum(entry.stat().st_size for entry in os.scandir(cache.directory)
+               for entry in os.scandir(entry.path)) <= 10000
+
+
+@pytest.mark.asyncio
+async def test_result_cache_input_contents(cleandir):
+    """Changing the contents of an input file invalidates the cached result."""
+    cache = ResultCache(os.path.join(cleandir, 'cache'))
+    infile = os.path.join(cleandir, 'input.txt')
+    for content in ('one', 'two', 'two'):
+        with open(infile, 'w') as fh:
+            fh.write(content)
+        context = scalems.local.AsyncWorkflowManager(result_cache=cache)
+        with scalems.context.scope(context):
+            cmd = scalems.executable(('/bin/cat', infile), inputs={'-i': infile})
+            async with context.dispatch():
+                ...
+        with open(cmd.result().stdout) as fh:
+            assert fh.read() == content
+    # The task uid does not change, but each input version has an entry.
+    assert cmd.uid() not in cache
+    assert len(os.listdir(cache.directory)) == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_output(cleandir):
+    context = scalems.local.AsyncWorkflowManager(stream_output=True)
+    script = 'echo step 1; sleep 1; echo converged; sleep 1; echo done'
+    with scalems.context.scope(context):
+        cmd = scalems.executable(('/bin/sh', '-c', script))
+        quiet = scalems.executable(('/bin/echo', 'quiet'))
+    # Subscribe before the task is launched.
+    stdout = cmd.stream('stdout')
+
+    async def watch():
+        # React to output while the process is still running.
+        async for line in stdout:
+            if line.startswith('converged'):
+                return cmd.done()
+
+    async with context.dispatch():
+        watcher = asyncio.create_task(watch())
+        assert await watcher is False
+    # Streams are only created for subscribers.
+    assert context.item(quiet.uid()).subscribed_streams() == {}
+    assert quiet.result().exitcode == 0
+    result = cmd.result()
+    assert result.exitcode == 0
+    with open(result.stdout) as fh:
+        assert fh.read() == 'step 1\nconverged\ndone\n'
+    # Streams are closed when the task finishes.
+    lines = [line async for line in cmd.stream('stdout')]
+    assert lines == []
+
+
+@pytest.mark.asyncio
+async def test_ensemble_task(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=2)
+    script = 'echo member $SCALEMS_ENSEMBLE_MEMBER; exit $SCALEMS_ENSEMBLE_MEMBER'
+    with scalems.context.scope(context):
+        ensemble = scalems.executable(('/bin/sh', '-c', script), shape=(3,))
+        single = scalems.executable(('/bin/sh', '-c', script))
+    # An ensemble is a single workflow item.
+    assert len(context.task_map) == 2
+    assert ensemble.uid() != single.uid()
+    assert ensemble.description().shape() == (3,)
+    async with context.dispatch():
+        ...
+    result = ensemble.result()
+    assert len(result) == 3
+    assert list(result.exitcode) == [0, 1, 2]
+    for i, member in enumerate(result):
+        assert member.exitcode == i
+        assert member.stdout == context.task_directory(ensemble.uid()) / str(i) / 'stdout'
+        with open(member.stdout) as fh:
+            assert fh.read() == 'member {}\n'.format(i)
+    # Single tasks do not get a member index.
+    assert single.result().exitcode == 0
+
+
+@pytest.mark.asyncio
+async def test_add_items(cleandir):
+    context = scalems.local.AsyncWorkflowManager()
+    tasks = [Subprocess(SubprocessInput(('/bin/echo', str(i)))) for i in range(5)]
+    views = context.add_items(tasks)
+    assert [view.uid() for view in views] == [task.uid() for task in tasks]
+
+    # Batches are added completely or not at all.
+    with pytest.raises(DuplicateKeyError):
+        context.add_items([Subprocess(SubprocessInput(('/bin/echo', 'new'))), tasks[0]])
+    assert len(context.task_map) == len(tasks)
+
+    async with context.dispatch():
+        ...
+    for i, view in enumerate(views):
+        with open(view.result().stdout) as fh:
+            assert fh.read() == '{}\n'.format(i)
+
+
+@pytest.mark.asyncio
+async def test_add_item_while_dispatching(cleandir):
+    context = scalems.local.AsyncWorkflowManager()
+    first = context.add_item(Subprocess(SubprocessInput(('/bin/echo', 'first'))))
+    async with context.dispatch():
+        # Items added while dispatching are executed without leaving the dispatch context.
+        second = context.add_item(Subprocess(SubprocessInput(('/bin/echo', 'second'))))
+        await asyncio.wait_for(second.wait(), timeout=10)
+        assert first.done()
+        # Adaptive logic may add work based on results.
+        third = context.add_items([Subprocess(SubprocessInput(('/bin/echo', str(second.result().exitcode))))])[0]
+        await asyncio.wait_for(third.wait(), timeout=10)
+    with open(third.result().stdout) as fh:
+        assert fh.read() == '0\n'
+
+    # Completed items are not dispatched again.
+    async with context.dispatch():
+        ...
+    assert third.result().exitcode == 0
+
+
+
+@pytest.mark.asyncio
+async def test_dispatch_cancelled(cleandir):
+    context = scalems.local.AsyncWorkflowManager(cores=1)
+    started = asyncio.Event()
+
+    async def dispatch():
+        async with context.dispatch():
+            context.add_item(Subprocess(SubprocessInput(('/bin/echo', 'hello'))))
+            started.set()
+            await asyncio.sleep(60)
+
+    task = asyncio.create_task(dispatch())
+    await started.wait()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # The dispatching context was cleaned up, so it can be entered again.
+    assert context._dispatcher is None
+    async with context.dispatch():
+        ...
+
+
+def test_dependency_index():
+    index = DependencyIndex()
+    # Dependencies may be added after their successors.
+    assert not index.add(b'c', (b'a', b'b'))
+    assert index.add(b'a', ())
+    assert not index.add(b'b', (b'a', b'a'))
+    assert index.ready() == [b'a']
+    assert index.waiting() == 2
+    with pytest.raises(DuplicateKeyError):
+        index.add(b'a', ())
+
+    assert index.complete(b'a') == [b'b']
+    assert index.ready() == [b'b']
+    assert index.complete(b'b') == [b'c']
+    assert index.complete(b'c') == []
+    assert index.ready_count() == 0
+    assert index.waiting() == 0
+    # Items added after their dependencies are complete are immediately ready.
+    assert index.add(b'd', (b'c',))
+    assert len(index) == 4
+
+
+@pytest.mark.asyncio
+async def test_dispatch_order(cleandir):
+    """Only items with satisfied dependencies are dispatched."""
+    context = scalems.local.AsyncWorkflowManager(cores=4)
+    log = os.path.join(cleandir, 'log')
+    # A chain of tasks, each of which fans out to independent tasks.
+    # The chain is added in reverse, so insertion order is not a valid execution order.
+    depth = 3
+    width = 3
+    chain = [bytes([1, i]) * 16 for i in range(depth)]
+    for i in reversed(range(depth)):
+        depends = (chain[i - 1],) if i > 0 else ()
+        add_record(context, chain[i], ('/bin/sh', '-c', 'echo chain{} >> {}'.format(i, log)), depends=depends,
+                   stdout='stdout', stderr='stderr')
+        for j in range(width):
+            add_record(context, bytes([2, i, j, 0]) * 8, ('/bin/sh', '-c', 'echo leaf{} >> {}'.format(i, log)),
+                       depends=(chain[i],),
+                       stdout='stdout', stderr='stderr')
+    # A failed dependency is reported to its successors.
+    failure = add_record(context, b'\x03' * 32, (os.path.join(cleandir, 'missing'),),
+                         stdout='stdout', stderr='stderr')
+    downstream = add_record(context, b'\x04' * 32, ('/bin/true',), depends=(failure.uid(),),
+                            stdout='stdout', stderr='stderr')
+    with pytest.raises(DispatchError):
+        async with context.dispatch():
+            ...
+    assert isinstance(failure.exception(), DispatchError)
+    assert isinstance(downstream.exception(), DispatchError)
+    with open(log, 'r') as fh:
+        lines = [line.strip() for line in fh]
+    assert len(lines) == depth * (width + 1)
+    for i in range(depth):
+        assert all(lines.index('chain{}'.format(i)) < position
+                   for position, line in enumerate(lines) if line.endswith(str(i)) and line.startswith('leaf'))
+        if i > 0:
+            assert lines.index('chain{}'.format(i - 1)) < lines.index('chain{}'.format(i))
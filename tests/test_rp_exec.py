@@ -10,6 +10,7 @@ MongoDB instance and RADICAL_PILOT_DBURL environment variable.
 import asyncio
 import logging
 import os
+import time
 import warnings
 
 import pytest
@@ -157,3 +158,149 @@ async def test_exec_rp():
 
     # Test active context scoping.
     assert scalems.context.get_context() is original_context
+
+
+@pytest.mark.asyncio
+async def test_exec_rp_fake(cleandir):
+    """Dispatch through RPWorkflowContext with the local stand-in for RP."""
+    import scalems.radical.fake
+    context = scalems.radical.RPWorkflowContext(rp=scalems.radical.fake, batch_size=16)
+    with scalems.context.scope(context):
+        # Tasks added before dispatching are submitted when dispatching begins.
+        early = scalems.executable(('/bin/echo', 'early'))
+        async with context.dispatch():
+            # Partial batches are submitted after the batch interval.
+            assert isinstance(await early, scalems.radical.RPResult)
+            late = scalems.executable(('/bin/echo', 'late'))
+            assert isinstance(await late, scalems.radical.RPResult)
+            tasks = [scalems.executable(('/bin/echo', str(i))) for i in range(40)]
+            failure = scalems.executable(('/bin/false',))
+    assert all(task.done() and task.exception() is None for task in tasks)
+    assert isinstance(failure.exception(), scalems.exceptions.DispatchError)
+    # 1 + 1 + (40 + 1) tasks: early, late, two full batches, and the remainder.
+    assert context.umgr.submit_count == 5
+    assert not context.active()
+
+
+@pytest.mark.asyncio
+async def test_exec_rp_bundles(cleandir):
+    """Bundle short tasks into compute units running scalems.radical.worker."""
+    import scalems.radical.fake
+    context = scalems.radical.RPWorkflowContext(rp=scalems.radical.fake, bundle_size=8, bundle_cores=2)
+    with scalems.context.scope(context):
+        async with context.dispatch():
+            tasks = [scalems.executable(('/bin/echo', str(i))) for i in range(20)]
+            failure = scalems.executable(('/bin/false',))
+    assert all(task.exception() is None for task in tasks)
+    assert isinstance(failure.exception(), scalems.exceptions.DispatchError)
+    # 21 tasks in 3 compute units.
+    assert len(context.umgr.units) == 3
+    # Each task runs in a directory named for its uid.
+    uid = scalems.subprocess.Subprocess(scalems.subprocess.SubprocessInput(('/bin/echo', '3'))).uid()
+    assert context.task_map[uid] is tasks[3]
+    stdout = os.path.join(context.bundle_directory, uid.hex(), 'stdout')
+    with open(stdout, 'r') as fp:
+        assert fp.read() == '3\n'
+
+
+def test_bundle_results_reset(cleandir):
+    """Results are not read from an earlier bundle with the same file names."""
+    import scalems.radical.worker as worker
+    with open('bundle.results', 'w') as fp:
+        fp.write('{"name": "task", "exitcode": 0}\n')
+    worker.write_bundle('bundle.json', tasks=[], cores=1, results='bundle.results')
+    assert worker.read_results('bundle.results') == {}
+    # Bundle names are unique to a workflow context.
+    import scalems.radical.fake
+    contexts = [scalems.radical.RPWorkflowContext(rp=scalems.radical.fake) for _ in range(2)]
+    assert contexts[0]._bundle_token != contexts[1]._bundle_token
+
+
+@pytest.mark.asyncio
+async def test_exec_rp_pilots(cleandir):
+    """Spread units across pilots by free capacity."""
+    import json
+    import scalems.radical.fake
+    with open('pilots.json', 'w') as fp:
+        json.dump({'pilots': [{'cores': 1}, {'cores': 3}]}, fp)
+    context = scalems.radical.RPWorkflowContext(rp=scalems.radical.fake, config='pilots.json')
+    assert [description['cores'] for description in context.pilot_descriptions] == [1, 3]
+    assert context.pilot_descriptions[0]['resource'] == 'local.localhost'
+    with scalems.context.scope(context):
+        async with context.dispatch():
+            tasks = [scalems.executable(('/bin/sleep', '0.{}'.format(i))) for i in range(1, 9)]
+    assert all(task.exception() is None for task in tasks)
+    placement = [unit.description['pilot'] for unit in context.umgr.get_units()]
+    small, large = context.umgr.list_pilots()
+    assert placement.count(small) == 2
+    assert placement.count(large) == 6
+
+
+@pytest.mark.asyncio
+async def test_exec_rp_submit_failure(cleandir, monkeypatch):
+    """Tasks are resolved, and the session is closed, if unit submission fails."""
+    import scalems.radical.fake
+    submit_units = scalems.radical.fake.UnitManager.submit_units
+    calls = []
+
+    def fail_second(umgr, descriptions):
+        calls.append(len(descriptions))
+        if len(calls) == 2:
+            raise RuntimeError('Lost connection.')
+        return submit_units(umgr, descriptions)
+
+    monkeypatch.setattr(scalems.radical.fake.UnitManager, 'submit_units', fail_second)
+    context = scalems.radical.RPWorkflowContext(rp=scalems.radical.fake, batch_interval=0.01)
+
+    async def run():
+        with scalems.context.scope(context):
+            async with context.dispatch():
+                first = scalems.executable(('/bin/echo', 'first'))
+                await first
+                # Submitted by a timed flush.
+                second = scalems.executable(('/bin/echo', 'second'))
+                await asyncio.sleep(0.1)
+        return first, second
+
+    first, second = await asyncio.wait_for(run(), timeout=10)
+    assert first.exception() is None
+    assert isinstance(second.exception(), scalems.exceptions.DispatchError)
+    assert not context.active()
+    assert all(assigned == 0 for _, assigned in context._capacity.values())
+
+
+@pytest.mark.asyncio
+async def test_exec_rp_submit_nonblocking(cleandir, monkeypatch):
+    """A slow unit submission does not block the event loop."""
+    import scalems.radical.fake
+    monkeypatch.setattr(scalems.radical.fake, 'submit_latency', 0.5)
+    context = scalems.radical.RPWorkflowContext(rp=scalems.radical.fake, batch_interval=0.01)
+    with scalems.context.scope(context):
+        async with context.dispatch():
+            task = scalems.executable(('/bin/echo', 'hello'))
+            # Let the timed flush start the submission.
+            await asyncio.sleep(0.05)
+            assert len(context._submissions) == 1
+            start = time.monotonic()
+            await asyncio.sleep(0.01)
+            assert time.monotonic() - start < 0.25
+            await task
+    assert task.exception() is None
+    assert context._submitter is None
+
+
+def test_fake_session_close():
+    """Closing a fake session cancels queued units and lets executing units finish."""
+    import scalems.radical.fake as fake
+    with fake.Session() as session:
+        pmgr = fake.PilotManager(session)
+        umgr = fake.UnitManager(session)
+        umgr.add_pilots(pmgr.submit_pilots(fake.ComputePilotDescription({'cores': 1})))
+        units = umgr.submit_units([fake.ComputeUnitDescription({'executable': '/bin/sleep', 'arguments': [0.5]})
+                                   for _ in range(3)])
+        for _ in range(100):
+            if units[0].state == fake.AGENT_EXECUTING:
+                break
+            time.sleep(0.01)
+    assert units[0].state == fake.DONE
+    assert [unit.state for unit in units[1:]] == [fake.CANCELED, fake.CANCELED]
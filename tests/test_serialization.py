@@ -0,0 +1,161 @@
+"""Test reading and writing workflow documents."""
+
+import io
+import json
+import pathlib
+
+import pytest
+
+import scalems
+import scalems.context
+import scalems.local
+from scalems.exceptions import DuplicateKeyError, ProtocolError
+from scalems.serialization import Codec, get_codec, WorkflowReader, WorkflowWriter
+from scalems.subprocess import Subprocess
+
+
+def record(uid: int, depends=()):
+    return {'uid': bytes([uid]) * 32, 'type': ['scalems', 'Test'], 'depends': [bytes([d]) * 32 for d in depends]}
+
+
+def test_workflow_document():
+    fp = io.StringIO()
+    with WorkflowWriter(fp) as writer:
+        for i in range(100):
+            writer.write(record(i, depends=range(max(0, i - 3), i)))
+    document = fp.getvalue()
+    assert json.loads(document)['version'] == 'scalems_workflow_1'
+
+    # Read in chunks smaller than a record.
+    reader = WorkflowReader(io.StringIO(document), chunk_size=7)
+    records = list(reader)
+    assert reader.version == 'scalems_workflow_1'
+    assert [r['uid'] for r in records] == [(bytes([i]) * 32).hex() for i in range(100)]
+
+    with pytest.raises(ProtocolError):
+        WorkflowWriter(io.StringIO()).write(record(1, depends=(0,)))
+
+    # Referents out of order.
+    document = {'version': 'scalems_workflow_1', 'types': {},
+                'referents': [{'uid': 'b' * 64, 'type': ['t'], 'depends': ['a' * 64]},
+                              {'uid': 'a' * 64, 'type': ['t']}]}
+    with pytest.raises(ProtocolError):
+        list(WorkflowReader(io.StringIO(json.dumps(document))))
+    document['referents'].reverse()
+    document['referents'].append(document['referents'][0])
+    with pytest.raises(DuplicateKeyError):
+        list(WorkflowReader(io.StringIO(json.dumps(document))))
+    with pytest.raises(ProtocolError):
+        list(WorkflowReader(io.StringIO('{"version": "scalems_workflow_1", "referents": [{"uid": ')))
+
+
+def test_binary_codec():
+    codec = get_codec('binary')
+    uid = bytes(range(32)).hex()
+    record = {'uid': uid, 'type': ['scalems', 'subprocess', 'SubprocessTask'],
+              'input': {'argv': ['/bin/echo', 'h\u00e9llo'], 'inputs': {'-i': {'reference': uid}}},
+              'depends': [uid], 'shape': [2]}
+    encoded = codec.encode(record)
+    assert isinstance(encoded, bytes)
+    assert len(encoded) < len(get_codec('json').encode(record))
+    assert codec.decode(encoded) == record
+    with pytest.raises(ProtocolError):
+        codec.decode(encoded + b'\x00')
+
+    # Members are decoded as from JSON, whether or not they can be packed.
+    members = {'input': {'argv': ('/bin/echo', pathlib.Path('out')), 'empty': [{}, []], 1: None},
+               'numbers': [0, -1, 1 << 70, 0.5, True, False], 'reference': scalems.context.ItemView(scalems.local.AsyncWorkflowManager(), bytes(32))}
+    for extra in ({}, {'text': 'null\0character'}, {'key\0': 'value'}):
+        record = dict(uid=uid, type=['t'], depends=[], **members, **extra)
+        expected = json.loads(get_codec('json').encode(record))
+        assert codec.decode(codec.encode(record)) == expected
+    # The structure is checked.
+    encoded = codec.encode({'uid': uid, 'type': ['t'], 'value': 'text'})
+    with pytest.raises(ProtocolError):
+        codec.decode(encoded.replace(b':value\x00s', b':value\x00x'))
+
+
+@pytest.mark.parametrize('codec', ['json', 'binary'])
+def test_dump_and_load(cleandir, codec):
+    context = scalems.local.AsyncWorkflowManager(codec=codec)
+    with scalems.context.scope(context):
+        first = scalems.executable(('/bin/echo', 'hello'))
+        second = scalems.executable(('/bin/cat',), inputs={'-': first}, shape=(2,))
+    # Items can be added before their dependencies.
+    context.task_map = dict(reversed(list(context.task_map.items())))
+    fp = io.BytesIO() if codec == 'binary' else io.StringIO()
+    context.dump(fp)
+
+    fp.seek(0)
+    restored = scalems.local.AsyncWorkflowManager(codec=codec)
+    assert restored.load(fp) == 2
+    assert list(restored.task_map) == [first.uid(), second.uid()]
+    assert restored.item(second.uid()).dependencies() == (first.uid(),)
+    assert restored.item(second.uid()).description().shape() == (2,)
+
+    # Records can be restored as tasks.
+    encoded = restored.item(second.uid()).serialize()
+    task = Subprocess.deserialize(encoded, context=restored, codec=codec)
+    assert task.uid() == second.uid()
+    assert task.dependencies() == (first.uid(),)
+    tampered = get_codec(codec).decode(encoded)
+    tampered['input']['argv'] = ['/bin/false']
+    with pytest.raises(ProtocolError):
+        Subprocess.deserialize(tampered)
+
+    # Documents can be converted between codecs.
+    fp = io.StringIO()
+    restored.dump(fp, codec='json')
+    fp.seek(0)
+    converted = scalems.local.AsyncWorkflowManager(codec='binary')
+    assert converted.load(fp, codec='json') == 2
+    assert converted.item(second.uid()).input == restored.item(second.uid()).input
+
+
+class CountingReader:
+    """Count the amount of data read from a file object."""
+    def __init__(self, fp):
+        self.fp = fp
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.count += len(data)
+        return data
+
+
+@pytest.mark.parametrize('codec', ['json', 'binary'])
+def test_malformed_document(codec):
+    """Malformed documents are rejected without reading the rest of the document."""
+    fp = io.BytesIO() if codec == 'binary' else io.StringIO()
+    with WorkflowWriter(fp, codec=codec) as writer:
+        for i in range(200):
+            writer.write(record(i, depends=range(max(0, i - 3), i)))
+    document = fp.getvalue()
+    size = len(document)
+    if codec == 'binary':
+        # Corrupt the version byte of the first record, after the frame length.
+        first = document.index(bytes([0]) * 32) - 1
+        corrupt = document[:first] + b'\xff' + document[first + 1:]
+        # Claim an oversized first record.
+        oversize = document[:first - 4] + b'\xff\xff\xff\x7f' + document[first:]
+    else:
+        first = document.index('{"uid"')
+        corrupt = document[:first] + '{"uid" 1' + document[first + 6:]
+        oversize = document[:first] + '"' + 'x' * 1000 + document[first:]
+    for data in (corrupt, oversize):
+        reader = CountingReader(io.BytesIO(data) if codec == 'binary' else io.StringIO(data))
+        with pytest.raises(ProtocolError):
+            list(WorkflowReader(reader, codec=codec, chunk_size=64, max_record_size=512))
+        assert reader.count < size / 4
+
+
+def test_codec_interface():
+    class Incomplete(Codec):
+        name = 'incomplete'
+
+        def encode(self, record):
+            return ''
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -6,13 +6,15 @@ TODO: Consider whether we can reimplement as a parameterized test over the
 
 import asyncio
 import logging
+import os
 
 import pytest
 
 import scalems.context
 import scalems.local
-from scalems.exceptions import MissingImplementationError
+from scalems.exceptions import DuplicateKeyError, MissingImplementationError
 import scalems.local_immediate
+import scalems.subprocess
 from scalems.subprocess import executable
 
 
@@ -72,6 +74,8 @@ async def test_exec_local(cleandir):
         assert result.stdout.name == 'stdout.txt'
         with open(result.stdout) as fh:
             assert fh.read().startswith('hi there')
+        # Staged input is cleaned up.
+        assert sorted(os.listdir(context.task_directory(cmd.uid()))) == ['stderr', 'stdout.txt']
 
 # Currently in test_rp_exec.py
 # def test_exec_rp():
@@ -80,4 +84,39 @@ async def test_exec_local(cleandir):
 #     cmd = executable(('/bin/echo',))
 #     context = sms_context.RPDispatcher()
 #     with context as session:
-#         session.run(cmd)
\ No newline at end of file
+#         session.run(cmd)
+
+def test_subprocess_uid():
+    def uid(*args, **kwargs):
+        return scalems.subprocess.Subprocess(scalems.subprocess.SubprocessInput(*args, **kwargs)).uid()
+
+    reference = uid(('/bin/echo', 'hi'))
+    assert isinstance(reference, bytes)
+    assert len(reference) == 32
+    # Fingerprints are deterministic.
+    assert uid(['/bin/echo', 'hi']) == reference
+    # Output locations do not affect identity.
+    assert uid(('/bin/echo', 'hi'), stdout='other') == reference
+    assert uid(('/bin/echo', 'hello')) != reference
+    assert uid(('/bin/echo', 'hi'), environment={'A': '1'}) != reference
+    assert uid(('/bin/echo', 'hi'), stdin=('data',)) != reference
+    assert uid(('/bin/echo', 'hi'), inputs={'-i': 'infile'}) != reference
+
+
+@pytest.mark.asyncio
+async def test_exec_local_ensemble(cleandir):
+    # Distinct commands can be added to the same workflow.
+    context = scalems.local.AsyncWorkflowManager()
+    with scalems.context.scope(context):
+        # Tasks are isolated in their own working directories.
+        commands = [executable(('/bin/echo', str(i))) for i in range(3)]
+        assert len(set(cmd.uid() for cmd in commands)) == 3
+        with pytest.raises(DuplicateKeyError):
+            executable(('/bin/echo', '0'))
+        async with context.dispatch():
+            ...
+    for i, cmd in enumerate(commands):
+        result = cmd.result()
+        assert result.stdout.parent == context.task_directory(cmd.uid())
+        with open(result.stdout) as fh:
+            assert fh.read().strip() == str(i)